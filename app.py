@@ -4,13 +4,22 @@ from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 import uuid
 import os
+import re
 import logging
 from datetime import datetime
 import traceback
-from service.watermark_service import WatermarkRemovalService
 from config.config import Config
+from service import thread_tuning
+from service import cost_model
+from service import image_decode
+from service.cancellation import CancelToken, Cancelled, socket_disconnected
 from threading import Thread
 
+# 在导入TensorFlow之前应用CPU线程配置（OpenMP/MKL环境变量）
+thread_tuning.startup()
+
+from service.watermark_service import WatermarkRemovalService
+
 app = Flask(__name__)
 app.config.from_object(Config)
 
@@ -25,11 +34,43 @@ service = WatermarkRemovalService()
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'mp4', 'avi', 'mov', 'mkv'}
+# 客户端指定的task_id，用于取消和去重，也用在文件名中
+TASK_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
 
 def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def job_options(default_deadline_s):
+    """
+    请求中的task_id和deadline_s：不传task_id时生成新的，同一task_id重复提交时
+    取消进行中的任务；deadline_s只能缩短服务端期限
+
+    Returns:
+        tuple: (task_id, deadline_s)
+
+    Raises:
+        ValueError: 参数无效
+    """
+    task_id = request.form.get('task_id') or str(uuid.uuid4())
+    if not TASK_ID_PATTERN.match(task_id):
+        raise ValueError(f"Invalid task_id: {task_id}")
+    deadline_s = default_deadline_s
+    if request.form.get('deadline_s'):
+        try:
+            requested = float(request.form['deadline_s'])
+        except ValueError:
+            requested = 0.
+        if not requested > 0:
+            raise ValueError(f"Invalid deadline_s: {request.form['deadline_s']}")
+        deadline_s = min(requested, deadline_s) if deadline_s > 0 else requested
+    return task_id, deadline_s
+
+def client_disconnected():
+    """检查同步请求的客户端是否已断开；WSGI服务器不提供socket时不检查"""
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    return None if sock is None else socket_disconnected(sock)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查端点"""
@@ -39,6 +80,21 @@ def health_check():
         "timestamp": datetime.utcnow().isoformat()
     }), 200
 
+@app.route('/api/v1/watermark-types', methods=['GET'])
+def watermark_types():
+    """列出可用的水印类型及其mask变体"""
+    return jsonify(service.masks.describe()), 200
+
+@app.route('/api/v1/stats/decode', methods=['GET'])
+def decode_stats():
+    """按图像格式统计的解码耗时和像素内存峰值"""
+    return jsonify(image_decode.stats.summary()), 200
+
+@app.route('/api/v1/stats/scheduler', methods=['GET'])
+def scheduler_stats():
+    """每个推理通道的权重、排队数、推理时间和等待时间"""
+    return jsonify(service.scheduler.summary()), 200
+
 @app.route('/api/v1/remove-watermark', methods=['POST'])
 def remove_watermark():
     """去水印API端点"""
@@ -54,35 +110,99 @@ def remove_watermark():
         if not allowed_file(file.filename):
             return jsonify({"error": "File type not allowed"}), 400
 
-        # 获取水印类型参数
+        # 获取水印类型参数，auto表示在所有水印类型中检测
         watermark_type = request.form.get('watermark_type', 'istock')
-
-        # 生成唯一的文件名
-        task_id = str(uuid.uuid4())
+        if watermark_type != service.AUTO_TYPE and watermark_type not in service.masks.types():
+            return jsonify({"error": f"Unknown watermark type: {watermark_type}"}), 400
+
+        # 获取检测参数：1先定位水印，没有水印时直接返回原图；不传时使用服务端配置
+        detect = request.form.get('detect')
+        if detect is not None:
+            if detect not in ('0', '1'):
+                return jsonify({"error": f"Invalid detect: {detect}"}), 400
+            detect = detect == '1'
+
+        # 获取质量参数：preview只运行第一阶段，用于快速预览
+        quality = request.form.get('quality', 'full')
+        if quality not in service.QUALITY_LEVELS:
+            return jsonify({"error": f"Unknown quality: {quality}"}), 400
+
+        # 获取引擎参数：classical使用cv2.inpaint快速修复，auto在过载或mask很小时自动降级
+        engine = request.form.get('engine', 'auto')
+        if engine not in service.ENGINES:
+            return jsonify({"error": f"Unknown engine: {engine}"}), 400
+
+        # 获取调试参数：attention在同一次推理中输出contextual attention的flow图像
+        debug = request.form.get('debug') or None
+        if debug is not None:
+            if debug not in service.DEBUG_OPTIONS:
+                return jsonify({"error": f"Unknown debug: {debug}"}), 400
+            if engine == 'classical' or quality != 'full':
+                return jsonify({"error": f"debug={debug} needs engine=neural and quality=full"}), 400
+            if debug not in service.debug_options():
+                return jsonify({"error": f"debug={debug} is not supported by this backend"}), 400
+
+        # 任务ID和期限：排队或处理中超过期限时返回504，被取消或被重复提交取代时返回409
+        try:
+            task_id, deadline_s = job_options(Config.IMAGE_DEADLINE_S)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # 生成唯一的文件名，重复提交的task_id不共用输入文件
         filename = secure_filename(file.filename)
         file_extension = filename.rsplit('.', 1)[1].lower()
-        input_filename = f"{task_id}_input.{file_extension}"
+        input_filename = f"{uuid.uuid4()}_input.{file_extension}"
         output_filename = f"{task_id}_output.png"
 
         # 保存上传的文件
         input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
         output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+        debug_path = None if debug is None else \
+            os.path.join(app.config['OUTPUT_FOLDER'], f"{task_id}_{debug}.png")
 
         file.save(input_path)
         logger.info(f"File saved: {input_path}")
 
-        # 处理图像
-        success = service.process_image(
-            input_path, output_path, watermark_type
-        )
-
-        if success:
-            return jsonify({
+        # 只读文件头，在完整解码之前拒绝无法识别或像素过多的图像
+        try:
+            info = image_decode.probe(input_path)
+        except image_decode.ImageTooLarge as e:
+            return jsonify({"error": f"Image too large: {e}"}), 413
+        except (OSError, SyntaxError, ValueError):
+            return jsonify({"error": "Unreadable image"}), 400
+        logger.info(f"Image info: {info.describe()}")
+
+        # 处理图像：预测内存超过预算且无法缩小或分块时返回413，排队过长时返回429，
+        # 客户端断开时离开队列或在块之间停止
+        token = CancelToken(deadline_s, disconnected=client_disconnected())
+        try:
+            with service.jobs.track(task_id, token):
+                engine_used = service.process_image(
+                    input_path, output_path, watermark_type, quality=quality, engine=engine,
+                    detect=detect, info=info, debug=debug, debug_path=debug_path, token=token
+                )
+        except Cancelled as e:
+            return jsonify({"error": f"Job {e.reason}", "task_id": task_id}), \
+                504 if e.reason == 'deadline' else 409
+        except cost_model.JobTooLarge as e:
+            return jsonify({"error": f"Image too large: {e}"}), 413
+        except cost_model.Overloaded as e:
+            return jsonify({"error": f"Server busy: {e}"}), 429, \
+                {"Retry-After": str(e.retry_after_s)}
+
+        if engine_used:
+            response = {
                 "success": True,
                 "task_id": task_id,
-                "message": "Watermark removed successfully",
+                "quality": quality,
+                "engine": engine_used,
+                "message": "No watermark detected" if engine_used == 'none'
+                           else "Watermark removed successfully",
                 "download_url": f"/api/v1/download/{task_id}"
-            }), 200
+            }
+            if debug_path is not None and os.path.exists(debug_path):
+                response["debug_url"] = f"/api/v1/download/{task_id}/{debug}"
+            return jsonify(response), 200
         else:
             return jsonify({
                 "success": False,
@@ -123,6 +243,18 @@ def download_result(task_id):
         logger.error(f"Error downloading file: {str(e)}")
         return jsonify({"error": "Failed to download file"}), 500
 
+@app.route('/api/v1/download/<task_id>/<debug>', methods=['GET'])
+def download_debug(task_id, debug):
+    """下载debug图像"""
+    if debug not in service.DEBUG_OPTIONS:
+        return jsonify({"error": f"Unknown debug: {debug}"}), 404
+    debug_path = os.path.join(app.config['OUTPUT_FOLDER'],
+                              f"{secure_filename(task_id)}_{debug}.png")
+    if not os.path.exists(debug_path):
+        return jsonify({"error": "File not found"}), 404
+    return send_file(debug_path, as_attachment=True,
+                     download_name=f"{debug}_{task_id}.png", mimetype='image/png')
+
 @app.route('/api/v1/remove-watermark-video', methods=['POST'])
 def remove_watermark_video():
     """视频去水印API端点"""
@@ -138,11 +270,16 @@ def remove_watermark_video():
             return jsonify({"error": "Video file type not allowed"}), 400
 
         watermark_type = request.form.get('watermark_type', 'istock')
-        task_id = str(uuid.uuid4())
+        if watermark_type not in service.masks.types():
+            return jsonify({"error": f"Unknown watermark type: {watermark_type}"}), 400
+        try:
+            task_id, deadline_s = job_options(Config.VIDEO_DEADLINE_S)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         filename = secure_filename(file.filename)
         file_extension = filename.rsplit('.', 1)[1].lower()
-        input_filename = f"{task_id}_input.{file_extension}"
+        input_filename = f"{uuid.uuid4()}_input.{file_extension}"
         output_filename = f"{task_id}_output.mp4"
 
         input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
@@ -151,17 +288,23 @@ def remove_watermark_video():
         file.save(input_path)
         logger.info(f"Video file saved: {input_path}")
 
-        # 异步处理视频
-        def process_async():
-            success = service.process_video(input_path, output_path, watermark_type, task_id)
-            if not success:
-                logger.error(f"Failed to process video: {task_id}")
+        # 异步处理视频，在返回之前登记，之后可以通过取消接口停止
+        token = CancelToken(deadline_s)
+        service.jobs.add(task_id, token)
 
-            # 清理输入文件
+        def process_async():
             try:
-                os.remove(input_path)
-            except:
-                pass
+                success = service.process_video(input_path, output_path, watermark_type,
+                                                task_id, token=token)
+                if not success and token.reason is None:
+                    logger.error(f"Failed to process video: {task_id}")
+            finally:
+                service.jobs.remove(task_id, token)
+                # 清理输入文件
+                try:
+                    os.remove(input_path)
+                except:
+                    pass
 
         thread = Thread(target=process_async)
         thread.daemon = True
@@ -172,13 +315,25 @@ def remove_watermark_video():
             "task_id": task_id,
             "message": "Video processing started",
             "progress_url":f"/api/v1/video-progress/{task_id}",
-            "download_url": f"/api/v1/download-video/{task_id}"
+            "download_url": f"/api/v1/download-video/{task_id}",
+            "cancel_url": f"/api/v1/cancel/{task_id}"
         }), 202
 
     except Exception as e:
         logger.error(f"Error starting video processing: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/api/v1/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """取消排队或处理中的任务，任务在下一帧、块或批之前停止并删除临时文件"""
+    if not service.jobs.cancel(task_id):
+        return jsonify({"error": "Task not found or already finished"}), 404
+    return jsonify({
+        "success": True,
+        "task_id": task_id,
+        "message": "Cancellation requested"
+    }), 202
+
 @app.route('/api/v1/video-progress/<task_id>', methods=['GET'])
 def get_video_progress(task_id):
     """获取视频处理进度"""
@@ -0,0 +1,407 @@
+"""Batch watermark removal for large image sets.
+
+Each flist line is either `input output` (the mask comes from the mask
+registry for --watermark_type) or `input mask output` (the batch_test.py
+format). A pool of decode workers prefetches images ahead of inference.
+Images are padded up to a multiple of --bucket and grouped by padded shape
+and mask, so mixed resolutions still run in full batches. Registry masks are
+grouped by template; a batch is inpainted with the union of their resized
+masks and each result keeps the original pixels outside its own mask. Results are written
+by a separate pool of writers at their original size.
+
+Every finished or failed file is appended to a JSONL manifest, so a rerun
+skips files that are already done. Throughput is reported while running and
+at the end.
+
+    python batch_inpaint.py --flist catalogue.flist --checkpoint_dir model/ \
+        --batch_size 4 --decode_workers 4 --manifest catalogue.manifest.jsonl
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from service.image_decode import decode_image
+from service.inference_backend import BACKENDS, create_backend
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--flist', default='', type=str,
+                    help='One image per line: "input output" or "input mask output".')
+parser.add_argument('--watermark_type', default='istock', type=str,
+                    help='Watermark type for lines without a mask.')
+parser.add_argument('--checkpoint_dir', default='model/', type=str,
+                    help='The directory of tensorflow checkpoint.')
+parser.add_argument('--backend', default='tensorflow', type=str,
+                    choices=sorted(BACKENDS),
+                    help='The inference backend.')
+parser.add_argument('--guided', action='store_true',
+                    help='Edge-guided checkpoint; edges are computed in the graph.')
+parser.add_argument('--onnx_model', default='model/inpaint.onnx', type=str,
+                    help='The ONNX model for the onnxruntime backend.')
+parser.add_argument('--quality', default='full', type=str,
+                    choices=['full', 'preview'])
+parser.add_argument('--batch_size', default=4, type=int,
+                    help='Images per inference call.')
+parser.add_argument('--bucket', default=64, type=int,
+                    help='Pad images up to a multiple of this, so that similar '
+                    'sizes share a batch (and a cached graph).')
+parser.add_argument('--max_pending', default=0, type=int,
+                    help='Decoded images held while waiting for a full batch; '
+                    'the largest bucket is flushed beyond this. 0: 4 batches.')
+parser.add_argument('--decode_workers', default=os.cpu_count() or 1, type=int)
+parser.add_argument('--write_workers', default=2, type=int)
+parser.add_argument('--prefetch', default=0, type=int,
+                    help='Images decoded ahead of inference. 0: 2 batches '
+                    'per decode worker.')
+parser.add_argument('--manifest', default='', type=str,
+                    help='JSONL manifest; defaults to <flist>.manifest.jsonl.')
+parser.add_argument('--report_every', default=30., type=float,
+                    help='Seconds between progress reports.')
+parser.add_argument('--report', default='', type=str,
+                    help='Optional JSON file for the final throughput report.')
+
+
+def read_flist(path):
+    """
+    Returns:
+        list: (input, mask or None, output) tuples
+    """
+    items = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) == 2:
+                items.append((fields[0], None, fields[1]))
+            elif len(fields) == 3:
+                items.append(tuple(fields))
+            else:
+                raise ValueError(f"Bad flist line: {line.strip()}")
+    return items
+
+
+class Manifest:
+    """Append-only JSONL record of processed files, keyed by output path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupted run
+                        continue
+                    if record.get('status') == 'done':
+                        self.done.add(record['output'])
+                    else:
+                        self.done.discard(record['output'])
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def is_done(self, output):
+        return output in self.done and os.path.exists(output)
+
+    def append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if record['status'] == 'done':
+                self.done.add(record['output'])
+
+    def close(self):
+        self._file.close()
+
+
+class Sample:
+    """A decoded image with its padded inputs."""
+
+    def __init__(self, item, image, mask, padded_image, padded_mask, key,
+                 decode_ms):
+        self.input, self.mask_path, self.output = item
+        self.image = image
+        self.mask = mask
+        self.padded_image = padded_image
+        self.padded_mask = padded_mask
+        self.key = key
+        self.decode_ms = decode_ms
+
+
+def pad_to(array, height, width, border):
+    h, w = array.shape[:2]
+    if (h, w) == (height, width):
+        return array
+    padded = cv2.copyMakeBorder(array, 0, height - h, 0, width - w, border)
+    return padded.reshape((height, width) + array.shape[2:])
+
+
+def load_sample(item, watermark_type, bucket, registry):
+    """Decode one image and its mask, pad both up to the bucket size."""
+    start = time.time()
+    image, _ = decode_image(item[0])
+    height, width = image.shape[:2]
+    if item[1] is None:
+        entry = registry.get(watermark_type, width, height)
+        mask = entry.mask
+        # the same template resized to sizes within one bucket differs by a few
+        # pixels; these images share a batch and the union of their masks
+        mask_key = entry.template.path
+    else:
+        mask = cv2.imread(item[1], cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"Cannot read mask {item[1]}")
+        if mask.shape != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        mask = np.where(mask > 127, 255, 0).astype(np.uint8)[:, :, None]
+        mask_key = None
+    bucket_h = -(-height // bucket) * bucket
+    bucket_w = -(-width // bucket) * bucket
+    # reflect so the padding looks like image content to the model, the mask
+    # is zero there so it is never inpainted
+    padded_image = pad_to(image, bucket_h, bucket_w, cv2.BORDER_REFLECT)
+    padded_mask = pad_to(mask, bucket_h, bucket_w, cv2.BORDER_CONSTANT)
+    if mask_key is None:
+        mask_key = hashlib.blake2b(padded_mask.tobytes(), digest_size=8).hexdigest()
+    return Sample(item, image, mask, padded_image, padded_mask,
+                  (bucket_h, bucket_w, mask_key), (time.time() - start) * 1000.)
+
+
+def batch_mask(batch):
+    """The mask shared by a batch: the union of the padded sample masks."""
+    mask = batch[0].padded_mask
+    for sample in batch[1:]:
+        if sample.padded_mask is not batch[0].padded_mask:
+            mask = np.maximum(mask, sample.padded_mask)
+    return mask
+
+
+def write_result(sample, result_bgr):
+    """Crop the padded result back and write it at the original size, with
+    the original pixels outside the sample's own mask."""
+    height, width = sample.image.shape[:2]
+    result_bgr = result_bgr[:height, :width]
+    result_bgr = np.where(sample.mask > 0, result_bgr,
+                          cv2.cvtColor(sample.image, cv2.COLOR_RGB2BGR))
+    directory = os.path.dirname(sample.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if not cv2.imwrite(sample.output, result_bgr):
+        raise IOError(f"Cannot write {sample.output}")
+
+
+class Throughput:
+    """Counters for the progress and final reports."""
+
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.megapixels = 0.
+        self.batches = 0
+        self.stage_seconds = collections.Counter()
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, ok, megapixels=0.):
+        with self._lock:
+            if ok:
+                self.done += 1
+                self.megapixels += megapixels
+            else:
+                self.failed += 1
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        with self._lock:
+            return {
+                'total': self.total,
+                'skipped': self.skipped,
+                'done': self.done,
+                'failed': self.failed,
+                'batches': self.batches,
+                'elapsed_s': elapsed,
+                'images_per_s': self.done / elapsed,
+                'megapixels_per_s': self.megapixels / elapsed,
+                'mean_batch': self.done / max(self.batches, 1),
+                'stage_seconds': dict(self.stage_seconds),
+            }
+
+
+class BatchRunner:
+    """
+    Prefetching, shape-bucketed batch inference.
+
+    Args:
+        backend: a loaded InferenceBackend
+        manifest: Manifest
+        registry: MaskRegistry for flist lines without a mask
+    """
+
+    def __init__(self, backend, manifest, registry=None, watermark_type='istock',
+                 quality='full', batch_size=4, bucket=64, max_pending=0,
+                 decode_workers=1, write_workers=2, prefetch=0, report_every=30.):
+        self.backend = backend
+        self.manifest = manifest
+        self.registry = registry
+        self.watermark_type = watermark_type
+        self.quality = quality
+        self.batch_size = batch_size
+        self.bucket = bucket
+        self.max_pending = max_pending or 4 * batch_size
+        self.decode_workers = decode_workers
+        self.write_workers = write_workers
+        self.prefetch = prefetch or 2 * batch_size * decode_workers
+        self.report_every = report_every
+        self.stats = None
+        self._writes = []
+
+    def run(self, items):
+        todo = [item for item in items if not self.manifest.is_done(item[2])]
+        self.stats = Throughput(len(items), len(items) - len(todo))
+        print(f'{len(todo)} to process, {self.stats.skipped} already done.')
+        buckets = collections.OrderedDict()
+        pending = 0
+        last_report = time.time()
+        with concurrent.futures.ThreadPoolExecutor(self.decode_workers) as decoders, \
+                concurrent.futures.ThreadPoolExecutor(self.write_workers) as self._writers:
+            queue = collections.deque()
+            todo = iter(todo)
+            for item in todo:
+                queue.append((item, decoders.submit(self._load, item)))
+                if len(queue) >= self.prefetch:
+                    break
+            while queue:
+                item, future = queue.popleft()
+                next_item = next(todo, None)
+                if next_item is not None:
+                    queue.append((next_item, decoders.submit(self._load, next_item)))
+                t = time.time()
+                try:
+                    sample = future.result()
+                except Exception as e:
+                    self._finish(item, 'failed', error=f'decode: {e}')
+                    continue
+                finally:
+                    self.stats.stage_seconds['decode_wait'] += time.time() - t
+
+                batch = buckets.setdefault(sample.key, [])
+                batch.append(sample)
+                pending += 1
+                if len(batch) == self.batch_size:
+                    pending -= len(buckets.pop(sample.key))
+                    self._infer(batch)
+                elif pending > self.max_pending:
+                    # too many stragglers in partial buckets: run the fullest
+                    key = max(buckets, key=lambda k: len(buckets[k]))
+                    pending -= len(buckets[key])
+                    self._infer(buckets.pop(key))
+
+                if time.time() - last_report > self.report_every:
+                    last_report = time.time()
+                    self._print_progress()
+
+            for batch in buckets.values():
+                self._infer(batch)
+            t = time.time()
+            concurrent.futures.wait(self._writes)
+            self.stats.stage_seconds['write_wait'] += time.time() - t
+        return self.stats.report()
+
+    def _load(self, item):
+        return load_sample(item, self.watermark_type, self.bucket, self.registry)
+
+    def _infer(self, batch):
+        t = time.time()
+        try:
+            results = self.backend.run(
+                np.stack([s.padded_image for s in batch]),
+                batch_mask(batch)[None], quality=self.quality, bgr=True)
+        except Exception as e:
+            for sample in batch:
+                self._finish(sample, 'failed', error=f'inference: {e}')
+            return
+        finally:
+            self.stats.stage_seconds['inference'] += time.time() - t
+        self.stats.batches += 1
+        infer_ms = (time.time() - t) * 1000. / len(batch)
+        for sample, result in zip(batch, results):
+            future = self._writers.submit(write_result, sample, result)
+            future.add_done_callback(
+                lambda f, sample=sample: self._written(f, sample, infer_ms))
+            self._writes.append(future)
+        # keep only unfinished writes around
+        self._writes = [f for f in self._writes if not f.done()]
+
+    def _written(self, future, sample, infer_ms):
+        error = future.exception()
+        if error is not None:
+            self._finish(sample, 'failed', error=f'write: {error}')
+            return
+        height, width = sample.image.shape[:2]
+        self._finish(sample, 'done', size=[width, height],
+                     decode_ms=round(sample.decode_ms, 1),
+                     inference_ms=round(infer_ms, 1))
+
+    def _finish(self, item, status, **fields):
+        if isinstance(item, Sample):
+            megapixels = item.image.shape[0] * item.image.shape[1] / 1e6
+            item = (item.input, item.mask_path, item.output)
+        else:
+            megapixels = 0.
+        if status == 'failed':
+            print(f'Failed: {item[0]}: {fields.get("error")}')
+        self.manifest.append(dict(input=item[0], output=item[2], status=status,
+                                  time=time.time(), **fields))
+        self.stats.add(status == 'done', megapixels)
+
+    def _print_progress(self):
+        report = self.stats.report()
+        print(f"{report['done'] + report['failed']}/{report['total'] - report['skipped']} "
+              f"({report['failed']} failed), {report['images_per_s']:.2f} img/s, "
+              f"{report['megapixels_per_s']:.2f} MP/s, mean batch {report['mean_batch']:.1f}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    items = read_flist(args.flist)
+
+    registry = None
+    if any(mask is None for _, mask, _ in items):
+        from service.mask_registry import default_registry
+        registry = default_registry()
+
+    if args.backend == 'onnxruntime':
+        backend = create_backend(args.backend, model_path=args.onnx_model)
+    elif args.backend == 'tensorflow':
+        backend = create_backend(args.backend, checkpoint_dir=args.checkpoint_dir,
+                                 guided=args.guided or None)
+    else:
+        backend = create_backend(args.backend)
+    print('Model loaded.')
+
+    manifest = Manifest(args.manifest or args.flist + '.manifest.jsonl')
+    runner = BatchRunner(
+        backend, manifest, registry=registry, watermark_type=args.watermark_type,
+        quality=args.quality, batch_size=args.batch_size, bucket=args.bucket,
+        max_pending=args.max_pending, decode_workers=args.decode_workers,
+        write_workers=args.write_workers, prefetch=args.prefetch,
+        report_every=args.report_every)
+    try:
+        report = runner.run(items)
+    finally:
+        manifest.close()
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
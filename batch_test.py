@@ -4,10 +4,9 @@ import argparse
 
 import cv2
 import numpy as np
-import tensorflow as tf
 import neuralgym as ng
 
-from inpaint_model import InpaintCAModel
+from service.inference_backend import create_backend
 
 
 parser = argparse.ArgumentParser()
@@ -28,31 +27,11 @@ parser.add_argument(
 
 
 if __name__ == "__main__":
-    FLAGS = ng.Config('inpaint.yml')
     ng.get_gpus(1)
     # os.environ['CUDA_VISIBLE_DEVICES'] =''
     args = parser.parse_args()
 
-    sess_config = tf.ConfigProto()
-    sess_config.gpu_options.allow_growth = True
-    sess = tf.Session(config=sess_config)
-
-    model = InpaintCAModel()
-    input_image_ph = tf.placeholder(
-        tf.float32, shape=(1, args.image_height, args.image_width*2, 3))
-    output = model.build_server_graph(FLAGS, input_image_ph)
-    output = (output + 1.) * 127.5
-    output = tf.reverse(output, [-1])
-    output = tf.saturate_cast(output, tf.uint8)
-    vars_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-    assign_ops = []
-    for var in vars_list:
-        vname = var.name
-        from_name = vname
-        var_value = tf.contrib.framework.load_variable(
-            args.checkpoint_dir, from_name)
-        assign_ops.append(tf.assign(var, var_value))
-    sess.run(assign_ops)
+    backend = create_backend('tensorflow', checkpoint_dir=args.checkpoint_dir)
     print('Model loaded.')
 
     with open(args.flist, 'r') as f:
@@ -81,12 +60,10 @@ if __name__ == "__main__":
         print('Shape of image: {}'.format(image.shape))
 
         image = np.expand_dims(image, 0)
-        mask = np.expand_dims(mask, 0)
-        input_image = np.concatenate([image, mask], axis=2)
+        mask = np.expand_dims(mask[:, :, 0:1], 0)
 
-        # load pretrained model
-        result = sess.run(output, feed_dict={input_image_ph: input_image})
+        result = backend.run(image, mask)
         print('Processed: {}'.format(out))
-        cv2.imwrite(out, result[0][:, :, ::-1])
+        cv2.imwrite(out, result[0])
 
     print('Time total: {}'.format(time.time() - t))
@@ -0,0 +1,78 @@
+"""Compare latency of the inference backends on the same inputs.
+
+The ONNX model has a fixed input size, so both backends run at that size.
+
+    python benchmark/bench_backends.py --onnx_model model/inpaint.onnx
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from service.inference_backend import create_backend
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='model/', type=str)
+parser.add_argument('--onnx_model', default='model/inpaint.onnx', type=str)
+parser.add_argument('--runs', default=10, type=int)
+parser.add_argument('--output', default='', type=str,
+                    help='Optional JSON file for the results.')
+
+
+def bench(backend, image, mask, runs):
+    t = time.time()
+    backend.run(image, mask)
+    first_ms = (time.time() - t) * 1000.
+    latencies = []
+    for _ in range(runs):
+        t = time.time()
+        result = backend.run(image, mask)
+        latencies.append((time.time() - t) * 1000.)
+    return result, {
+        'first_run_ms': first_ms,
+        'mean_latency_ms': float(np.mean(latencies)),
+        'p50_latency_ms': float(np.percentile(latencies, 50)),
+        'p95_latency_ms': float(np.percentile(latencies, 95)),
+    }
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    report = {}
+    t = time.time()
+    onnx_backend = create_backend('onnxruntime', model_path=args.onnx_model)
+    load_onnx_ms = (time.time() - t) * 1000.
+    height, width = onnx_backend.capabilities()['input_size']
+    t = time.time()
+    tf_backend = create_backend('tensorflow', checkpoint_dir=args.checkpoint_dir)
+    load_tf_ms = (time.time() - t) * 1000.
+
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (1, height, width, 3)).astype(np.uint8)
+    mask = np.zeros((1, height, width, 1), np.uint8)
+    mask[:, height//4:height//2, width//3:width*2//3] = 255
+
+    results = {}
+    for backend, load_ms in ((tf_backend, load_tf_ms),
+                             (onnx_backend, load_onnx_ms)):
+        results[backend.name], report[backend.name] = bench(
+            backend, image, mask, args.runs)
+        report[backend.name]['load_ms'] = load_ms
+    diff = np.abs(results['tensorflow'].astype(np.float32) -
+                  results['onnxruntime'].astype(np.float32))
+    report['input_size'] = [height, width]
+    report['mean_abs_diff'] = float(diff.mean())
+    report['max_abs_diff'] = float(diff.max())
+    report['speedup'] = report['tensorflow']['mean_latency_ms'] / \
+        report['onnxruntime']['mean_latency_ms']
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
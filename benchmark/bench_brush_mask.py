@@ -0,0 +1,134 @@
+"""Benchmark free-form training mask generation in a tf.data pipeline.
+
+`tf` is random_brush_strokes in native TF ops; `pil` is the earlier
+generator, drawing with PIL inside a stateful tf.py_func; `bank` takes the
+masks from a memory-mapped bank of --bank_size precomputed strokes and
+flips and shifts them (bank_brush_strokes); writing the bank is not timed.
+Masks are mapped from Dataset.range with each value of --parallel_calls and
+fetched in batches of --batch_size, so the numbers show how far each
+generator scales across input pipeline workers rather than the cost of a
+session run.
+
+    python benchmark/bench_brush_mask.py --size 256x256 --parallel_calls 1 4 8
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.isolated import run_in_process
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', default='256x256', type=str, help='HxW')
+parser.add_argument('--masks', default=2000, type=int, help='Masks per measurement.')
+parser.add_argument('--batch_size', default=32, type=int, help='Masks per session run.')
+parser.add_argument('--parallel_calls', nargs='+', default=[1, os.cpu_count() or 1], type=int)
+parser.add_argument('--variants', nargs='+', default=['pil', 'tf', 'bank'])
+parser.add_argument('--bank_size', default=1000, type=int,
+                    help='Precomputed masks of the bank variant.')
+parser.add_argument('--output', default='', type=str,
+                    help='Optional JSON file for the results.')
+
+
+def pil_brush_stroke(height, width):
+    """The PIL generator replaced by random_brush_strokes, for comparison."""
+    from PIL import Image, ImageDraw
+
+    min_num_vertex, max_num_vertex = 4, 12
+    mean_angle, angle_range = 2*math.pi / 5, 2*math.pi / 15
+    min_width, max_width = 12, 40
+    average_radius = math.sqrt(height*height + width*width) / 8
+    mask = Image.new('L', (width, height), 0)
+    for _ in range(np.random.randint(1, 4)):
+        num_vertex = np.random.randint(min_num_vertex, max_num_vertex)
+        angle_min = mean_angle - np.random.uniform(0, angle_range)
+        angle_max = mean_angle + np.random.uniform(0, angle_range)
+        angles = []
+        for i in range(num_vertex):
+            if i % 2 == 0:
+                angles.append(2*math.pi - np.random.uniform(angle_min, angle_max))
+            else:
+                angles.append(np.random.uniform(angle_min, angle_max))
+        vertex = [(int(np.random.randint(0, width)), int(np.random.randint(0, height)))]
+        for i in range(num_vertex):
+            r = np.clip(np.random.normal(loc=average_radius, scale=average_radius//2),
+                        0, 2*average_radius)
+            new_x = np.clip(vertex[-1][0] + r * math.cos(angles[i]), 0, width)
+            new_y = np.clip(vertex[-1][1] + r * math.sin(angles[i]), 0, height)
+            vertex.append((int(new_x), int(new_y)))
+        draw = ImageDraw.Draw(mask)
+        stroke = int(np.random.uniform(min_width, max_width))
+        draw.line(vertex, fill=1, width=stroke)
+        for v in vertex:
+            draw.ellipse((v[0] - stroke//2, v[1] - stroke//2,
+                          v[0] + stroke//2, v[1] + stroke//2), fill=1)
+    return np.asarray(mask, np.float32)[:, :, None]
+
+
+def run_variant(variant, height, width, masks, batch_size, parallel_calls, bank_path,
+                bank_size, queue):
+    import tensorflow as tf
+    from inpaint_ops import bank_brush_strokes, brush_stroke_bank, random_brush_strokes
+
+    if variant == 'bank':
+        bank = brush_stroke_bank(bank_path, bank_size, height, width)
+
+    def generate(_):
+        if variant == 'tf':
+            return random_brush_strokes(height, width)
+        if variant == 'bank':
+            return bank_brush_strokes(bank)
+        mask = tf.py_func(lambda: pil_brush_stroke(height, width), [], tf.float32,
+                          stateful=True)
+        mask.set_shape([height, width, 1])
+        return mask
+
+    batches = max(1, masks // batch_size)
+    dataset = tf.data.Dataset.range((batches + 2) * batch_size).map(
+        generate, num_parallel_calls=parallel_calls).batch(batch_size).prefetch(1)
+    mask = tf.data.make_one_shot_iterator(dataset).get_next()
+    coverage = []
+    with tf.Session() as sess:
+        # warm up the pipeline
+        for _ in range(2):
+            sess.run(mask)
+        t = time.time()
+        for _ in range(batches):
+            coverage.extend(sess.run(mask).mean(axis=(1, 2, 3)).tolist())
+        elapsed = time.time() - t
+    queue.put({'variant': variant, 'parallel_calls': parallel_calls,
+               'masks_per_s': len(coverage) / elapsed,
+               'mean_coverage': float(np.mean(coverage))})
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    height, width = [int(v) for v in args.size.split('x')]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # written by the first bank run, reused by the others
+        bank_path = os.path.join(tmp, 'brush_bank.npy')
+        for variant in args.variants:
+            for parallel_calls in args.parallel_calls:
+                try:
+                    r = run_in_process(run_variant, variant, height, width, args.masks,
+                                       args.batch_size, parallel_calls, bank_path,
+                                       args.bank_size)
+                except RuntimeError as e:
+                    results.append({'variant': variant, 'parallel_calls': parallel_calls,
+                                    'failed': str(e)})
+                    print(f"{variant:4s} parallel_calls={parallel_calls:3d} failed: {e}")
+                    continue
+                results.append(r)
+                print(f"{variant:4s} parallel_calls={parallel_calls:3d} "
+                      f"{r['masks_per_s']:8.1f} masks/s  coverage {r['mean_coverage']:.3f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
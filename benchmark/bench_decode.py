@@ -0,0 +1,115 @@
+"""Benchmark image decoding: PIL open/convert/np.array against
+service.image_decode, at full size and with a reduced-size decode.
+
+A synthetic photo-like image is written once per format. Each variant runs in
+its own process so peak RSS is attributable to it.
+
+    python benchmark/bench_decode.py --size 4000x6000 --formats jpg png webp --max_side 1536
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.isolated import run_in_process
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', default='3000x4000', type=str, help='Image size as HxW.')
+parser.add_argument('--formats', nargs='+', default=['jpg', 'png', 'webp'])
+parser.add_argument('--max_side', default=1536, type=int,
+                    help='Longest side for the reduced decode.')
+parser.add_argument('--runs', default=5, type=int)
+parser.add_argument('--output', default='', type=str,
+                    help='Optional JSON file for the results.')
+
+VARIANTS = ('pil', 'decode', 'reduced')
+
+
+def peak_rss_mb():
+    # VmHWM is reset on exec, unlike ru_maxrss which a spawned process
+    # inherits from the parent that wrote the test images
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def write_image(path, height, width):
+    import cv2
+    rng = np.random.RandomState(0)
+    # smooth gradients plus texture, so that the codecs do realistic work
+    small = rng.randint(0, 256, (height // 32 + 1, width // 32 + 1, 3)).astype(np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    image = cv2.add(image, rng.randint(0, 24, image.shape).astype(np.uint8))
+    cv2.imwrite(path, image)
+
+
+def run_variant(variant, path, max_side, runs, queue):
+    from PIL import Image
+    from service.image_decode import ImageBuffer, decode_image
+
+    buffer = ImageBuffer()
+
+    def decode():
+        if variant == 'pil':
+            image = Image.open(path)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            return np.array(image)
+        return decode_image(path, max_side=max_side if variant == 'reduced' else 0,
+                            buffer=buffer, max_pixels=0)[0]
+
+    rss_before = peak_rss_mb()
+    shape = decode().shape
+    latencies = []
+    for _ in range(runs):
+        t = time.time()
+        decode()
+        latencies.append((time.time() - t) * 1000.)
+    queue.put({
+        'output_size': list(shape[:2]),
+        'mean_latency_ms': float(np.mean(latencies)),
+        'min_latency_ms': float(np.min(latencies)),
+        'peak_rss_mb': peak_rss_mb(),
+        'decode_rss_increase_mb': peak_rss_mb() - rss_before,
+    })
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    height, width = [int(v) for v in args.size.split('x')]
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in args.formats:
+            path = os.path.join(tmp, 'image.' + fmt)
+            write_image(path, height, width)
+            entry = {'format': fmt, 'input_size': [height, width],
+                     'file_mb': os.path.getsize(path) / 2.**20}
+            for variant in VARIANTS:
+                try:
+                    entry[variant] = run_in_process(
+                        run_variant, variant, path, args.max_side, args.runs)
+                except RuntimeError as e:
+                    entry[variant] = {'failed': str(e)}
+            if not any('failed' in entry[variant] for variant in VARIANTS):
+                entry['speedup'] = entry['pil']['mean_latency_ms'] / \
+                    entry['decode']['mean_latency_ms']
+                entry['reduced_speedup'] = entry['pil']['mean_latency_ms'] / \
+                    entry['reduced']['mean_latency_ms']
+            report.append(entry)
+            print(json.dumps(entry, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,411 @@
+"""End-to-end benchmark suite that runs offline.
+
+Without --checkpoint_dir a checkpoint with random weights is generated first
+(see synthetic_checkpoint.py), so no model download is needed. Scenarios:
+
+- main:    `python main.py` per resolution, as a fresh process (cold start
+           including imports, graph build and the single inference)
+- service: WatermarkRemovalService.process_image in one process, cold start
+           and warm latency per resolution
+- batch:   backend.run at increasing batch sizes, and batch_inpaint.py's
+           BatchRunner over a set of mixed-resolution files
+- cost:    peak memory and latency of one backend.run per (resolution, batch),
+           each in a fresh process, fitted by service/cost_model.py. With
+           --calibrate_cost_model the fit is saved for admission control
+
+Every scenario runs in its own process so peak RSS is attributable to it.
+Results are written as JSON; with --baseline the metrics are compared against
+an earlier run and the exit code is 1 when any regressed beyond --tolerance.
+
+    python benchmark/bench_e2e.py --output bench.json
+    python benchmark/bench_e2e.py --output new.json --baseline bench.json
+    python benchmark/bench_e2e.py --scenarios cost --checkpoint_dir model/ \
+        --calibrate_cost_model config/cost_model.json
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmark.isolated import run_in_process
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='', type=str,
+                    help='Leave empty to generate a synthetic checkpoint.')
+parser.add_argument('--scenarios', nargs='+', default=['main', 'service', 'batch'])
+parser.add_argument('--resolutions', nargs='+', default=['256x256', '512x512', '512x768'],
+                    help='Image sizes as HxW.')
+parser.add_argument('--runs', default=5, type=int,
+                    help='Warm runs per measurement.')
+parser.add_argument('--batch_sizes', nargs='+', default=[1, 2, 4], type=int)
+parser.add_argument('--batch_resolution', default='256x256', type=str)
+parser.add_argument('--runner_images', default=16, type=int,
+                    help='Files processed by the BatchRunner scenario.')
+parser.add_argument('--cost_resolutions', nargs='+',
+                    default=['128x128', '256x256', '256x384', '384x384', '384x512',
+                             '512x512', '512x680'],
+                    help='Sizes measured for the cost model, as HxW.')
+parser.add_argument('--cost_batch_sizes', nargs='+', default=[1, 2], type=int,
+                    help='Batch sizes measured at the two smallest cost resolutions.')
+parser.add_argument('--calibrate_cost_model', default='', type=str,
+                    help='Save the fitted cost model to this file.')
+parser.add_argument('--output', default='bench_e2e.json', type=str)
+parser.add_argument('--baseline', default='', type=str,
+                    help='Earlier results to compare against.')
+parser.add_argument('--tolerance', default=0.2, type=float,
+                    help='Relative change that counts as a regression.')
+
+
+def peak_rss_mb():
+    # VmHWM is reset on exec, unlike ru_maxrss which a spawned process
+    # inherits from its parent
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def parse_size(size):
+    height, width = [int(v) for v in size.split('x')]
+    return height, width
+
+
+def latency_stats(latencies):
+    return {
+        'mean_latency_ms': float(np.mean(latencies)),
+        'p50_latency_ms': float(np.percentile(latencies, 50)),
+        'p95_latency_ms': float(np.percentile(latencies, 95)),
+    }
+
+
+def write_image(path, height, width, seed=0):
+    """A smooth random image, so that encoders and decoders do real work."""
+    import cv2
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 256, (height // 16 + 1, width // 16 + 1, 3)).astype(np.uint8)
+    cv2.imwrite(path, cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC))
+
+
+def bench_main(checkpoint_dir, images, tmp):
+    """One `python main.py` process per resolution."""
+    results = []
+    for size, path in images.items():
+        output = os.path.join(tmp, 'main_' + os.path.basename(path))
+        # stderr goes to a file: nothing reads a pipe while waiting below, and
+        # TensorFlow's log output could fill it
+        with tempfile.TemporaryFile() as stderr:
+            t = time.time()
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'main.py'), '--image', path,
+                 '--output', output, '--checkpoint_dir', checkpoint_dir],
+                cwd=ROOT, stdout=subprocess.DEVNULL, stderr=stderr)
+            # wait4 gives the resource usage of this child only
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                else -os.WTERMSIG(status)
+            wall_ms = (time.time() - t) * 1000.
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError('main.py failed: ' + stderr.read().decode()[-2000:])
+        results.append({'resolution': size, 'cold_start_ms': wall_ms,
+                        'peak_rss_mb': usage.ru_maxrss / 1024.})
+    return results
+
+
+def bench_service(checkpoint_dir, images, tmp, runs, queue):
+    t = time.time()
+    os.chdir(ROOT)
+    os.environ['MODEL_PATH'] = checkpoint_dir
+    from service.watermark_service import WatermarkRemovalService
+
+    service = WatermarkRemovalService()
+    import_ms = (time.time() - t) * 1000.
+    output = os.path.join(tmp, 'service.png')
+    report = {'import_and_init_ms': import_ms, 'resolutions': []}
+    for size, path in images.items():
+        t = time.time()
+        if service.process_image(path, output, engine='neural') != 'neural':
+            raise RuntimeError('process_image failed for ' + size)
+        first_ms = (time.time() - t) * 1000.
+        if 'cold_start_ms' not in report:
+            report['cold_start_ms'] = import_ms + first_ms
+        latencies = []
+        for _ in range(runs):
+            t = time.time()
+            service.process_image(path, output, engine='neural')
+            latencies.append((time.time() - t) * 1000.)
+        report['resolutions'].append(dict(
+            resolution=size, first_request_ms=first_ms, **latency_stats(latencies)))
+    report['peak_rss_mb'] = peak_rss_mb()
+    queue.put(report)
+
+
+def bench_batch(checkpoint_dir, batch_sizes, batch_resolution, runner_images,
+                tmp, runs, queue):
+    os.chdir(ROOT)
+    from batch_inpaint import BatchRunner, Manifest
+    from service.inference_backend import create_backend
+    from service.mask_registry import default_registry
+
+    backend = create_backend('tensorflow', checkpoint_dir=checkpoint_dir)
+    height, width = parse_size(batch_resolution)
+    mask = default_registry().get('istock', width, height).mask[None]
+    rng = np.random.RandomState(0)
+    report = {'resolution': batch_resolution, 'batch_sizes': []}
+    for batch_size in batch_sizes:
+        images = rng.randint(0, 256, (batch_size, height, width, 3)).astype(np.uint8)
+        t = time.time()
+        backend.run(images, mask)
+        first_ms = (time.time() - t) * 1000.
+        latencies = []
+        for _ in range(runs):
+            t = time.time()
+            backend.run(images, mask)
+            latencies.append((time.time() - t) * 1000.)
+        stats = latency_stats(latencies)
+        report['batch_sizes'].append(dict(
+            batch_size=batch_size, first_run_ms=first_ms,
+            images_per_s=batch_size * 1000. / stats['mean_latency_ms'], **stats))
+
+    # mixed resolutions through the batch CLI's runner
+    sizes = [(height, width), (height - 24, width - 40), (height, width - 16)]
+    lines = []
+    for i in range(runner_images):
+        h, w = sizes[i % len(sizes)]
+        path = os.path.join(tmp, f'runner_{i}.jpg')
+        write_image(path, h, w, seed=i)
+        lines.append((path, None, os.path.join(tmp, 'runner_out', f'{i}.png')))
+    manifest = Manifest(os.path.join(tmp, 'runner.manifest.jsonl'))
+    runner = BatchRunner(backend, manifest, registry=default_registry(),
+                         batch_size=max(batch_sizes), report_every=1e9)
+    try:
+        report['runner'] = runner.run(lines)
+    finally:
+        manifest.close()
+    report['peak_rss_mb'] = peak_rss_mb()
+    queue.put(report)
+
+
+def cost_sample(checkpoint_dir, height, width, batch, box, runs, queue):
+    """Peak memory and warm latency of one (resolution, batch) in a fresh process."""
+    os.chdir(ROOT)
+    from service.inference_backend import create_backend
+    from service.mask_registry import default_registry
+
+    backend = create_backend('tensorflow', checkpoint_dir=checkpoint_dir)
+    if box:
+        # a centred box, so that mask area varies independently of image size
+        mask = np.zeros((1, height, width, 1), np.uint8)
+        mask[:, height // 3:height * 2 // 3, width // 4:width * 3 // 4] = 255
+    else:
+        mask = default_registry().get('istock', width, height).mask[None]
+    images = np.random.RandomState(0).randint(
+        0, 256, (batch, height, width, 3)).astype(np.uint8)
+    backend.run(images, mask)
+    latencies = []
+    for _ in range(runs):
+        t = time.time()
+        backend.run(images, mask)
+        latencies.append((time.time() - t) * 1000.)
+    queue.put({'height': height, 'width': width, 'batch': batch,
+               'mask_area': int(np.count_nonzero(mask)),
+               'memory_mb': peak_rss_mb(), 'latency_ms': float(np.median(latencies))})
+
+
+def classical_samples(resolutions, runs):
+    """cv2.inpaint latency for a few mask areas per resolution"""
+    import cv2
+    samples = []
+    for size in resolutions:
+        height, width = parse_size(size)
+        image = np.random.RandomState(0).randint(0, 256, (height, width, 3)).astype(np.uint8)
+        for fraction in (0.02, 0.1):
+            mask = np.zeros((height, width), np.uint8)
+            side = int(np.sqrt(fraction * height * width))
+            mask[:side, :min(width, side)] = 1
+            latencies = []
+            for _ in range(runs):
+                t = time.time()
+                cv2.inpaint(image, mask, 3, cv2.INPAINT_TELEA)
+                latencies.append((time.time() - t) * 1000.)
+            samples.append({'height': height, 'width': width, 'batch': 1,
+                            'mask_area': int(mask.sum()),
+                            'latency_ms': float(np.median(latencies))})
+    return samples
+
+
+def bench_cost(checkpoint_dir, resolutions, batch_sizes, runs, calibrate):
+    from service.cost_model import CostModel, save_model
+
+    cases = [(size, 1) for size in resolutions]
+    cases += [(size, batch) for size in resolutions[:2] for batch in batch_sizes if batch > 1]
+    samples = []
+    for i, (size, batch) in enumerate(cases):
+        height, width = parse_size(size)
+        print(f'  {size} batch {batch}')
+        samples.append(run_in_process(cost_sample, checkpoint_dir, height, width,
+                                      batch, i % 2 == 1, runs))
+    classical = classical_samples(resolutions, runs)
+    model = CostModel().fit(samples, 'neural').fit(classical, 'classical',
+                                                   targets=('latency_ms',))
+
+    def fit_error(samples, engine, target):
+        errors = [abs(model.predict(s['height'], s['width'], s['mask_area'], s['batch'],
+                                    engine)._asdict()[target] - s[target]) / s[target]
+                  for s in samples]
+        return float(np.mean(errors))
+
+    if calibrate:
+        save_model(model, {'neural': samples, 'classical': classical}, path=calibrate)
+        print('Cost model written to {}'.format(calibrate))
+    return {
+        'samples': [dict(s, resolution=f"{s['height']}x{s['width']}/batch{s['batch']}")
+                    for s in samples],
+        'memory_fit_error': fit_error(samples, 'neural', 'memory_mb'),
+        'latency_fit_error': fit_error(samples, 'neural', 'latency_ms'),
+        'classical_latency_fit_error': fit_error(classical, 'classical', 'latency_ms'),
+    }
+
+
+def flatten(results, prefix=''):
+    """Metric name -> value, list entries keyed by resolution or batch size."""
+    metrics = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            metrics.update(flatten(value, f'{prefix}{key}/'))
+    elif isinstance(results, list):
+        for entry in results:
+            name = entry.get('resolution') or f"batch{entry.get('batch_size')}"
+            metrics.update(flatten(entry, f'{prefix}{name}/'))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        metrics[prefix.rstrip('/')] = results
+    return metrics
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns:
+        list: (metric, baseline, current, relative change) for regressions
+    """
+    current = flatten(results['scenarios'])
+    previous = flatten(baseline['scenarios'])
+    regressions = []
+    for name, old in sorted(previous.items()):
+        new = current.get(name)
+        if new is None or not old:
+            continue
+        if name.endswith('_ms') or name.endswith('_mb'):
+            change = (new - old) / old
+        elif name.endswith('_per_s'):
+            change = (old - new) / old
+        else:
+            continue
+        print(f"{name:60s} {old:10.2f} -> {new:10.2f} "
+              f"({abs(change):.1%} {'worse' if change > 0 else 'better'})")
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint_dir = args.checkpoint_dir
+        if not checkpoint_dir:
+            from benchmark.synthetic_checkpoint import write_checkpoint
+            checkpoint_dir = os.path.join(tmp, 'model')
+            ctx = multiprocessing.get_context('spawn')
+            process = ctx.Process(target=write_checkpoint, args=(
+                checkpoint_dir, os.path.join(ROOT, 'inpaint.yml')))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError('Writing the synthetic checkpoint failed with exit code {}'
+                                   .format(process.exitcode))
+            results['meta']['checkpoint'] = 'synthetic'
+        else:
+            results['meta']['checkpoint'] = os.path.abspath(checkpoint_dir)
+        checkpoint_dir = os.path.abspath(checkpoint_dir)
+
+        images = {}
+        for size in args.resolutions:
+            height, width = parse_size(size)
+            images[size] = os.path.join(tmp, f'input_{size}.png')
+            write_image(images[size], height, width)
+
+        scenarios = {
+            'main': lambda: bench_main(checkpoint_dir, images, tmp),
+            'service': lambda: run_in_process(
+                bench_service, checkpoint_dir, images, tmp, args.runs),
+            'cost': lambda: bench_cost(
+                checkpoint_dir, args.cost_resolutions, args.cost_batch_sizes,
+                args.runs, args.calibrate_cost_model),
+            'batch': lambda: run_in_process(
+                bench_batch, checkpoint_dir, args.batch_sizes,
+                args.batch_resolution, args.runner_images, tmp, args.runs),
+        }
+        failed = []
+        for name in ('main', 'service', 'cost', 'batch'):
+            if name not in args.scenarios:
+                continue
+            print(name + ' ...')
+            try:
+                results['scenarios'][name] = scenarios[name]()
+            except RuntimeError as e:
+                print('{} failed: {}'.format(name, e))
+                results['scenarios'][name] = {'failed': str(e)}
+                failed.append(name)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['scenarios'], indent=2))
+    print('Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} metrics regressed by more than {:.0%}'.format(
+                len(regressions), args.tolerance))
+            sys.exit(1)
+    if failed:
+        print('Failed scenarios: ' + ', '.join(failed))
+        sys.exit(1)
@@ -0,0 +1,96 @@
+"""Benchmark the fused gated conv blocks against the original ones.
+
+Each variant builds the full serving graph with randomly initialised weights
+in its own process, so peak RSS is attributable to that variant.
+
+    python benchmark/bench_gated_conv.py --height 512 --width 680
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.isolated import run_in_process
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--height', default=512, type=int)
+parser.add_argument('--width', default=680, type=int)
+parser.add_argument('--runs', default=5, type=int)
+parser.add_argument('--output', default='', type=str,
+                    help='Optional JSON file for the results.')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_variant(fused, height, width, runs, queue):
+    import tensorflow as tf
+    import neuralgym as ng
+    from inpaint_model import InpaintCAModel
+
+    FLAGS = ng.Config('inpaint.yml')
+    np.random.seed(0)
+    image = np.random.randint(0, 255, (1, height, width, 3))
+    mask = np.zeros((1, height, width, 3))
+    mask[:, height//4:height*3//4, width//4:width*3//4] = 255
+    input_image = np.concatenate([image, mask], axis=2).astype(np.float32)
+
+    input_ph = tf.placeholder(tf.float32, shape=input_image.shape)
+    output = InpaintCAModel().build_server_graph(
+        FLAGS, input_ph, fused=fused)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        rss_before = peak_rss_mb()
+        feed = {input_ph: input_image}
+        result = sess.run(output, feed_dict=feed)
+        latencies = []
+        for _ in range(runs):
+            t = time.time()
+            sess.run(output, feed_dict=feed)
+            latencies.append((time.time() - t) * 1000.)
+    np.save(os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                         'bench_gated_conv_{}.npy'.format(int(fused))), result)
+    queue.put({
+        'fused': fused,
+        'mean_latency_ms': float(np.mean(latencies)),
+        'min_latency_ms': float(np.min(latencies)),
+        'peak_rss_mb': peak_rss_mb(),
+        'inference_rss_increase_mb': peak_rss_mb() - rss_before,
+    })
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        results = [run_in_process(run_variant, fused, args.height, args.width, args.runs)
+                   for fused in (False, True)]
+    except RuntimeError as e:
+        # without both variants there is nothing to compare
+        sys.exit('Benchmark failed: {}'.format(e))
+    tmp = os.environ.get('TMPDIR', '/tmp')
+    ref = np.load(os.path.join(tmp, 'bench_gated_conv_0.npy'))
+    out = np.load(os.path.join(tmp, 'bench_gated_conv_1.npy'))
+    report = {
+        'height': args.height,
+        'width': args.width,
+        'original': results[0],
+        'fused': results[1],
+        'max_abs_diff': float(np.max(np.abs(ref - out))),
+        'speedup': results[0]['mean_latency_ms'] /
+        results[1]['mean_latency_ms'],
+        'peak_rss_saved_mb': results[0]['peak_rss_mb'] -
+        results[1]['peak_rss_mb'],
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,97 @@
+"""Report where the start-up time of a process goes.
+
+Each module is imported in a fresh interpreter with `-X importtime`. The
+report has the wall time of the import, the self time summed per top-level
+package, and which of the heavy packages (TensorFlow, neuralgym, moviepy)
+were loaded. Only the inference path should load them, so that API processes
+start fast when autoscaling or forking workers.
+
+    python benchmark/bench_import.py --modules app batch_inpaint --budget_s 2
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ('tensorflow', 'neuralgym', 'moviepy')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--modules', nargs='+', default=['app'])
+parser.add_argument('--top', default=10, type=int,
+                    help='Packages listed per module.')
+parser.add_argument('--budget_s', default=0., type=float,
+                    help='Exit with 1 when an import takes longer or loads a '
+                    'heavy package. 0: only report.')
+parser.add_argument('--output', default='', type=str,
+                    help='Optional JSON file for the report.')
+
+# runs in the child; the marker separates the result from anything the
+# module prints while it is imported
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+wall_s = time.perf_counter() - started
+print('@@import_report ' + json.dumps({{
+    'wall_s': wall_s, 'modules': len(sys.modules),
+    'heavy': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+"""
+
+
+def parse_importtime(stderr):
+    """Self time in seconds summed per top-level package."""
+    packages = collections.Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header
+        packages[fields[2].strip().split('.')[0]] += int(fields[0]) / 1e6
+    return packages
+
+
+def import_report(module, top=10, env=None):
+    """Import module in a fresh interpreter from the repository root.
+
+    Returns:
+        dict: module, wall_s, modules (loaded in total), heavy (heavy
+            packages loaded) and packages (the top self times in seconds)
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         CHILD.format(module=module, heavy=HEAVY)],
+        cwd=ROOT, env=dict(os.environ, **(env or {})),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    results = [line for line in proc.stdout.splitlines()
+               if line.startswith('@@import_report ')]
+    if proc.returncode != 0 or not results:
+        raise RuntimeError(f'Importing {module} failed:\n' + proc.stderr[-2000:])
+    report = {'module': module}
+    report.update(json.loads(results[-1].split(' ', 1)[1]))
+    report['packages'] = dict(parse_importtime(proc.stderr).most_common(top))
+    return report
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    reports = []
+    failed = False
+    for module in args.modules:
+        report = import_report(module, args.top)
+        reports.append(report)
+        print(f"{module}: {report['wall_s']:.2f}s, {report['modules']} modules, "
+              f"heavy: {', '.join(report['heavy']) or 'none'}")
+        for package, seconds in report['packages'].items():
+            print(f'  {package:24s} {seconds * 1000:8.1f}ms')
+        if args.budget_s > 0 and (report['wall_s'] > args.budget_s or report['heavy']):
+            print(f'  over the budget of {args.budget_s}s or loads a heavy package')
+            failed = True
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+    sys.exit(1 if failed else 0)
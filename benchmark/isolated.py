@@ -0,0 +1,38 @@
+"""Run a benchmark step in a fresh process, so peak RSS is attributable to it.
+
+The step is called as target(*args, queue) and puts its result on the queue.
+A step that crashes, e.g. killed by the OOM killer, raises instead of
+leaving the benchmark waiting for a result that never comes.
+"""
+import multiprocessing
+import queue as queue_module
+
+# Interval for checking whether the process is still alive, in seconds
+POLL_INTERVAL_S = 1.
+
+
+def run_in_process(target, *args):
+    """
+    Returns:
+        The object the process put on the queue.
+
+    Raises:
+        RuntimeError: The process exited without a result.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=args + (queue,))
+    process.start()
+    while True:
+        # a process that exits after put has flushed the result, so a get
+        # after seeing the exit code still finds it
+        exited = process.exitcode is not None
+        try:
+            result = queue.get(timeout=POLL_INTERVAL_S)
+            break
+        except queue_module.Empty:
+            if exited:
+                raise RuntimeError('{} exited with code {} without a result'.format(
+                    target.__name__, process.exitcode))
+    process.join()
+    return result
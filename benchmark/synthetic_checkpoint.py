@@ -0,0 +1,54 @@
+"""Write a checkpoint with random weights for InpaintCAModel.
+
+The variables have the names and shapes the serving graphs load, so
+benchmarks and tests can run the real network without downloading the
+model. Outputs are meaningless, the cost of computing them is not.
+
+    python benchmark/synthetic_checkpoint.py --output_dir /tmp/synthetic_model
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output_dir', default='synthetic_model/', type=str)
+parser.add_argument('--config', default='inpaint.yml', type=str)
+parser.add_argument('--guided', action='store_true',
+                    help='Write the variables of an edge-guided model.')
+parser.add_argument('--seed', default=0, type=int)
+
+
+def write_checkpoint(output_dir, config_path='inpaint.yml', guided=None, seed=0):
+    """Build the full-quality serving graph once and save its variables,
+    initialised by their regular initialisers.
+
+    Returns:
+        str: The checkpoint prefix that was written.
+    """
+    import tensorflow as tf
+    import neuralgym as ng
+    from inpaint_model import InpaintCAModel
+
+    FLAGS = ng.Config(config_path)
+    if guided is not None:
+        FLAGS['guided'] = guided
+    os.makedirs(output_dir, exist_ok=True)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(seed)
+        images = tf.placeholder(tf.uint8, [1, 64, 64, 3])
+        masks = tf.placeholder(tf.uint8, [1, 64, 64, 1])
+        InpaintCAModel().build_uint8_server_graph(FLAGS, images, masks)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            prefix = tf.train.Saver().save(
+                sess, os.path.join(output_dir, 'snap-0'), write_meta_graph=False)
+    return prefix
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('Checkpoint written to {}'.format(write_checkpoint(
+        args.output_dir, args.config, args.guided or None, args.seed)))
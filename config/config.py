@@ -10,9 +10,62 @@ class Config:
     # 文件上传配置
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or '/tmp/uploads'
     OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER') or '/tmp/outputs'
+    # 解码前按文件头检查的像素上限，超过时返回413，0表示不限制
+    MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS') or 40000000)
+    # 解码时最长边的上限，超过时缩小解码(JPEG直接按1/2~1/8解码)并在缩小后的图像上处理，0表示原尺寸
+    MAX_DECODE_SIDE = int(os.environ.get('MAX_DECODE_SIDE') or 0)
 
-    # 模型配置
+    # 模型配置：也可以指向quantize_model.py压缩的checkpoint，加载时转换回float32
     MODEL_PATH = os.environ.get('MODEL_PATH') or 'model/'
+    # 水印mask目录：<MASK_DIR>/<水印类型>/<变体>/mask.png，检查目录变化的间隔(秒)，0表示不自动重新加载
+    MASK_DIR = os.environ.get('MASK_DIR') or 'utils'
+    MASK_RELOAD_INTERVAL = float(os.environ.get('MASK_RELOAD_INTERVAL') or 2.)
+    # 水印定位：WATERMARK_DETECTION=1时先在缩小到DETECT_SIDE的图像上匹配模板，
+    # 只修复匹配到的位置，分数低于DETECT_THRESHOLD时认为没有水印，直接返回原图
+    WATERMARK_DETECTION = os.environ.get('WATERMARK_DETECTION') or '0'
+    DETECT_SIDE = int(os.environ.get('DETECT_SIDE') or 512)
+    DETECT_THRESHOLD = float(os.environ.get('DETECT_THRESHOLD') or 0.7)
+    # 推理后端：tensorflow 或 onnxruntime（模型由export_onnx.py导出）
+    INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND') or 'tensorflow'
+    ONNX_MODEL_PATH = os.environ.get('ONNX_MODEL_PATH') or 'model/inpaint.onnx'
+    # 1表示边缘引导(guided)模型，边缘图在推理图中从输入图像计算；不设置时使用inpaint.yml中的guided
+    GUIDED_MODEL = os.environ.get('GUIDED_MODEL') or ''
+    # INFERENCE_BACKEND=stub时的模拟推理耗时：固定部分 + 每百万像素部分(毫秒)，用于压测
+    STUB_LATENCY_MS = float(os.environ.get('STUB_LATENCY_MS') or 50)
+    STUB_MS_PER_MEGAPIXEL = float(os.environ.get('STUB_MS_PER_MEGAPIXEL') or 200)
+    # 经典修复(cv2.inpaint)降级路径：telea 或 ns
+    CLASSICAL_INPAINT_METHOD = os.environ.get('CLASSICAL_INPAINT_METHOD') or 'telea'
+    CLASSICAL_INPAINT_RADIUS = int(os.environ.get('CLASSICAL_INPAINT_RADIUS') or 3)
+    # engine=auto时自动使用经典修复的条件：mask占图像面积的比例不超过该值，
+    # 或请求排队时间超过QUEUE_LATENCY_SLO_MS。0表示关闭对应条件
+    CLASSICAL_MAX_MASK_RATIO = float(os.environ.get('CLASSICAL_MAX_MASK_RATIO') or 0.001)
+    QUEUE_LATENCY_SLO_MS = float(os.environ.get('QUEUE_LATENCY_SLO_MS') or 10000)
+    # 准入控制(service/cost_model.py)：按开销模型预测的峰值内存决定直接处理、缩小、分块或拒绝(413)，
+    # MEMORY_BUDGET_MB为0时取容器内存上限的85%；排队任务的预测耗时之和超过ADMISSION_MAX_QUEUE_MS时返回429
+    COST_MODEL_FILE = os.environ.get('COST_MODEL_FILE') or 'config/cost_model.json'
+    MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB') or 0)
+    ADMISSION_MAX_QUEUE_MS = float(os.environ.get('ADMISSION_MAX_QUEUE_MS') or 60000)
+    # 缩小推理的最小比例(相对于MAX_WORKING_SIDE的缩小)，更小时在原分辨率上分块推理，块数超过MAX_TILES时仍然缩小
+    MIN_DOWNSCALE = float(os.environ.get('MIN_DOWNSCALE') or 0.5)
+    MAX_TILES = int(os.environ.get('MAX_TILES') or 16)
+    # 视频每批推理的帧数
+    VIDEO_BATCH_SIZE = int(os.environ.get('VIDEO_BATCH_SIZE') or 4)
+    # 推理调度(service/scheduler.py)：图像和视频通道的权重，两者都有任务时按权重分配推理时间，
+    # 视频每批帧之间让出推理
+    IMAGE_LANE_WEIGHT = float(os.environ.get('IMAGE_LANE_WEIGHT') or 4)
+    VIDEO_LANE_WEIGHT = float(os.environ.get('VIDEO_LANE_WEIGHT') or 1)
+    # 任务期限(秒)：超过时在排队或帧、块、批之间取消，0表示不限制；请求的deadline_s只能缩短期限
+    IMAGE_DEADLINE_S = float(os.environ.get('IMAGE_DEADLINE_S') or 120)
+    VIDEO_DEADLINE_S = float(os.environ.get('VIDEO_DEADLINE_S') or 3600)
+
+    # 高分辨率配置：最长边超过该值时在缩小后的ROI上推理，0表示关闭
+    MAX_WORKING_SIDE = int(os.environ.get('MAX_WORKING_SIDE') or 1536)
+    # 放大结果时叠加原图高频细节的权重，0表示关闭（适用于半透明水印）
+    HIGHRES_DETAIL = float(os.environ.get('HIGHRES_DETAIL') or 0.)
+
+    # CPU线程配置：THREAD_AUTOTUNE=1时在启动时为未调优的主机类型自动调优，force总是重新调优
+    THREAD_AUTOTUNE = os.environ.get('THREAD_AUTOTUNE') or '0'
+    THREAD_TUNING_FILE = os.environ.get('THREAD_TUNING_FILE') or 'config/thread_tuning.json'
 
     # 日志配置
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
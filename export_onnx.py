@@ -0,0 +1,52 @@
+import argparse
+
+import tensorflow as tf
+
+from service.inference_backend import OnnxRuntimeBackend, TensorFlowBackend
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='model/', type=str,
+                    help='The directory of tensorflow checkpoint.')
+parser.add_argument('--output', default='model/inpaint.onnx', type=str,
+                    help='Where to write the ONNX model. The preview model '
+                    'is written next to it with a _preview suffix.')
+parser.add_argument('--height', default=512, type=int,
+                    help='Input height of the exported model, multiple of 8.')
+parser.add_argument('--width', default=680, type=int,
+                    help='Input width of the exported model, multiple of 8.')
+parser.add_argument('--quality', default='all', type=str,
+                    choices=['full', 'preview', 'all'],
+                    help='Which serving graphs to export.')
+parser.add_argument('--opset', default=13, type=int,
+                    help='ONNX opset version.')
+
+
+def export(backend, quality, height, width, output_path, opset):
+    """Freeze the serving graph of one quality and convert it to ONNX."""
+    import tf2onnx
+
+    sess, _, _, _ = backend.session_for(1, height, width, quality)
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), ['output'])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+    tf2onnx.convert.from_graph_def(
+        graph_def, input_names=['image:0', 'mask:0'],
+        output_names=['output:0'],
+        opset=opset, output_path=output_path)
+    print('{} model saved to {}'.format(quality, output_path))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    assert args.height % 8 == 0 and args.width % 8 == 0, \
+        'height and width must be multiples of 8'
+
+    backend = TensorFlowBackend(checkpoint_dir=args.checkpoint_dir)
+    backend.load()
+    qualities = ['full', 'preview'] if args.quality == 'all' \
+        else [args.quality]
+    for quality in qualities:
+        path = args.output if quality == 'full' \
+            else OnnxRuntimeBackend.preview_path(args.output)
+        export(backend, quality, args.height, args.width, path, args.opset)
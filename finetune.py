@@ -0,0 +1,361 @@
+"""Fine-tune the inpainting model on a new image set.
+
+Training images are listed one per line in the first data_flist file of the
+dataset in inpaint.yml (or --dataset). A tf.data pipeline decodes them in
+parallel map calls, resizes them to img_shapes (or crops them at random when
+random_crop is set), optionally caches them in memory or on disk, shuffles,
+flips, batches and prefetches. Unreadable files are skipped.
+
+Masks are the random boxes and brush strokes of build_graph_with_losses by
+default. With --watermark_prob above 0 they are generated in the pipeline
+instead: that fraction of batches is masked with a watermark template from
+the mask registry, rescaled and shifted at random, the others with
+random_brush_strokes. --brush_bank takes the strokes from a memory-mapped
+bank of precomputed ones, flipped and shifted at random, instead of drawing
+them; the masks then come from the pipeline even without --watermark_prob,
+as brush strokes only.
+
+Each batch is moved from the pipeline into variables before the
+discriminator and generator updates run on it, so the time spent waiting for
+input is measured on its own. Images/s and the input stall time
+are printed every --log_every steps and written to TensorBoard.
+
+    python finetune.py --checkpoint_dir model/ --dataset watermarks \
+        --log_dir logs/finetune --watermark_prob 0.5 --cache /tmp/watermarks.cache
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import neuralgym as ng
+import tensorflow as tf
+
+from config.config import Config
+from inpaint_model import InpaintCAModel
+from inpaint_ops import bank_brush_strokes, brush_stroke_bank, edge_guidance
+from inpaint_ops import random_brush_strokes
+from service.mask_registry import MaskRegistry
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='inpaint.yml', type=str)
+parser.add_argument('--dataset', default='', type=str,
+                    help='The data_flist entry to train on. Default: dataset in the config.')
+parser.add_argument('--checkpoint_dir', default='model/', type=str,
+                    help='The pretrained checkpoint to start from.')
+parser.add_argument('--log_dir', default='', type=str,
+                    help='Checkpoints and summaries. Default: log_dir in the config. '
+                    'Training resumes from a checkpoint found here.')
+parser.add_argument('--max_iters', default=10000, type=int)
+parser.add_argument('--lr', default=1e-4, type=float)
+parser.add_argument('--watermark_prob', default=0., type=float,
+                    help='Fraction of batches masked with a watermark template. '
+                    '0 keeps the random boxes and strokes of the model.')
+parser.add_argument('--watermark_types', nargs='*', default=[],
+                    help='Watermark types to use. Default: all registered types.')
+parser.add_argument('--brush_bank', default='', type=str,
+                    help='A .npy file of precomputed brush stroke masks, written '
+                    'with --brush_bank_size masks when missing. Strokes are then '
+                    'taken from it, flipped and shifted, instead of drawn per mask.')
+parser.add_argument('--brush_bank_size', default=4000, type=int)
+parser.add_argument('--mask_dir', default='', type=str,
+                    help='Mask registry directory. Default: MASK_DIR.')
+parser.add_argument('--cache', default='', type=str,
+                    help='"memory", or a file prefix to cache decoded images on '
+                    'disk. Delete the cache files when the flist changes.')
+parser.add_argument('--parallel_calls', default=0, type=int,
+                    help='Parallel decode calls. 0: autotune.')
+parser.add_argument('--shuffle_buffer', default=1000, type=int,
+                    help='Shuffle buffer after the cache.')
+parser.add_argument('--prefetch', default=2, type=int, help='Batches prefetched.')
+parser.add_argument('--log_every', default=100, type=int)
+parser.add_argument('--summary_every', default=500, type=int)
+parser.add_argument('--save_every', default=2000, type=int)
+parser.add_argument('--input_only', action='store_true',
+                    help='Only run the input pipeline for --max_iters batches, '
+                    'to measure its throughput.')
+
+
+def read_flist(path):
+    """Image paths, the first column of each non-empty line."""
+    with open(path) as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def decode(path):
+    image = tf.image.decode_image(tf.io.read_file(path), channels=3,
+                                  expand_animations=False)
+    image.set_shape([None, None, 3])
+    return image
+
+
+def fit_image(image, img_shape, random_crop=False):
+    """Resize a uint8 image to img_shape, or crop it at random after scaling
+    it up to cover img_shape if needed.
+
+    Returns:
+        tf.Tensor: uint8 [h, w, 3]
+    """
+    height, width = img_shape[:2]
+    image = tf.cast(image, tf.float32)
+    if random_crop:
+        shape = tf.cast(tf.shape(image)[:2], tf.float32)
+        scale = tf.maximum(1., tf.reduce_max(tf.constant([height, width], tf.float32) / shape))
+        image = tf.image.resize_images(image, tf.cast(tf.ceil(shape * scale), tf.int32))
+        image = tf.image.random_crop(image, [height, width, 3])
+    else:
+        image = tf.image.resize_images(image, [height, width])
+    return tf.saturate_cast(tf.round(image), tf.uint8)
+
+
+def image_dataset(paths, img_shape, batch_size, random_crop=False, cache='',
+                  parallel_calls=0, shuffle_buffer=1000):
+    """Endless dataset of float32 [batch_size, h, w, 3] batches in [0, 255].
+
+    Decoded images are cached before the random crop, so with random_crop
+    the cache holds them at full size.
+    """
+    parallel_calls = parallel_calls or tf.data.experimental.AUTOTUNE
+    dataset = tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths))
+    dataset = dataset.map(decode, parallel_calls)
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    if not random_crop:
+        dataset = dataset.map(lambda image: fit_image(image, img_shape), parallel_calls)
+    if cache:
+        # later epochs replay the cache in the order of the first one
+        dataset = dataset.cache('' if cache == 'memory' else cache)
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.repeat()
+
+    def augment(image):
+        if random_crop:
+            image = fit_image(image, img_shape, random_crop=True)
+        return tf.image.random_flip_left_right(tf.cast(image, tf.float32))
+    dataset = dataset.map(augment, parallel_calls)
+    return dataset.batch(batch_size, drop_remainder=True)
+
+
+def watermark_mask_bank(registry, watermark_types, height, width):
+    """Every variant of the watermark types resized to height x width.
+
+    Returns:
+        np.ndarray: float32 [n, h, w, 1] in {0, 1}
+    """
+    masks = []
+    for watermark_type in watermark_types or registry.types():
+        for template in registry.templates(watermark_type):
+            mask = cv2.resize(template.mask, (width, height),
+                              interpolation=cv2.INTER_LINEAR)
+            masks.append(mask > 127)
+    if not masks:
+        raise ValueError(f'No watermark masks in {registry.root}')
+    return np.stack(masks)[:, :, :, None].astype(np.float32)
+
+
+def augment_mask(mask, scale_range=(0.75, 1.25), max_shift=0.125):
+    """Rescale a [h, w, 1] mask about its centre and shift it at random by
+    up to max_shift of its size."""
+    height, width = mask.shape.as_list()[:2]
+    scale = tf.random_uniform([], *scale_range)
+    size = tf.cast(tf.round(tf.constant([height, width], tf.float32) * scale), tf.int32)
+    mask = tf.image.resize_images(mask, size)
+    mask = tf.image.resize_image_with_crop_or_pad(mask, height, width)
+    dy, dx = int(height * max_shift), int(width * max_shift)
+    mask = tf.image.pad_to_bounding_box(mask, dy, dx, height + 2*dy, width + 2*dx)
+    mask = tf.image.random_crop(mask, [height, width, 1])
+    return tf.cast(mask > 0.5, tf.float32)
+
+
+def mask_dataset(img_shape, bank=None, watermark_prob=1., parallel_calls=0,
+                 brush_bank=None):
+    """Endless dataset of float32 [1, h, w, 1] masks, one per batch: an
+    augmented mask from bank with probability watermark_prob, brush strokes
+    otherwise. The strokes are taken from brush_bank (see
+    brush_stroke_bank) when it is given, drawn per mask otherwise."""
+    height, width = img_shape[:2]
+    parallel_calls = parallel_calls or tf.data.experimental.AUTOTUNE
+    if bank is None:
+        watermark_prob = 0.
+    else:
+        bank = tf.constant(bank, tf.float32)
+
+    def watermark():
+        index = tf.random_uniform([], 0, tf.shape(bank)[0], tf.int32)
+        return augment_mask(bank[index])
+
+    def strokes():
+        if brush_bank is not None:
+            return bank_brush_strokes(brush_bank)
+        return random_brush_strokes(height, width)
+
+    def generate(_):
+        if watermark_prob >= 1.:
+            mask = watermark()
+        elif watermark_prob <= 0.:
+            mask = strokes()
+        else:
+            mask = tf.cond(tf.random_uniform([]) < watermark_prob, watermark, strokes)
+        return mask[None]
+    return tf.data.Dataset.from_tensors(0).repeat().map(generate, parallel_calls)
+
+
+def restore(sess, checkpoint_dir, var_list):
+    """Restore the variables of var_list stored in checkpoint_dir with the
+    same shape and dtype; optimizer slots and, for released checkpoints, the
+    discriminator keep their initial values.
+
+    Returns:
+        list: names of the restored variables
+    """
+    path = tf.train.latest_checkpoint(checkpoint_dir) or checkpoint_dir
+    reader = tf.train.NewCheckpointReader(path)
+    shapes = reader.get_variable_to_shape_map()
+    dtypes = reader.get_variable_to_dtype_map()
+    found = {v.op.name: v for v in var_list
+             if shapes.get(v.op.name) == v.shape.as_list()
+             and dtypes.get(v.op.name) == v.dtype.base_dtype}
+    if found:
+        tf.train.Saver(found).restore(sess, path)
+    return sorted(found)
+
+
+class StepTimer:
+    """Splits wall time into waiting for input and compute, per report."""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.steps = 0
+        self.stall = 0.
+
+    def step(self, stall):
+        self.steps += 1
+        self.stall += stall
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        report = {
+            'images_per_s': self.steps * self.batch_size / elapsed,
+            'stall_ms': 1000. * self.stall / max(self.steps, 1),
+            'stall_fraction': self.stall / elapsed,
+        }
+        self.reset()
+        return report
+
+
+def report_summary(report):
+    return tf.Summary(value=[tf.Summary.Value(tag='input/' + k, simple_value=v)
+                             for k, v in report.items()])
+
+
+def finetune(args, FLAGS):
+    dataset_name = args.dataset or FLAGS.dataset
+    paths = read_flist(FLAGS.data_flist[dataset_name][0])
+    img_shape, batch_size = FLAGS.img_shapes, FLAGS.batch_size
+    log_dir = args.log_dir or FLAGS.log_dir
+    print(f'{len(paths)} training images in {dataset_name}.')
+
+    dataset = image_dataset(paths, img_shape, batch_size, FLAGS.random_crop,
+                            args.cache, args.parallel_calls, args.shuffle_buffer)
+    bank = brush_bank = None
+    if args.watermark_prob > 0:
+        registry = MaskRegistry(args.mask_dir or Config.MASK_DIR, reload_interval=0)
+        bank = watermark_mask_bank(registry, args.watermark_types, *img_shape[:2])
+        print(f'{len(bank)} watermark masks.')
+    if args.brush_bank:
+        brush_bank = brush_stroke_bank(args.brush_bank, args.brush_bank_size,
+                                       *img_shape[:2])
+        print(f'{len(brush_bank)} brush stroke masks in {args.brush_bank}.')
+    if bank is not None or brush_bank is not None:
+        dataset = tf.data.Dataset.zip((dataset, mask_dataset(
+            img_shape, bank, args.watermark_prob, args.parallel_calls, brush_bank)))
+    dataset = dataset.prefetch(args.prefetch)
+    next_batch = tf.data.make_one_shot_iterator(dataset).get_next()
+    if not isinstance(next_batch, tuple):
+        next_batch = (next_batch,)
+
+    # the training graph reads each batch from variables, so waiting for
+    # the pipeline and computing are separate session runs
+    inputs = [tf.Variable(tf.zeros(t.shape, t.dtype), trainable=False,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+              for t, name in zip(next_batch, ['input_images', 'input_mask'])]
+    load = tf.group(*[v.assign(t) for v, t in zip(inputs, next_batch)])
+    images = inputs[0]
+    mask = inputs[1] if len(inputs) > 1 else None
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    writer = tf.summary.FileWriter(log_dir)
+    timer = StepTimer(batch_size)
+    if args.input_only:
+        with tf.Session(config=config) as sess:
+            sess.run(tf.local_variables_initializer())
+            for step in range(1, args.max_iters + 1):
+                t = time.time()
+                sess.run(load)
+                timer.step(time.time() - t)
+                if step % args.log_every == 0:
+                    report = timer.report()
+                    writer.add_summary(report_summary(report), step)
+                    print(f"step {step}: {report['images_per_s']:.1f} images/s")
+        return
+
+    batch_data = (images, edge_guidance(images, FLAGS.edge_threshold) * 255.) \
+        if FLAGS.guided else images
+    model = InpaintCAModel()
+    g_vars, d_vars, losses = model.build_graph_with_losses(
+        FLAGS, batch_data, training=True, summary=True, mask=mask)
+    global_step = tf.train.get_or_create_global_step()
+    d_train = tf.train.AdamOptimizer(args.lr, beta1=0.5, beta2=0.999).minimize(
+        losses['d_loss'], var_list=d_vars)
+    g_train = tf.train.AdamOptimizer(args.lr, beta1=0.5, beta2=0.999).minimize(
+        losses['g_loss'], var_list=g_vars, global_step=global_step)
+    summaries = tf.summary.merge_all()
+    saver = tf.train.Saver(max_to_keep=5)
+
+    with tf.Session(config=config) as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        if tf.train.latest_checkpoint(log_dir):
+            saver.restore(sess, tf.train.latest_checkpoint(log_dir))
+            print(f'Resumed from {log_dir}.')
+        else:
+            restored = restore(sess, args.checkpoint_dir, g_vars + d_vars)
+            print(f'Restored {len(restored)} of {len(g_vars) + len(d_vars)} '
+                  f'variables from {args.checkpoint_dir}.')
+        step = sess.run(global_step)
+        t = time.time()
+        sess.run(load)
+        print(f'First batch after {time.time() - t:.1f}s.')
+        timer.reset()
+        while step < args.max_iters:
+            sess.run(d_train)
+            fetches = {'step': g_train, 'losses': losses}
+            if summaries is not None and (step + 1) % args.summary_every == 0:
+                fetches['summary'] = summaries
+            out = sess.run(fetches)
+            step += 1
+            # the batch for the next step
+            t = time.time()
+            sess.run(load)
+            timer.step(time.time() - t)
+            if 'summary' in out:
+                writer.add_summary(out['summary'], step)
+            if step % args.log_every == 0:
+                report = timer.report()
+                writer.add_summary(report_summary(report), step)
+                print(f"step {step}: g_loss {out['losses']['g_loss']:.4f} "
+                      f"d_loss {out['losses']['d_loss']:.4f}, "
+                      f"{report['images_per_s']:.1f} images/s, input stall "
+                      f"{report['stall_ms']:.1f}ms/step ({report['stall_fraction']:.0%})")
+            if step % args.save_every == 0 or step >= args.max_iters:
+                saver.save(sess, os.path.join(log_dir, 'snap'), global_step=step)
+    writer.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    finetune(args, ng.Config(args.config))
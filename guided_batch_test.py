@@ -1,13 +1,11 @@
 import time
-import os
 import argparse
 
 import cv2
 import numpy as np
-import tensorflow as tf
 import neuralgym as ng
 
-from inpaint_model import InpaintCAModel
+from service.inference_backend import create_backend
 
 
 parser = argparse.ArgumentParser()
@@ -25,6 +23,23 @@ parser.add_argument(
 parser.add_argument(
     '--checkpoint_dir', default='', type=str,
     help='The directory of tensorflow checkpoint.')
+parser.add_argument(
+    '--batch_size', default=1, type=int,
+    help='Images per inference call. Edge maps are computed in the graph, '
+    'no _edge.jpg files are needed.')
+
+
+def load(line, width, height):
+    image, mask, out = line.split()
+    # RGB like the service and batch_inpaint.py: the edge guidance is computed
+    # from the first channel, which has to be red for the same checkpoint
+    image = cv2.cvtColor(cv2.resize(cv2.imread(image), (width, height)),
+                         cv2.COLOR_BGR2RGB)
+    mask = cv2.resize(cv2.imread(mask), (width, height))
+    grid = 8
+    image = image[:height//grid*grid, :width//grid*grid, :]
+    mask = mask[:height//grid*grid, :width//grid*grid, 0:1]
+    return image, mask, out
 
 
 if __name__ == "__main__":
@@ -32,64 +47,24 @@ if __name__ == "__main__":
     # os.environ['CUDA_VISIBLE_DEVICES'] =''
     args = parser.parse_args()
 
-    sess_config = tf.ConfigProto()
-    sess_config.gpu_options.allow_growth = True
-    sess = tf.Session(config=sess_config)
-
-    model = InpaintCAModel()
-    input_image_ph = tf.placeholder(
-        tf.float32, shape=(1, args.image_height, args.image_width*3, 3))
-    output = model.build_server_graph(input_image_ph)
-    output = (output + 1.) * 127.5
-    output = tf.reverse(output, [-1])
-    output = tf.saturate_cast(output, tf.uint8)
-    vars_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-    assign_ops = []
-    for var in vars_list:
-        vname = var.name
-        from_name = vname
-        var_value = tf.contrib.framework.load_variable(
-            args.checkpoint_dir, from_name)
-        assign_ops.append(tf.assign(var, var_value))
-    sess.run(assign_ops)
+    backend = create_backend('tensorflow', checkpoint_dir=args.checkpoint_dir,
+                             guided=True)
     print('Model loaded.')
 
     with open(args.flist, 'r') as f:
         lines = f.read().splitlines()
     t = time.time()
-    for line in lines:
-    # for i in range(100):
-        image, mask, out = line.split()
-        base = os.path.basename(mask)
-
-        guidance = cv2.imread(image[:-4] + '_edge.jpg')
-        image = cv2.imread(image)
-        mask = cv2.imread(mask)
-        image = cv2.resize(image, (args.image_width, args.image_height))
-        guidance = cv2.resize(guidance, (args.image_width, args.image_height))
-        mask = cv2.resize(mask, (args.image_width, args.image_height))
-        # cv2.imwrite(out, image*(1-mask/255.) + mask)
-        # # continue
-        # image = np.zeros((128, 256, 3))
-        # mask = np.zeros((128, 256, 3))
-
-        assert image.shape == mask.shape
-
-        h, w, _ = image.shape
-        grid = 4
-        image = image[:h//grid*grid, :w//grid*grid, :]
-        mask = mask[:h//grid*grid, :w//grid*grid, :]
-        guidance = guidance[:h//grid*grid, :w//grid*grid, :]
-        print('Shape of image: {}'.format(image.shape))
-
-        image = np.expand_dims(image, 0)
-        guidance = np.expand_dims(guidance, 0)
-        mask = np.expand_dims(mask, 0)
-        input_image = np.concatenate([image, guidance, mask], axis=2)
+    for i in range(0, len(lines), args.batch_size):
+        batch = [load(line, args.image_width, args.image_height)
+                 for line in lines[i:i + args.batch_size]]
+        images = np.stack([image for image, _, _ in batch])
+        masks = np.stack([mask for _, mask, _ in batch])
+        print('Shape of images: {}'.format(images.shape))
 
-        # load pretrained model
-        result = sess.run(output, feed_dict={input_image_ph: input_image})
-        print('Processed: {}'.format(out))
-        cv2.imwrite(out, result[0][:, :, ::-1])
+        # images are RGB, results come back as BGR for cv2.imwrite
+        results = backend.run(images, masks, bgr=True)
+        for result, (_, _, out) in zip(results, batch):
+            print('Processed: {}'.format(out))
+            cv2.imwrite(out, result)
 
     print('Time total: {}'.format(time.time() - t))
@@ -16,22 +16,30 @@ from neuralgym.ops.gan_ops import random_interpolates
 from inpaint_ops import gen_conv, gen_deconv, dis_conv
 from inpaint_ops import random_bbox, bbox2mask, local_patch, brush_stroke_mask
 from inpaint_ops import resize_mask_like, contextual_attention
+from inpaint_ops import edge_guidance
 
 
 logger = logging.getLogger()
 
+# 'full' runs both stages, 'preview' serves the coarse stage-1 result only.
+QUALITY_LEVELS = ('full', 'preview')
+
 
 class InpaintCAModel(Model):
     def __init__(self):
         super().__init__('InpaintCAModel')
 
     def build_inpaint_net(self, x, mask, reuse=False,
-                          training=True, padding='SAME', name='inpaint_net'):
+                          training=True, padding='SAME', name='inpaint_net',
+                          stage1_only=False, fused=False):
         """Inpaint network.
 
         Args:
             x: incomplete image, [-1, 1]
             mask: mask region {0, 1}
+            stage1_only: Stop after the coarse network, skipping the
+                refinement stage. x_stage2 and offset_flow are None.
+            fused: Use the inference-optimised gated conv/deconv blocks.
         Returns:
             [-1, 1] as predicted image
         """
@@ -44,7 +52,7 @@ class InpaintCAModel(Model):
         cnum = 48
         with tf.variable_scope(name, reuse=reuse), \
                 arg_scope([gen_conv, gen_deconv],
-                          training=training, padding=padding):
+                          training=training, padding=padding, fused=fused):
             # stage1
             x = gen_conv(x, cnum, 5, 1, name='conv1')
             x = gen_conv(x, 2*cnum, 3, 2, name='conv2_downsample')
@@ -66,6 +74,8 @@ class InpaintCAModel(Model):
             x = gen_conv(x, 3, 3, 1, activation=None, name='conv17')
             x = tf.nn.tanh(x)
             x_stage1 = x
+            if stage1_only:
+                return x_stage1, None, offset_flow
 
             # stage2, paste result as input
             x = x*mask + xin[:, :, :, 0:3]*(1.-mask)
@@ -130,23 +140,34 @@ class InpaintCAModel(Model):
 
     def build_graph_with_losses(
             self, FLAGS, batch_data, training=True, summary=False,
-            reuse=False):
+            reuse=False, mask=None):
+        """Training graph.
+
+        Args:
+            batch_data: [0, 255] images, or (images, edges) if FLAGS.guided
+            mask: Optional float mask [1, h, w, 1] shared by the batch, 1
+                represents masked point. A random box and brush strokes are
+                generated when None.
+        Returns:
+            g_vars, d_vars, losses
+        """
         if FLAGS.guided:
             batch_data, edge = batch_data
             edge = edge[:, :, :, 0:1] / 255.
             edge = tf.cast(edge > FLAGS.edge_threshold, tf.float32)
         batch_pos = batch_data / 127.5 - 1.
-        # generate mask, 1 represents masked point
-        bbox = random_bbox(FLAGS)
-        regular_mask = bbox2mask(FLAGS, bbox, name='mask_c')
-        irregular_mask = brush_stroke_mask(FLAGS, name='mask_c')
-        mask = tf.cast(
-            tf.logical_or(
-                tf.cast(irregular_mask, tf.bool),
-                tf.cast(regular_mask, tf.bool),
-            ),
-            tf.float32
-        )
+        if mask is None:
+            # generate mask, 1 represents masked point
+            bbox = random_bbox(FLAGS)
+            regular_mask = bbox2mask(FLAGS, bbox, name='mask_c')
+            irregular_mask = brush_stroke_mask(FLAGS, name='mask_c')
+            mask = tf.cast(
+                tf.logical_or(
+                    tf.cast(irregular_mask, tf.bool),
+                    tf.cast(regular_mask, tf.bool),
+                ),
+                tf.float32
+            )
 
         batch_incomplete = batch_pos*(1.-mask)
         if FLAGS.guided:
@@ -269,9 +290,18 @@ class InpaintCAModel(Model):
         return self.build_infer_graph(FLAGS, batch_data, bbox, name)
 
 
-    def build_server_graph(self, FLAGS, batch_data, reuse=False, is_training=False):
-        """
+    def build_server_graph(self, FLAGS, batch_data, reuse=False,
+                           is_training=False, quality='full', fused=True):
+        """Build the serving graph.
+
+        Args:
+            quality: 'full' runs both stages, 'preview' ends at the coarse
+                stage-1 output for fast interactive results.
+            fused: Use the inference-optimised gated conv blocks, which
+                produce the same output with fewer intermediate tensors.
         """
+        if quality not in QUALITY_LEVELS:
+            raise ValueError('Unknown quality: {}'.format(quality))
         # generate mask, 1 represents masked point
         if FLAGS.guided:
             batch_raw, edge, masks_raw = tf.split(batch_data, 3, axis=2)
@@ -279,19 +309,84 @@ class InpaintCAModel(Model):
             edge = tf.cast(edge > FLAGS.edge_threshold, tf.float32)
         else:
             batch_raw, masks_raw = tf.split(batch_data, 2, axis=2)
+            edge = None
         masks = tf.cast(masks_raw[0:1, :, :, 0:1] > 127.5, tf.float32)
+        return self._complete(FLAGS, batch_raw, masks, edge, reuse=reuse,
+                              is_training=is_training, quality=quality,
+                              fused=fused)
+
+    def build_uint8_server_graph(self, FLAGS, images, masks, edges=None,
+                                 reuse=False, quality='full', fused=True,
+                                 reverse_channels=False, attention=False):
+        """Build the serving graph on uint8 inputs.
+
+        Same network as build_server_graph, but image and mask are separate
+        inputs, so the feed is a quarter of the float32 side-by-side layout
+        and the output is ready to be written without conversion.
+
+        Args:
+            images: uint8 images [b, h, w, 3].
+            masks: uint8 mask [1, h, w, 1] shared by the batch, >127 is
+                masked.
+            edges: uint8 edge maps [b, h, w, 1] for guided models. When
+                None they are computed in the graph from the images.
+            reverse_channels: Reverse the channel order of the output, e.g.
+                RGB input to BGR output for cv2.imwrite.
+            attention: Also return the contextual attention flow image,
+                only available at quality 'full'.
 
+        Returns:
+            tf.Tensor: uint8 [b, h, w, 3], or (output, flow image) with
+                attention, both uint8 [b, h, w, 3]
+        """
+        if quality not in QUALITY_LEVELS:
+            raise ValueError('Unknown quality: {}'.format(quality))
+        if attention and quality != 'full':
+            raise ValueError('No attention at quality {}'.format(quality))
+        masks = tf.cast(masks[0:1] > 127, tf.float32)
+        if not FLAGS.guided:
+            edges = None
+        elif edges is None:
+            edges = edge_guidance(images, FLAGS.edge_threshold)
+        else:
+            edges = tf.cast(edges, tf.float32) / 255.
+            edges = tf.cast(edges > FLAGS.edge_threshold, tf.float32)
+        batch_complete, flow = self._complete(
+            FLAGS, tf.cast(images, tf.float32), masks, edges, reuse=reuse,
+            quality=quality, fused=fused, return_flow=True)
+        output = tf.saturate_cast((batch_complete + 1.) * 127.5, tf.uint8)
+        if reverse_channels:
+            output = tf.reverse(output, axis=[3])
+        if not attention:
+            return output
+        # the flow is at the resolution of the attention layer
+        flow = tf.image.resize_nearest_neighbor(flow, tf.shape(images)[1:3])
+        flow = tf.saturate_cast((flow + 1.) * 127.5, tf.uint8)
+        if reverse_channels:
+            flow = tf.reverse(flow, axis=[3])
+        return output, flow
+
+    def _complete(self, FLAGS, batch_raw, masks, edge=None, reuse=False,
+                  is_training=False, quality='full', fused=True,
+                  return_flow=False):
+        """Inpaint batch_raw ([0, 255] float) inside masks and composite,
+        returns the result in [-1, 1], and the attention flow image (None at
+        quality 'preview') with return_flow.
+        """
         batch_pos = batch_raw / 127.5 - 1.
         batch_incomplete = batch_pos * (1. - masks)
-        if FLAGS.guided:
+        if edge is not None:
             edge = edge * masks[:, :, :, 0:1]
             xin = tf.concat([batch_incomplete, edge], axis=3)
         else:
             xin = batch_incomplete
         # inpaint
         x1, x2, flow = self.build_inpaint_net(
-            xin, masks, reuse=reuse, training=is_training)
-        batch_predict = x2
+            xin, masks, reuse=reuse, training=is_training,
+            stage1_only=(quality == 'preview'), fused=fused)
+        batch_predict = x1 if quality == 'preview' else x2
         # apply mask and reconstruct
         batch_complete = batch_predict*masks + batch_incomplete*(1-masks)
+        if return_flow:
+            return batch_complete, flow
         return batch_complete
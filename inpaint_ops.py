@@ -1,11 +1,11 @@
 import logging
 import math
+import os
 
 import cv2
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.framework.python.ops import add_arg_scope
-from PIL import Image, ImageDraw
 
 from neuralgym.ops.layers import resize
 from neuralgym.ops.layers import *
@@ -20,7 +20,8 @@ np.random.seed(2018)
 
 @add_arg_scope
 def gen_conv(x, cnum, ksize, stride=1, rate=1, name='conv',
-             padding='SAME', activation=tf.nn.elu, training=True):
+             padding='SAME', activation=tf.nn.elu, training=True,
+             fused=False):
     """Define conv for generator.
 
     Args:
@@ -33,6 +34,7 @@ def gen_conv(x, cnum, ksize, stride=1, rate=1, name='conv',
         padding: Default to SYMMETRIC.
         activation: Activation function after convolution.
         training: If current graph is for training or inference, used for bn.
+        fused: Use the inference-optimised gated conv, see gen_conv_fused.
 
     Returns:
         tf.Tensor: output
@@ -43,6 +45,10 @@ def gen_conv(x, cnum, ksize, stride=1, rate=1, name='conv',
         p = int(rate*(ksize-1)/2)
         x = tf.pad(x, [[0,0], [p, p], [p, p], [0,0]], mode=padding)
         padding = 'VALID'
+    if fused and not (cnum == 3 or activation is None):
+        return gen_conv_fused(
+            x, cnum, ksize, stride, rate, name=name, padding=padding,
+            activation=activation)
     x = tf.layers.conv2d(
         x, cnum, ksize, stride, dilation_rate=rate,
         activation=None, padding=padding, name=name)
@@ -57,7 +63,8 @@ def gen_conv(x, cnum, ksize, stride=1, rate=1, name='conv',
 
 
 @add_arg_scope
-def gen_deconv(x, cnum, name='upsample', padding='SAME', training=True):
+def gen_deconv(x, cnum, name='upsample', padding='SAME', training=True,
+               fused=False):
     """Define deconv for generator.
     The deconv is defined to be a x2 resize_nearest_neighbor operation with
     additional gen_conv operation.
@@ -67,19 +74,123 @@ def gen_deconv(x, cnum, name='upsample', padding='SAME', training=True):
         cnum: Channel number.
         name: Name of layers.
         training: If current graph is for training or inference, used for bn.
+        fused: Use the inference-optimised upsample-plus-conv, see
+            gen_deconv_fused. Only available for SAME padding.
 
     Returns:
         tf.Tensor: output
 
     """
+    if fused and padding == 'SAME':
+        return gen_deconv_fused(x, cnum, name=name)
     with tf.variable_scope(name):
         x = resize(x, func=tf.image.resize_nearest_neighbor)
         x = gen_conv(
             x, cnum, 3, 1, name=name+'_conv', padding=padding,
-            training=training)
+            training=training, fused=fused)
     return x
 
 
+def _gated_conv_variables(x, cnum, ksize, name):
+    """Create or reuse the kernel and bias of a gen_conv layer.
+
+    Variable names and initializers match tf.layers.conv2d, so fused and
+    unfused graphs load the same checkpoint.
+    """
+    in_channels = x.get_shape().as_list()[-1]
+    with tf.variable_scope(name):
+        kernel = tf.get_variable(
+            'kernel', [ksize, ksize, in_channels, cnum],
+            initializer=tf.glorot_uniform_initializer())
+        bias = tf.get_variable(
+            'bias', [cnum], initializer=tf.zeros_initializer())
+    return kernel, bias
+
+
+def gen_conv_fused(x, cnum, ksize, stride=1, rate=1, name='conv',
+                   padding='SAME', activation=tf.nn.elu):
+    """Inference-optimised gated conv, numerically equivalent to gen_conv.
+
+    Instead of one conv with cnum outputs followed by tf.split, the kernel
+    is split (a small weight slice) and feature and gate are computed by two
+    convs, so the full-size conv output and its split copies are never
+    materialised.
+
+    Args:
+        x: Input, already padded for SYMMETRIC/REFELECT padding.
+        cnum: Channel number of the unsplit conv (output has cnum//2).
+        padding: 'SAME' or 'VALID'.
+
+    Returns:
+        tf.Tensor: output
+
+    """
+    kernel, bias = _gated_conv_variables(x, cnum, ksize, name)
+    half = cnum // 2
+    outs = []
+    for part in (slice(0, half), slice(half, cnum)):
+        y = tf.nn.convolution(
+            x, kernel[:, :, :, part], padding=padding,
+            strides=[stride, stride], dilation_rate=[rate, rate])
+        outs.append(tf.nn.bias_add(y, bias[part]))
+    return activation(outs[0]) * tf.nn.sigmoid(outs[1])
+
+
+# For output row parity a, _UPSAMPLE_PHASES[a][r, d] is 1 when tap d of a
+# 3x3 kernel applied to the x2 nearest upsampled input reads input row
+# offset r-1.
+_UPSAMPLE_PHASES = np.zeros((2, 3, 3), np.float32)
+for _d in range(3):
+    _UPSAMPLE_PHASES[0, [0, 1, 1][_d], _d] = 1.
+    _UPSAMPLE_PHASES[1, [1, 1, 2][_d], _d] = 1.
+
+
+def _upsample_phase_kernel(kernel):
+    """Fold a x2 nearest upsample into a 3x3 kernel.
+
+    Returns a kernel with 4x the output channels whose conv on the low
+    resolution input, followed by depth_to_space(2), equals the original
+    conv on the upsampled input.
+    """
+    kernels = []
+    for a in range(2):
+        for b in range(2):
+            # [r, e, in, out] then [c, r, in, out]
+            k = tf.tensordot(_UPSAMPLE_PHASES[a], kernel, axes=[[1], [0]])
+            k = tf.tensordot(_UPSAMPLE_PHASES[b], k, axes=[[1], [1]])
+            kernels.append(tf.transpose(k, [1, 0, 2, 3]))
+    return tf.concat(kernels, axis=3)
+
+
+def gen_deconv_fused(x, cnum, name='upsample'):
+    """Inference-optimised gen_deconv with SAME padding.
+
+    The x2 nearest neighbour upsample is folded into the kernel, so the conv
+    runs on the low resolution input and the upsampled input is never
+    materialised. Equivalent to gen_deconv up to float rounding.
+
+    Args:
+        x: Input.
+        cnum: Channel number of the unsplit conv (output has cnum//2).
+        name: Name of layers.
+
+    Returns:
+        tf.Tensor: output
+
+    """
+    with tf.variable_scope(name):
+        kernel, bias = _gated_conv_variables(x, cnum, 3, name+'_conv')
+    half = cnum // 2
+    outs = []
+    for part in (slice(0, half), slice(half, cnum)):
+        y = tf.nn.conv2d(
+            x, _upsample_phase_kernel(kernel[:, :, :, part]),
+            strides=[1, 1, 1, 1], padding='SAME')
+        y = tf.nn.bias_add(y, tf.tile(bias[part], [4]))
+        outs.append(tf.depth_to_space(y, 2))
+    return tf.nn.elu(outs[0]) * tf.nn.sigmoid(outs[1])
+
+
 @add_arg_scope
 def dis_conv(x, cnum, ksize=5, stride=2, name='conv', training=True):
     """Define conv for discriminator.
@@ -153,72 +264,186 @@ def bbox2mask(FLAGS, bbox, name='mask'):
     return mask
 
 
+def draw_strokes(starts, ends, widths, height, width, stride=1):
+    """Rasterise line segments with round caps and joins.
+
+    A pixel is masked when it lies within half the width of any segment, so
+    all segments are drawn at once instead of in a Python loop. With
+    stride > 1 the squared distance to the strokes is computed on a grid
+    stride times coarser and interpolated, which is stride^2 times cheaper;
+    edges move by a fraction of a pixel.
+
+    Args:
+        starts: float32 [N, 2] segment start points (x, y)
+        ends: float32 [N, 2] segment end points (x, y)
+        widths: float32 [N] stroke widths, <= 0 for unused segments
+        height: mask height
+        width: mask width
+
+    Returns:
+        tf.Tensor: bool [H, W]
+    """
+    rows = (height - 2) // stride + 2 if height > 1 else 1
+    cols = (width - 2) // stride + 2 if width > 1 else 1
+    ax, ay = starts[:, 0], starts[:, 1]
+    abx, aby = ends[:, 0] - ax, ends[:, 1] - ay
+    inverse_length2 = 1. / tf.maximum(abx * abx + aby * aby, 1e-6)
+    # offsets from the segment starts, per column [1, W, N] and per row [H, 1, N]
+    px = tf.range(cols, dtype=tf.float32)[None, :, None] * stride - ax
+    py = tf.range(rows, dtype=tf.float32)[:, None, None] * stride - ay
+    # projection of every pixel onto every segment, clamped to the segment
+    t = tf.clip_by_value(px * (abx * inverse_length2) + py * (aby * inverse_length2),
+                         0., 1.)
+    dx = px - t * abx
+    dy = py - t * aby
+    # d^2 - r^2 has the same zero set as the distance to the strokes and is
+    # smooth enough to interpolate; unused segments never come close to zero
+    radius2 = tf.where(widths > 0, tf.square(widths / 2.), tf.fill(tf.shape(widths), -1e8))
+    distance = tf.reduce_min(dx * dx + dy * dy - radius2, axis=-1)
+    if stride > 1:
+        distance = tf.image.resize_bilinear(
+            distance[None, :, :, None], [(rows - 1) * stride + 1, (cols - 1) * stride + 1],
+            align_corners=True)[0, :height, :width, 0]
+    return distance <= 0
+
+
+def random_brush_strokes(height, width, max_strokes=3, min_num_vertex=4,
+                         max_num_vertex=12, mean_angle=2*math.pi/5,
+                         angle_range=2*math.pi/15, min_width=12, max_width=40,
+                         stride=4):
+    """Free-form mask of 1 to max_strokes random brush strokes.
+
+    Native TF ops only, so it can run in parallel tf.data map calls. Each
+    stroke is a random walk of min_num_vertex to max_num_vertex - 1 segments
+    with alternating directions, clipped to the image; the mask is flipped
+    at random horizontally and vertically. Strokes are drawn on a grid
+    stride times coarser, see draw_strokes.
+
+    Returns:
+        tf.Tensor: float32 [H, W, 1], 1 for masked pixels
+    """
+    max_segments = max_num_vertex - 1
+    average_radius = math.sqrt(height*height + width*width) / 8
+    num_strokes = tf.random_uniform([], 1, max_strokes + 1, dtype=tf.int32)
+    num_segments = tf.random_uniform(
+        [max_strokes], min_num_vertex, max_num_vertex, dtype=tf.int32)
+
+    angle_min = mean_angle - tf.random_uniform([max_strokes, 1], 0, angle_range)
+    angle_max = mean_angle + tf.random_uniform([max_strokes, 1], 0, angle_range)
+    angles = angle_min + (angle_max - angle_min) * tf.random_uniform(
+        [max_strokes, max_segments])
+    # even segments turn the other way
+    odd = tf.cast(tf.range(max_segments) % 2, tf.float32)
+    angles = odd * angles + (1. - odd) * (2*math.pi - angles)
+    radius = tf.clip_by_value(
+        tf.random_normal([max_strokes, max_segments], average_radius,
+                         average_radius // 2),
+        0, 2*average_radius)
+    steps = tf.stack([radius * tf.cos(angles), radius * tf.sin(angles)], axis=-1)
+
+    size = tf.constant([width, height], tf.float32)
+    start = tf.floor(tf.random_uniform([max_strokes, 2]) * size)
+    # walk all strokes together, clipping each vertex to the image
+    vertices = tf.scan(
+        lambda vertex, step: tf.floor(tf.minimum(tf.maximum(vertex + step, 0.), size)),
+        tf.transpose(steps, [1, 0, 2]), initializer=start)
+    vertices = tf.concat([start[None], vertices], axis=0)
+
+    stroke_width = tf.floor(tf.random_uniform([max_strokes], min_width, max_width))
+    used = tf.logical_and(
+        tf.range(max_segments)[:, None] < num_segments[None, :],
+        tf.range(max_strokes)[None, :] < num_strokes)
+    widths = tf.where(used, tf.tile(stroke_width[None], [max_segments, 1]),
+                      tf.zeros([max_segments, max_strokes]))
+    mask = draw_strokes(tf.reshape(vertices[:-1], [-1, 2]),
+                        tf.reshape(vertices[1:], [-1, 2]),
+                        tf.reshape(widths, [-1]), height, width, stride)
+
+    for axis in (1, 0):
+        mask = tf.cond(tf.random_uniform([]) < 0.5,
+                       lambda: tf.reverse(mask, [axis]), lambda: mask)
+    mask = tf.cast(mask, tf.float32)[:, :, None]
+    mask.set_shape([height, width, 1])
+    return mask
+
+
+def write_brush_stroke_bank(path, count, height, width, batch_size=64):
+    """Precompute count masks of random_brush_strokes into a .npy file.
+
+    The file holds uint8 [count, H, W] and is written under a temporary
+    name first, so an interrupted run leaves no partial bank behind.
+    Builds its own graph, so it can run before the training graph.
+    """
+    partial = path + '.partial'
+    bank = np.lib.format.open_memmap(partial, mode='w+', dtype=np.uint8,
+                                     shape=(count, height, width))
+    with tf.Graph().as_default():
+        masks = tf.data.Dataset.range(count).map(
+            lambda _: random_brush_strokes(height, width),
+            tf.data.experimental.AUTOTUNE).batch(batch_size)
+        masks = tf.data.make_one_shot_iterator(masks).get_next()
+        with tf.Session() as sess:
+            for start in range(0, count, batch_size):
+                batch = sess.run(masks)
+                bank[start:start+len(batch)] = batch[:, :, :, 0]
+    bank.flush()
+    del bank
+    os.replace(partial, path)
+
+
+def brush_stroke_bank(path, count, height, width):
+    """Memory-map the brush stroke bank at path, writing count masks first
+    when the file does not exist.
+
+    Returns:
+        np.ndarray: uint8 [n, H, W], 1 for masked pixels
+
+    Raises:
+        ValueError: The bank at path was written for another mask size.
+    """
+    if not os.path.exists(path):
+        logger.info('Writing {} brush stroke masks to {}'.format(count, path))
+        write_brush_stroke_bank(path, count, height, width)
+    bank = np.load(path, mmap_mode='r')
+    if bank.ndim != 3 or bank.shape[1:] != (height, width):
+        raise ValueError('Brush stroke bank {} holds {} masks, not {}x{}'.format(
+            path, 'x'.join(map(str, bank.shape[1:])), height, width))
+    return bank
+
+
+def bank_brush_strokes(bank):
+    """A random mask of a brush stroke bank, flipped at random and shifted
+    by a random offset with wrap-around, see brush_stroke_bank.
+
+    Only copying the chosen row out of the memory-mapped bank runs in
+    Python; the augmentation is native TF ops. Rolling instead of
+    rescaling keeps the stroke widths and the masked area of the bank.
+
+    Returns:
+        tf.Tensor: float32 [H, W, 1], 1 for masked pixels
+    """
+    count, height, width = bank.shape
+    index = tf.random_uniform([], 0, count, tf.int64)
+    mask = tf.py_func(lambda i: np.asarray(bank[i]), [index], tf.uint8,
+                      stateful=False)
+    mask = tf.reshape(mask, [height, width, 1])
+    mask = tf.image.random_flip_up_down(tf.image.random_flip_left_right(mask))
+    shift = tf.stack([tf.random_uniform([], 0, height, tf.int32),
+                      tf.random_uniform([], 0, width, tf.int32)])
+    return tf.cast(tf.roll(mask, shift, [0, 1]), tf.float32)
+
+
 def brush_stroke_mask(FLAGS, name='mask'):
-    """Generate mask tensor from bbox.
+    """Generate a free-form brush stroke mask, see random_brush_strokes.
 
     Returns:
         tf.Tensor: output with shape [1, H, W, 1]
 
     """
-    min_num_vertex = 4
-    max_num_vertex = 12
-    mean_angle = 2*math.pi / 5
-    angle_range = 2*math.pi / 15
-    min_width = 12
-    max_width = 40
-    def generate_mask(H, W):
-        average_radius = math.sqrt(H*H+W*W) / 8
-        mask = Image.new('L', (W, H), 0)
-
-        for _ in range(np.random.randint(1, 4)):
-            num_vertex = np.random.randint(min_num_vertex, max_num_vertex)
-            angle_min = mean_angle - np.random.uniform(0, angle_range)
-            angle_max = mean_angle + np.random.uniform(0, angle_range)
-            angles = []
-            vertex = []
-            for i in range(num_vertex):
-                if i % 2 == 0:
-                    angles.append(2*math.pi - np.random.uniform(angle_min, angle_max))
-                else:
-                    angles.append(np.random.uniform(angle_min, angle_max))
-
-            h, w = mask.size
-            vertex.append((int(np.random.randint(0, w)), int(np.random.randint(0, h))))
-            for i in range(num_vertex):
-                r = np.clip(
-                    np.random.normal(loc=average_radius, scale=average_radius//2),
-                    0, 2*average_radius)
-                new_x = np.clip(vertex[-1][0] + r * math.cos(angles[i]), 0, w)
-                new_y = np.clip(vertex[-1][1] + r * math.sin(angles[i]), 0, h)
-                vertex.append((int(new_x), int(new_y)))
-
-            draw = ImageDraw.Draw(mask)
-            width = int(np.random.uniform(min_width, max_width))
-            draw.line(vertex, fill=1, width=width)
-            for v in vertex:
-                draw.ellipse((v[0] - width//2,
-                              v[1] - width//2,
-                              v[0] + width//2,
-                              v[1] + width//2),
-                             fill=1)
-
-        if np.random.normal() > 0:
-            mask.transpose(Image.FLIP_LEFT_RIGHT)
-        if np.random.normal() > 0:
-            mask.transpose(Image.FLIP_TOP_BOTTOM)
-        mask = np.asarray(mask, np.float32)
-        mask = np.reshape(mask, (1, H, W, 1))
-        return mask
-    with tf.variable_scope(name), tf.device('/cpu:0'):
+    with tf.variable_scope(name):
         img_shape = FLAGS.img_shapes
-        height = img_shape[0]
-        width = img_shape[1]
-        mask = tf.py_func(
-            generate_mask,
-            [height, width],
-            tf.float32, stateful=True)
-        mask.set_shape([1] + [height, width] + [1])
-    return mask
+        mask = random_brush_strokes(img_shape[0], img_shape[1])
+    return mask[None]
 
 
 def local_patch(x, bbox):
@@ -253,6 +478,62 @@ def resize_mask_like(mask, x):
     return mask_resize
 
 
+def _overlap_add(patches, rate, height, width):
+    """Sum 2rate x 2rate patches placed with stride rate, equivalent to
+    tf.nn.conv2d_transpose with SAME padding and a per-sample filter.
+
+    Args:
+        patches: Tensor [b, h, w, 2*rate, 2*rate, c].
+        rate: Stride between patches.
+        height, width: Output size, h*rate and w*rate.
+
+    Returns:
+        tf.Tensor: [b, height, width, c]
+    """
+    shape = tf.shape(patches)
+    c = patches.get_shape().as_list()[-1]
+    out = 0.
+    # each rate x rate quadrant of the patches tiles the output without
+    # overlap, so it is a depth_to_space followed by a shift
+    for qi in range(2):
+        for qj in range(2):
+            q = patches[:, :, :, qi*rate:(qi+1)*rate, qj*rate:(qj+1)*rate, :]
+            q = tf.reshape(q, [shape[0], shape[1], shape[2], rate*rate*c])
+            if rate > 1:
+                q = tf.depth_to_space(q, rate)
+            out += tf.pad(q, [[0, 0], [qi*rate, (1-qi)*rate],
+                              [qj*rate, (1-qj)*rate], [0, 0]])
+    pad_before = rate // 2
+    return out[:, pad_before:pad_before+height, pad_before:pad_before+width, :]
+
+
+def attention_fuse(y, fs, bs, k=3):
+    """Fuse attention scores with identity-kernel convolutions.
+
+    The scores are treated as a [fh*fw, bh*bw] image and convolved with an
+    identity kernel twice, once with both positions flattened row-major and
+    once column-major, which sums them along the diagonals.
+
+    Args:
+        y: Attention scores [b, fh*fw, bh*bw].
+        fs: Shape of the foreground [b, fh, fw, c].
+        bs: Shape of the background [b, bh, bw, c].
+        k: Fuse kernel size.
+
+    Returns:
+        tf.Tensor: fused scores [b, fh, fw, bh, bw]
+    """
+    fuse_weight = tf.reshape(tf.eye(k), [k, k, 1, 1])
+    y = tf.reshape(y, [fs[0], fs[1]*fs[2], bs[1]*bs[2], 1])
+    y = tf.nn.conv2d(y, fuse_weight, strides=[1,1,1,1], padding='SAME')
+    y = tf.reshape(y, [fs[0], fs[1], fs[2], bs[1], bs[2]])
+    y = tf.transpose(y, [0, 2, 1, 4, 3])
+    y = tf.reshape(y, [fs[0], fs[1]*fs[2], bs[1]*bs[2], 1])
+    y = tf.nn.conv2d(y, fuse_weight, strides=[1,1,1,1], padding='SAME')
+    y = tf.reshape(y, [fs[0], fs[2], fs[1], bs[2], bs[1]])
+    return tf.transpose(y, [0, 2, 1, 4, 3])
+
+
 def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
                          fuse_k=3, softmax_scale=10., training=True, fuse=True):
     """ Contextual attention layer implementation.
@@ -267,8 +548,10 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
         ksize: Kernel size for contextual attention.
         stride: Stride for extracting patches from t.
         rate: Dilation for matching.
+        fuse_k: Kernel size for fusing the attention scores.
         softmax_scale: Scaled softmax for attention.
         training: Indicating if current graph is training or inference.
+        fuse: Fuse the attention scores to encourage large patches.
 
     Returns:
         tf.Tensor: output
@@ -282,8 +565,6 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
     kernel = 2*rate
     raw_w = tf.extract_image_patches(
         b, [1,kernel,kernel,1], [1,rate*stride,rate*stride,1], [1,1,1,1], padding='SAME')
-    raw_w = tf.reshape(raw_w, [raw_int_bs[0], -1, kernel, kernel, raw_int_bs[3]])
-    raw_w = tf.transpose(raw_w, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
     # downscaling foreground option: downscaling both foreground and
     # background for matching and use original background for reconstruction.
     f = resize(f, scale=1./rate, func=tf.image.resize_nearest_neighbor)
@@ -292,14 +573,12 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
         mask = resize(mask, scale=1./rate, func=tf.image.resize_nearest_neighbor)
     fs = tf.shape(f)
     int_fs = f.get_shape().as_list()
-    f_groups = tf.split(f, int_fs[0], axis=0)
-    # from t(H*W*C) to w(b*k*k*c*h*w)
+    # from t(H*W*C) to w(b*hw*(k*k*c))
     bs = tf.shape(b)
     int_bs = b.get_shape().as_list()
     w = tf.extract_image_patches(
         b, [1,ksize,ksize,1], [1,stride,stride,1], [1,1,1,1], padding='SAME')
-    w = tf.reshape(w, [int_fs[0], -1, ksize, ksize, int_fs[3]])
-    w = tf.transpose(w, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
+    w = tf.reshape(w, [int_fs[0], -1, ksize*ksize*int_fs[3]])
     # process mask
     if mask is None:
         mask = tf.zeros([1, bs[1], bs[2], 1])
@@ -309,47 +588,37 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
     m = tf.transpose(m, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
     m = m[0]
     mm = tf.cast(tf.equal(tf.reduce_mean(m, axis=[0,1,2], keep_dims=True), 0.), tf.float32)
-    w_groups = tf.split(w, int_bs[0], axis=0)
-    raw_w_groups = tf.split(raw_w, int_bs[0], axis=0)
-    y = []
-    offsets = []
     k = fuse_k
     scale = softmax_scale
-    fuse_weight = tf.reshape(tf.eye(k), [k, k, 1, 1])
-    for xi, wi, raw_wi in zip(f_groups, w_groups, raw_w_groups):
-        # conv for compare
-        wi = wi[0]
-        wi_normed = wi / tf.maximum(tf.sqrt(tf.reduce_sum(tf.square(wi), axis=[0,1,2])), 1e-4)
-        yi = tf.nn.conv2d(xi, wi_normed, strides=[1,1,1,1], padding="SAME")
-
-        # conv implementation for fuse scores to encourage large patches
-        if fuse:
-            yi = tf.reshape(yi, [1, fs[1]*fs[2], bs[1]*bs[2], 1])
-            yi = tf.nn.conv2d(yi, fuse_weight, strides=[1,1,1,1], padding='SAME')
-            yi = tf.reshape(yi, [1, fs[1], fs[2], bs[1], bs[2]])
-            yi = tf.transpose(yi, [0, 2, 1, 4, 3])
-            yi = tf.reshape(yi, [1, fs[1]*fs[2], bs[1]*bs[2], 1])
-            yi = tf.nn.conv2d(yi, fuse_weight, strides=[1,1,1,1], padding='SAME')
-            yi = tf.reshape(yi, [1, fs[2], fs[1], bs[2], bs[1]])
-            yi = tf.transpose(yi, [0, 2, 1, 4, 3])
-        yi = tf.reshape(yi, [1, fs[1], fs[2], bs[1]*bs[2]])
-
-        # softmax to match
-        yi *=  mm  # mask
-        yi = tf.nn.softmax(yi*scale, 3)
-        yi *=  mm  # mask
-
-        offset = tf.argmax(yi, axis=3, output_type=tf.int32)
-        offset = tf.stack([offset // fs[2], offset % fs[2]], axis=-1)
-        # deconv for patch pasting
-        # 3.1 paste center
-        wi_center = raw_wi[0]
-        yi = tf.nn.conv2d_transpose(yi, wi_center, tf.concat([[1], raw_fs[1:]], axis=0), strides=[1,rate,rate,1]) / 4.
-        y.append(yi)
-        offsets.append(offset)
-    y = tf.concat(y, axis=0)
+
+    # conv for compare, as a batched matmul of the foreground patches with
+    # the normalised background patches of the same sample
+    w_normed = w / tf.maximum(tf.sqrt(tf.reduce_sum(tf.square(w), axis=2, keepdims=True)), 1e-4)
+    xp = tf.extract_image_patches(
+        f, [1,ksize,ksize,1], [1,1,1,1], [1,1,1,1], padding='SAME')
+    xp = tf.reshape(xp, [int_fs[0], -1, ksize*ksize*int_fs[3]])
+    y = tf.matmul(xp, w_normed, transpose_b=True)  # b*(fh*fw)*(bh*bw)
+
+    # fuse scores to encourage large patches
+    if fuse:
+        y = attention_fuse(y, fs, bs, k)
+    y = tf.reshape(y, [fs[0], fs[1], fs[2], bs[1]*bs[2]])
+
+    # softmax to match
+    y *= mm  # mask
+    y = tf.nn.softmax(y*scale, 3)
+    y *= mm  # mask
+
+    offsets = tf.argmax(y, axis=3, output_type=tf.int32)
+    offsets = tf.stack([offsets // fs[2], offsets % fs[2]], axis=-1)
+    # deconv for patch pasting
+    # 3.1 paste center
+    y = tf.reshape(y, [fs[0], fs[1]*fs[2], bs[1]*bs[2]])
+    raw_w = tf.reshape(raw_w, [raw_int_bs[0], -1, kernel*kernel*raw_int_bs[3]])
+    y = tf.matmul(y, raw_w)  # b*(fh*fw)*(k*k*c)
+    y = tf.reshape(y, [fs[0], fs[1], fs[2], kernel, kernel, raw_int_bs[3]])
+    y = _overlap_add(y, rate, raw_fs[1], raw_fs[2]) / 4.
     y.set_shape(raw_int_fs)
-    offsets = tf.concat(offsets, axis=0)
     offsets.set_shape(int_bs[:3] + [2])
     # case1: visualize optical flow: minus current position
     h_add = tf.tile(tf.reshape(tf.range(bs[1]), [1, bs[1], 1, 1]), [bs[0], 1, bs[2], 1])
@@ -436,111 +705,152 @@ def make_color_wheel():
 COLORWHEEL = make_color_wheel()
 
 
-def compute_color(u,v):
-    h, w = u.shape
-    img = np.zeros([h, w, 3])
-    nanIdx = np.isnan(u) | np.isnan(v)
-    u[nanIdx] = 0
-    v[nanIdx] = 0
-    # colorwheel = COLORWHEEL
-    colorwheel = make_color_wheel()
-    ncols = np.size(colorwheel, 0)
-    rad = np.sqrt(u**2+v**2)
+def compute_color(u, v):
+    """Middlebury colour code of flow normalised to at most 1.
+
+    Args:
+        u, v: Vertical and horizontal flow of any shape, NaN where unknown.
+
+    Returns:
+        np.ndarray: uint8 image, the shape of u with 3 channels.
+    """
+    nan = np.isnan(u) | np.isnan(v)
+    u = np.where(nan, 0., u)
+    v = np.where(nan, 0., v)
+    ncols = len(COLORWHEEL)
+    rad = np.sqrt(u**2 + v**2)[..., None]
     a = np.arctan2(-v, -u) / np.pi
-    fk = (a+1) / 2 * (ncols - 1) + 1
+    fk = (a+1) / 2 * (ncols - 1)
     k0 = np.floor(fk).astype(int)
-    k1 = k0 + 1
-    k1[k1 == ncols+1] = 1
-    f = fk - k0
-    for i in range(np.size(colorwheel,1)):
-        tmp = colorwheel[:, i]
-        col0 = tmp[k0-1] / 255
-        col1 = tmp[k1-1] / 255
-        col = (1-f) * col0 + f * col1
-        idx = rad <= 1
-        col[idx] = 1-rad[idx]*(1-col[idx])
-        notidx = np.logical_not(idx)
-        col[notidx] *= 0.75
-        img[:, :, i] = np.uint8(np.floor(255 * col*(1-nanIdx)))
-    return img
-
+    k1 = (k0 + 1) % ncols
+    f = (fk - k0)[..., None]
+    col = (1-f) * (COLORWHEEL[k0] / 255) + f * (COLORWHEEL[k1] / 255)
+    col = np.where(rad <= 1, 1 - rad*(1-col), col*0.75)
+    return np.uint8(np.floor(255 * col * ~nan[..., None]))
 
 
 def flow_to_image(flow):
     """Transfer flow map to image.
-    Part of code forked from flownet.
+    Part of code forked from flownet. Each flow map is normalised by its
+    largest motion; values above 1e7 are unknown flow.
+
+    Args:
+        flow: [b, h, w, 2] flow, not modified.
+
+    Returns:
+        np.ndarray: float32 [b, h, w, 3] in [0, 255]
     """
-    out = []
-    maxu = -999.
-    maxv = -999.
-    minu = 999.
-    minv = 999.
-    maxrad = -1
-    for i in range(flow.shape[0]):
-        u = flow[i, :, :, 0]
-        v = flow[i, :, :, 1]
-        idxunknow = (abs(u) > 1e7) | (abs(v) > 1e7)
-        u[idxunknow] = 0
-        v[idxunknow] = 0
-        maxu = max(maxu, np.max(u))
-        minu = min(minu, np.min(u))
-        maxv = max(maxv, np.max(v))
-        minv = min(minv, np.min(v))
-        rad = np.sqrt(u ** 2 + v ** 2)
-        maxrad = max(maxrad, np.max(rad))
-        u = u/(maxrad + np.finfo(float).eps)
-        v = v/(maxrad + np.finfo(float).eps)
-        img = compute_color(u, v)
-        out.append(img)
-    return np.float32(np.uint8(out))
+    flow = np.asarray(flow, np.float64)
+    flow = np.where((np.abs(flow) > 1e7).any(axis=3, keepdims=True), 0., flow)
+    rad = np.sqrt(np.sum(flow**2, axis=3))
+    maxrad = rad.max(axis=(1, 2), keepdims=True) + np.finfo(float).eps
+    return np.float32(compute_color(flow[..., 0] / maxrad, flow[..., 1] / maxrad))
 
 
 def flow_to_image_tf(flow, name='flow_to_image'):
-    """Tensorflow ops for computing flow to image.
+    """Tensorflow ops for computing flow to image, see flow_to_image.
+
+    Returns:
+        tf.Tensor: float32 [b, h, w, 3] in [-1, 1]
     """
-    with tf.variable_scope(name), tf.device('/cpu:0'):
-        img = tf.py_func(flow_to_image, [flow], tf.float32, stateful=False)
-        img.set_shape(flow.get_shape().as_list()[0:-1]+[3])
-        img = img / 127.5 - 1.
-        return img
+    with tf.variable_scope(name):
+        flow = tf.cast(flow, tf.float32)
+        unknown = tf.reduce_any(tf.abs(flow) > 1e7, axis=3, keepdims=True)
+        flow = tf.where(tf.broadcast_to(unknown, tf.shape(flow)), tf.zeros_like(flow), flow)
+        rad = tf.sqrt(tf.reduce_sum(tf.square(flow), axis=3))
+        maxrad = tf.reduce_max(rad, axis=[1, 2], keepdims=True) + np.finfo(np.float32).eps
+        u, v, rad = flow[..., 0] / maxrad, flow[..., 1] / maxrad, rad / maxrad
+        ncols = len(COLORWHEEL)
+        fk = (tf.atan2(-v, -u) / math.pi + 1) / 2 * (ncols - 1)
+        k0 = tf.floor(fk)
+        f = (fk - k0)[..., None]
+        k0 = tf.cast(k0, tf.int32)
+        colorwheel = tf.constant(COLORWHEEL / 255, tf.float32)
+        col = (1-f) * tf.gather(colorwheel, k0) + \
+            f * tf.gather(colorwheel, tf.floormod(k0 + 1, ncols))
+        rad = tf.tile(rad[..., None], [1, 1, 1, 3])
+        col = tf.where(rad <= 1, 1 - rad*(1-col), col*0.75)
+        img = tf.floor(255 * col)
+        return img / 127.5 - 1.
 
 
 def highlight_flow(flow):
-    """Convert flow into middlebury color code image.
+    """White at the pixels any location attends to, grey elsewhere.
+
+    Args:
+        flow: int [b, h, w, 2] absolute positions, negative values count
+            from the end.
+
+    Returns:
+        np.ndarray: float32 [b, h, w, 3] in [0, 255]
     """
-    out = []
-    s = flow.shape
-    for i in range(flow.shape[0]):
-        img = np.ones((s[1], s[2], 3)) * 144.
-        u = flow[i, :, :, 0]
-        v = flow[i, :, :, 1]
-        for h in range(s[1]):
-            for w in range(s[1]):
-                ui = u[h,w]
-                vi = v[h,w]
-                img[ui, vi, :] = 255.
-        out.append(img)
-    return np.float32(np.uint8(out))
+    b, h, w = flow.shape[:3]
+    img = np.full((b, h, w, 3), 144., np.float32)
+    img[np.arange(b)[:, None, None], flow[..., 0], flow[..., 1]] = 255.
+    return img
 
 
 def highlight_flow_tf(flow, name='flow_to_image'):
-    """Tensorflow ops for highlight flow.
+    """Tensorflow ops for highlight flow, see highlight_flow.
+
+    Returns:
+        tf.Tensor: float32 [b, h, w, 3] in [-1, 1]
     """
-    with tf.variable_scope(name), tf.device('/cpu:0'):
-        img = tf.py_func(highlight_flow, [flow], tf.float32, stateful=False)
+    with tf.variable_scope(name):
+        flow = tf.cast(flow, tf.int32)
+        shape = tf.shape(flow)
+        batch = tf.tile(tf.reshape(tf.range(shape[0]), [-1, 1, 1, 1]),
+                        [1, shape[1], shape[2], 1])
+        indices = tf.concat([batch, tf.floormod(flow[..., 0:1], shape[1]),
+                             tf.floormod(flow[..., 1:2], shape[2])], axis=3)
+        hits = tf.scatter_nd(indices, tf.ones(shape[:3]), shape[:3])
+        img = tf.where(hits > 0, tf.fill(shape[:3], 255.), tf.fill(shape[:3], 144.))
+        img = tf.tile(img[..., None], [1, 1, 1, 3])
         img.set_shape(flow.get_shape().as_list()[0:-1]+[3])
-        img = img / 127.5 - 1.
-        return img
+        return img / 127.5 - 1.
 
 
 def image2edge(image):
     """Convert image to edges.
+
+    Same result as cv2.Laplacian(ksize=3, scale=2) on every image of the
+    batch followed by a wrapping uint8 cast, computed for the whole batch at
+    once from shifted slices of the reflect-101 padded images.
+
+    Args:
+        image: uint8 images [b, h, w, c].
+
+    Returns:
+        np.ndarray: float32 edges [b, h, w, c] in [0, 255].
+    """
+    image = np.asarray(image).astype(np.int32)
+    padded = np.pad(image, ((0, 0), (1, 1), (1, 1), (0, 0)), mode='reflect')
+    # the ksize=3 Laplacian kernel is [[2, 0, 2], [0, -8, 0], [2, 0, 2]]
+    corners = padded[:, :-2, :-2] + padded[:, :-2, 2:] + \
+        padded[:, 2:, :-2] + padded[:, 2:, 2:]
+    edges = 2 * (2 * corners - 8 * image)
+    return np.float32(np.uint8(edges & 255))
+
+
+def edge_guidance(images, threshold):
+    """In-graph image2edge of the first channel, binarised like the edge
+    inputs of guided models, so no edge files have to be computed upfront.
+
+    Args:
+        images: RGB images [b, h, w, c] with integer values in [0, 255],
+            uint8 or float. Edges come from the red channel, so callers must
+            not pass BGR.
+        threshold: The edge_threshold of the model config, in [0, 1].
+
+    Returns:
+        tf.Tensor: float32 edges [b, h, w, 1] in {0, 1}.
     """
-    out = []
-    for i in range(image.shape[0]):
-        img = cv2.Laplacian(image[i, :, :, :], cv2.CV_64F, ksize=3, scale=2)
-        out.append(img)
-    return np.float32(np.uint8(out))
+    x = tf.cast(images[:, :, :, 0:1], tf.int32)
+    padded = tf.pad(x, [[0, 0], [1, 1], [1, 1], [0, 0]], mode='REFLECT')
+    corners = padded[:, :-2, :-2] + padded[:, :-2, 2:] + \
+        padded[:, 2:, :-2] + padded[:, 2:, 2:]
+    edges = tf.bitwise.bitwise_and(2 * (2 * corners - 8 * x), 255)
+    return tf.cast(tf.cast(edges, tf.float32) / 255. > threshold, tf.float32)
 
 
 if __name__ == "__main__":
@@ -3,8 +3,56 @@ from PIL import Image
 import cv2
 
 
+def load_mask(watermark_type, image_w, image_h):
+    """Load the watermark mask and resize it to the image size.
+
+    Returns:
+        np.ndarray: RGB mask of shape (image_h, image_w, 3)
+    """
+    return np.repeat(load_mask_channel(watermark_type, image_w, image_h), 3, axis=2)
+
+
+def load_mask_channel(watermark_type, image_w, image_h):
+    """Binarized single-channel mask for the image size, from the mask
+    registry, which picks the variant closest to the image aspect ratio and
+    caches the resized masks.
+
+    Returns:
+        np.ndarray: read-only uint8 mask of shape (image_h, image_w, 1)
+    """
+    from service.mask_registry import default_registry
+    return default_registry().get(watermark_type, image_w, image_h).mask
+
+
+def build_input(image, mask_image, grid=8):
+    """Crop image and RGB mask to the grid and concatenate them side by side
+    into the [1, H, 2W, 3] layout expected by build_server_graph.
+    """
+    image_h, image_w = image.shape[:2]
+    image = image[:image_h//grid*grid, :image_w//grid*grid, :]
+    mask_image = mask_image[:image_h//grid*grid, :image_w//grid*grid, :]
+    image = np.expand_dims(image, 0)
+    mask_image = np.expand_dims(mask_image, 0)
+    return np.concatenate([image, mask_image], axis=2)
+
+
+def prepare_image(image, watermark_type, grid=8):
+    """Load image and mask as separate arrays for an inference backend.
+
+    Returns:
+        tuple: (RGB image (H, W, 3), mask (H, W, 1)), both uint8 and cropped
+            to a multiple of grid
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image = np.array(image)
+    image_h, image_w = image.shape[:2]
+    mask = load_mask_channel(watermark_type, image_w, image_h)
+    h, w = image_h//grid*grid, image_w//grid*grid
+    return image[:h, :w], mask[:h, :w]
+
+
 def preprocess_image(image, watermark_type):
-    image_type: str = ''
     preprocessed_mask_image = np.array([])
     if image.mode != "RGB":
         image = image.convert("RGB")
@@ -14,34 +62,11 @@ def preprocess_image(image, watermark_type):
     aspectRatioImage = image_w / image_h
     print("image size: {}".format(image.shape))
 
-    if image_w > image_h:
-        image_type = "landscape"
-    elif image_w == image_h:
-        image_type = "landscape"
-    else:
-        image_type = "potrait"
-
-    mask_image = Image.open(
-        "utils/{}/{}/mask.png".format(watermark_type, image_type))
-    if mask_image.mode != "RGB":
-        mask_image = mask_image.convert("RGB")
-    mask_image = np.array(mask_image)
-    print("mask image size: {}".format(mask_image.shape))
-
-    # 移除纵横比限制，直接将mask调整为输入图片的尺寸
-    preprocessed_mask_image = cv2.resize(mask_image, (image_w, image_h))
-    print(f"Resized mask to match image: {preprocessed_mask_image.shape}")
+    preprocessed_mask_image = load_mask(watermark_type, image_w, image_h)
 
     if (preprocessed_mask_image.shape != (0,)):
         # assert image.shape == preprocessed_mask_image
-        grid = 8
-        image = image[:image_h//grid*grid, :image_w//grid*grid, :]
-        preprocessed_mask_image = preprocessed_mask_image[:image_h //
-                                                          grid*grid, :image_w//grid*grid, :]
-        image = np.expand_dims(image, 0)
-        preprocessed_mask_image = np.expand_dims(preprocessed_mask_image, 0)
-        input_image = np.concatenate([image, preprocessed_mask_image], axis=2)
-        return input_image
+        return build_input(image, preprocessed_mask_image)
 
     else:
         return preprocessed_mask_image
@@ -0,0 +1,124 @@
+""" weight quantization for compressed checkpoints
+
+This is storage-only compression: load_variable converts the weights back
+to float32, so inference runs the same float32 graph with the same compute
+and activation memory as the original model. Only the checkpoint on disk
+(and the weights read at start-up) shrinks.
+"""
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+logger = logging.getLogger()
+
+PRECISIONS = ('float32', 'float16', 'int8')
+# per-output-channel scales of int8 kernels are stored next to the kernel
+SCALE_SUFFIX = '_quant_scale'
+
+
+def quantize_weight(value, precision):
+    """Quantize one checkpoint tensor.
+
+    Only conv kernels (rank 4) are quantized, biases and other tensors are
+    kept in float32. int8 uses symmetric per-output-channel scales.
+
+    Args:
+        value: Numpy array from the float32 checkpoint.
+        precision: One of PRECISIONS.
+
+    Returns:
+        tuple: (stored value, scale or None)
+
+    """
+    if precision == 'float32' or value.ndim != 4 or \
+            value.dtype != np.float32:
+        return value, None
+    if precision == 'float16':
+        return value.astype(np.float16), None
+    if precision == 'int8':
+        scale = np.max(np.abs(value), axis=(0, 1, 2)) / 127.
+        scale = np.maximum(scale, 1e-12).astype(np.float32)
+        q = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+        return q, scale
+    raise ValueError('Unknown precision: {}'.format(precision))
+
+
+def dequantize_weight(value, scale=None):
+    """Inverse of quantize_weight, always returns float32."""
+    if scale is not None:
+        return value.astype(np.float32) * scale
+    return value.astype(np.float32)
+
+
+def load_variable(checkpoint_dir, name):
+    """Load a variable from a float32 or quantized checkpoint as float32.
+
+    Quantized weights are dequantized here, so the graph always computes in
+    float32.
+
+    Args:
+        checkpoint_dir: Checkpoint directory or prefix.
+        name: Variable name, with or without the ':0' suffix.
+
+    Returns:
+        np.ndarray: float32 value
+
+    """
+    if name.endswith(':0'):
+        name = name[:-2]
+    value = tf.contrib.framework.load_variable(checkpoint_dir, name)
+    if value.dtype == np.int8:
+        scale = tf.contrib.framework.load_variable(
+            checkpoint_dir, name + SCALE_SUFFIX)
+        return dequantize_weight(value, scale)
+    if value.dtype == np.float16:
+        return dequantize_weight(value)
+    return value
+
+
+def quantize_checkpoint(checkpoint_dir, output_dir, precision='int8'):
+    """Write a reduced-precision copy of a checkpoint.
+
+    The copy keeps the original variable names so it can be loaded with
+    load_variable by any graph built from InpaintCAModel.
+
+    Args:
+        checkpoint_dir: Directory of the float32 checkpoint.
+        output_dir: Directory for the quantized checkpoint.
+        precision: One of PRECISIONS.
+
+    Returns:
+        dict: bytes of the weights before and after quantization
+
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision: {}'.format(precision))
+    tensors = {}
+    size_before = 0
+    size_after = 0
+    for name, _ in tf.train.list_variables(checkpoint_dir):
+        value = tf.contrib.framework.load_variable(checkpoint_dir, name)
+        size_before += value.nbytes
+        q, scale = quantize_weight(value, precision)
+        tensors[name] = q
+        size_after += q.nbytes
+        if scale is not None:
+            tensors[name + SCALE_SUFFIX] = scale
+            size_after += scale.nbytes
+    os.makedirs(output_dir, exist_ok=True)
+    with tf.Graph().as_default():
+        var_list = {}
+        for i, (name, value) in enumerate(sorted(tensors.items())):
+            var_list[name] = tf.Variable(value, name='var_{}'.format(i))
+        saver = tf.train.Saver(var_list)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            saver.save(sess, os.path.join(output_dir, 'snap-0'),
+                       write_meta_graph=False)
+    logger.info('Quantized checkpoint ({}) written to {}: {} -> {} bytes'.format(
+        precision, output_dir, size_before, size_after))
+    return {'weight_bytes_before': size_before,
+            'weight_bytes_after': size_after}
@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from queue import Empty
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from quantization import PRECISIONS
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='model/', type=str,
+                    help='The directory of the float32 checkpoint.')
+parser.add_argument('--output_dir', default='model_int8/', type=str,
+                    help='Where to write the compressed checkpoint.')
+parser.add_argument('--precision', default='int8', type=str,
+                    choices=[p for p in PRECISIONS if p != 'float32'],
+                    help='Storage precision of the conv kernels.')
+parser.add_argument('--flist', default='', type=str,
+                    help='Reference images, one path per line. Leave empty '
+                    'to only write the checkpoint.')
+parser.add_argument('--watermark_type', default='istock', type=str,
+                    help='The watermark type used to build the masks.')
+parser.add_argument('--runs', default=3, type=int,
+                    help='Timed runs per image, after one warm-up run.')
+parser.add_argument('--report', default='quantization_report.json', type=str,
+                    help='Where to write the JSON report.')
+
+
+def masked_psnr(reference, test, mask):
+    """PSNR restricted to the masked (inpainted) pixels."""
+    m = mask.astype(bool)
+    if not m.any():
+        return float('inf')
+    diff = reference.astype(np.float64)[m] - test.astype(np.float64)[m]
+    mse = np.mean(diff ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10. * np.log10(255. ** 2 / mse))
+
+
+def masked_ssim(reference, test, mask):
+    """Mean SSIM (gaussian window 11, sigma 1.5) over the masked pixels."""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    x = reference.astype(np.float64)
+    y = test.astype(np.float64)
+
+    def blur(a):
+        return cv2.GaussianBlur(a, (11, 11), 1.5)
+    mu_x, mu_y = blur(x), blur(y)
+    sigma_x = blur(x * x) - mu_x ** 2
+    sigma_y = blur(y * y) - mu_y ** 2
+    sigma_xy = blur(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / \
+        ((mu_x ** 2 + mu_y ** 2 + c1) * (sigma_x + sigma_y + c2))
+    m = mask.astype(bool)
+    if not m.any():
+        return 1.
+    return float(np.mean(ssim_map[m]))
+
+
+def run_variant(checkpoint_dir, image_paths, watermark_type, runs, out_dir,
+                queue):
+    """Run every reference image through one checkpoint variant.
+
+    Runs in its own process so that peak RSS belongs to this variant only.
+    """
+    import tensorflow as tf
+    import neuralgym as ng
+    from inpaint_model import InpaintCAModel
+    from preprocess_image import preprocess_image
+    from quantization import load_variable
+
+    FLAGS = ng.Config('inpaint.yml')
+    model = InpaintCAModel()
+    stats = {'latency_ms': [], 'load_ms': []}
+    for i, path in enumerate(image_paths):
+        input_image = preprocess_image(Image.open(path), watermark_type)
+        tf.reset_default_graph()
+        sess_config = tf.ConfigProto()
+        sess_config.gpu_options.allow_growth = True
+        with tf.Session(config=sess_config) as sess:
+            input_ph = tf.placeholder(tf.float32, shape=input_image.shape)
+            output = model.build_server_graph(FLAGS, input_ph)
+            output = (output + 1.) * 127.5
+            output = tf.saturate_cast(output, tf.uint8)
+            t = time.time()
+            assign_ops = []
+            for var in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+                var_value = load_variable(checkpoint_dir, var.name)
+                assign_ops.append(tf.assign(var, var_value))
+            sess.run(assign_ops)
+            stats['load_ms'].append((time.time() - t) * 1000.)
+            feed = {input_ph: input_image}
+            result = sess.run(output, feed_dict=feed)
+            for _ in range(runs):
+                t = time.time()
+                result = sess.run(output, feed_dict=feed)
+                stats['latency_ms'].append((time.time() - t) * 1000.)
+        w = input_image.shape[2] // 2
+        np.save(os.path.join(out_dir, '{}.npy'.format(i)), result[0])
+        np.save(os.path.join(out_dir, '{}_mask.npy'.format(i)),
+                input_image[0, :, w:, 0] > 127.5)
+    # ru_maxrss is in kilobytes on Linux
+    stats['peak_rss_mb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024.
+    queue.put(stats)
+
+
+def evaluate(checkpoint_dir, image_paths, watermark_type, runs, out_dir):
+    """Run run_variant in a fresh process.
+
+    Raises:
+        RuntimeError: The process exited without a result, e.g. it was
+            killed for running out of memory.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=run_variant, args=(
+        checkpoint_dir, image_paths, watermark_type, runs, out_dir, queue))
+    p.start()
+    while True:
+        # a process that exits after put has flushed the result, so a get
+        # after seeing the exit code still finds it
+        exited = p.exitcode is not None
+        try:
+            stats = queue.get(timeout=1.)
+            break
+        except Empty:
+            if exited:
+                raise RuntimeError('Evaluating {} failed with exit code {}'.format(
+                    checkpoint_dir, p.exitcode))
+    p.join()
+    return stats
+
+
+if __name__ == "__main__":
+    from quantization import quantize_checkpoint
+
+    args = parser.parse_args()
+    report = {
+        'precision': args.precision,
+        'checkpoint_dir': args.checkpoint_dir,
+        'output_dir': args.output_dir,
+    }
+    report.update(quantize_checkpoint(
+        args.checkpoint_dir, args.output_dir, args.precision))
+    report['compression_ratio'] = report['weight_bytes_before'] / \
+        report['weight_bytes_after']
+
+    if args.flist:
+        with open(args.flist, 'r') as f:
+            image_paths = [l.strip() for l in f if l.strip()]
+        with tempfile.TemporaryDirectory() as tmp:
+            ref_dir = os.path.join(tmp, 'float32')
+            q_dir = os.path.join(tmp, args.precision)
+            os.makedirs(ref_dir)
+            os.makedirs(q_dir)
+            ref_stats = evaluate(args.checkpoint_dir, image_paths,
+                                 args.watermark_type, args.runs, ref_dir)
+            q_stats = evaluate(args.output_dir, image_paths,
+                               args.watermark_type, args.runs, q_dir)
+            images = []
+            for i, path in enumerate(image_paths):
+                ref = np.load(os.path.join(ref_dir, '{}.npy'.format(i)))
+                out = np.load(os.path.join(q_dir, '{}.npy'.format(i)))
+                mask = np.load(os.path.join(ref_dir, '{}_mask.npy'.format(i)))
+                images.append({
+                    'image': path,
+                    'masked_psnr': masked_psnr(ref, out, mask),
+                    'masked_ssim': masked_ssim(ref, out, mask),
+                })
+        for name, stats in (('float32', ref_stats),
+                            (args.precision, q_stats)):
+            report[name] = {
+                'mean_latency_ms': float(np.mean(stats['latency_ms'])),
+                'mean_load_ms': float(np.mean(stats['load_ms'])),
+                'peak_rss_mb': stats['peak_rss_mb'],
+            }
+        report['images'] = images
+        report['mean_masked_psnr'] = float(
+            np.mean([i['masked_psnr'] for i in images]))
+        report['mean_masked_ssim'] = float(
+            np.mean([i['masked_ssim'] for i in images]))
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print('report saved to {}'.format(args.report))
+    print('Note: the weights are converted back to float32 when loaded, so '
+          'inference latency and memory match the float32 model.')
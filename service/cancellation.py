@@ -0,0 +1,138 @@
+"""
+任务取消与期限
+
+每个任务有一个CancelToken，在以下情况下被取消：
+    cancelled   调用了cancel()，例如取消接口
+    superseded  同一task_id重复提交，前一个任务被新的任务取代
+    deadline    超过任务期限
+    disconnected  同步请求的客户端已断开
+
+处理过程在帧、块和批之间调用token.check()，排队时调度器定期检查，取消后
+抛出Cancelled，释放推理槽位和临时文件。
+
+    token = CancelToken(deadline_s=60)
+    with registry.track(task_id, token):
+        service.process_image(..., token=token)
+"""
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+    """任务被取消或超过期限"""
+
+    def __init__(self, reason):
+        super().__init__(f"Job {reason}")
+        self.reason = reason
+
+
+def socket_disconnected(sock):
+    """
+    返回检查客户端是否断开的函数。请求体已经读完，连接上可读且读到EOF
+    表示对方已关闭；无法检查的socket(例如TLS)视为仍然连接
+    """
+    def disconnected():
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError, ValueError):
+            return False
+        except OSError:
+            return True
+    return disconnected
+
+
+class CancelToken:
+    """
+    一个任务的取消状态，线程安全
+
+    Args:
+        deadline_s: 从创建起的期限(秒)，0表示不限制
+        disconnected: 返回客户端是否已断开的函数，None表示不检查
+    """
+
+    def __init__(self, deadline_s=0., disconnected=None):
+        self.deadline = time.time() + deadline_s if deadline_s > 0 else None
+        self._disconnected = disconnected
+        self._reason = None
+
+    def cancel(self, reason='cancelled'):
+        if self._reason is None:
+            self._reason = reason
+
+    @property
+    def reason(self):
+        """取消的原因，未取消时为None"""
+        if self._reason is None:
+            if self.deadline is not None and time.time() > self.deadline:
+                self._reason = 'deadline'
+            elif self._disconnected is not None and self._disconnected():
+                self._reason = 'disconnected'
+        return self._reason
+
+    def remaining_s(self):
+        """距离期限的秒数，没有期限时为None"""
+        if self.deadline is None:
+            return None
+        return max(0., self.deadline - time.time())
+
+    def check(self):
+        """
+        Raises:
+            Cancelled: 任务已被取消
+        """
+        reason = self.reason
+        if reason is not None:
+            raise Cancelled(reason)
+
+
+class JobRegistry:
+    """进行中的任务，按task_id取消，线程安全"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def add(self, task_id, token):
+        """登记任务；同一task_id的进行中任务被取代并取消"""
+        with self._lock:
+            previous = self._tokens.get(task_id)
+            self._tokens[task_id] = token
+        if previous is not None:
+            logger.info(f"Job {task_id} resubmitted, cancelling the previous one")
+            previous.cancel('superseded')
+
+    def remove(self, task_id, token):
+        with self._lock:
+            if self._tokens.get(task_id) is token:
+                del self._tokens[task_id]
+
+    @contextlib.contextmanager
+    def track(self, task_id, token):
+        """在with块内登记任务"""
+        self.add(task_id, token)
+        try:
+            yield token
+        finally:
+            self.remove(task_id, token)
+
+    def cancel(self, task_id, reason='cancelled'):
+        """
+        Returns:
+            bool: 有进行中的任务并已取消
+        """
+        with self._lock:
+            token = self._tokens.get(task_id)
+        if token is None:
+            return False
+        logger.info(f"Cancelling job {task_id}")
+        token.cancel(reason)
+        return True
+
+    def active(self):
+        with self._lock:
+            return sorted(self._tokens)
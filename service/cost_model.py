@@ -0,0 +1,346 @@
+"""
+推理开销模型与准入控制
+
+上下文注意力在1/4分辨率的特征图上做全局匹配，相关矩阵的大小与特征图面积的
+平方成正比，一张大图就可能超过容器的内存上限，进程被杀掉时所有进行中的任务
+都会失败。开销模型按 (H, W, mask面积, batch) 预测峰值内存和耗时：
+
+    y = c0 + c1 * B*P + c2 * B*P^2 + c3 * B*M      (P、M为百万像素)
+
+系数由benchmark/bench_e2e.py --calibrate_cost_model 在本机测量后用非负最小
+二乘拟合，按主机类型保存到COST_MODEL_FILE，没有校准结果时使用保守的默认值。
+
+准入控制在推理之前决定如何处理一个任务：
+    admit      预测内存在预算内，按原方式处理
+    downscale  缩小推理分辨率直到满足预算(缩放比例不低于MIN_DOWNSCALE)
+    tile       原分辨率下分块推理，每块满足预算(块数不超过MAX_TILES，否则仍然缩小)
+    reject     缩小推理也无法满足预算，返回413
+排队中的任务预测耗时之和超过ADMISSION_MAX_QUEUE_MS时直接拒绝，返回429。
+"""
+import collections
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from config.config import Config
+from service import highres
+from service.thread_tuning import host_key
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('const', 'pixels', 'pixels_sq', 'mask')
+TARGETS = ('memory_mb', 'latency_ms')
+
+# 未校准时的默认系数(保守估计)。神经网络的平方项来自注意力相关矩阵：
+# 每百万像素有(1e6/64)个匹配位置，float32矩阵及其softmax/fuse副本约3份
+DEFAULT_COEFFICIENTS = {
+    'neural': {
+        'memory_mb': [800., 2000., 3000., 0.],
+        'latency_ms': [50., 1500., 1000., 0.],
+    },
+    'classical': {
+        'memory_mb': [300., 30., 0., 0.],
+        'latency_ms': [5., 20., 0., 5000.],
+    },
+}
+
+JobCost = collections.namedtuple('JobCost', 'memory_mb latency_ms')
+
+
+class JobTooLarge(ValueError):
+    """任务在任何处理方式下都超过内存预算(413)"""
+
+
+class Overloaded(RuntimeError):
+    """排队的任务过多(429)"""
+
+    def __init__(self, message, retry_after_s):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+def features(height, width, mask_area=0, batch=1):
+    pixels = height * width / 1e6
+    return np.array([1., batch * pixels, batch * pixels ** 2,
+                     batch * mask_area / 1e6])
+
+
+def nonnegative_lstsq(x, y):
+    """系数为负的特征逐个去掉后重新拟合，保证预测随尺寸单调增加"""
+    active = list(range(x.shape[1]))
+    coefficients = np.zeros(x.shape[1])
+    while active:
+        solution = np.linalg.lstsq(x[:, active], y, rcond=None)[0]
+        if (solution >= 0).all():
+            coefficients[active] = solution
+            break
+        active.pop(int(np.argmin(solution)))
+    return coefficients
+
+
+class CostModel:
+    """
+    按 (H, W, mask面积, batch) 预测一次推理的峰值内存(MB)和耗时(ms)
+
+    Args:
+        coefficients: {engine: {target: [c0, c1, c2, c3]}}，None时使用默认值
+    """
+
+    def __init__(self, coefficients=None, calibrated=False):
+        self.coefficients = {
+            engine: {target: list(values) for target, values in targets.items()}
+            for engine, targets in (coefficients or DEFAULT_COEFFICIENTS).items()}
+        self.calibrated = calibrated
+
+    def predict(self, height, width, mask_area=0, batch=1, engine='neural'):
+        x = features(height, width, mask_area, batch)
+        coefficients = self.coefficients[engine]
+        return JobCost(*(float(x @ coefficients[target]) for target in TARGETS))
+
+    def fit(self, samples, engine='neural', targets=TARGETS):
+        """
+        Args:
+            samples: [{'height', 'width', 'mask_area', 'batch', 'memory_mb', 'latency_ms'}]
+            targets: 拟合的目标，其余目标保留原来的系数
+        """
+        x = np.stack([features(s['height'], s['width'], s.get('mask_area', 0),
+                               s.get('batch', 1)) for s in samples])
+        for target in targets:
+            self.coefficients[engine][target] = nonnegative_lstsq(
+                x, np.array([s[target] for s in samples])).tolist()
+        self.calibrated = True
+        return self
+
+    def max_side(self, aspect, budget_mb, mask_fraction=0., batch=1, grid=8,
+                 engine='neural'):
+        """
+        内存预算内最长边的最大值(grid的倍数)，aspect为短边/长边
+
+        Returns:
+            int: 0表示最小尺寸也超过预算
+        """
+        def fits(side):
+            short = max(grid, int(side * aspect))
+            return self.predict(side, short, side * short * mask_fraction,
+                                batch, engine).memory_mb <= budget_mb
+        low, high = 0, 1
+        while fits(high * grid) and high < 1 << 16:
+            low, high = high, high * 2
+        while high - low > 1:
+            mid = (low + high) // 2
+            if fits(mid * grid):
+                low = mid
+            else:
+                high = mid
+        return low * grid
+
+
+def load_model(path=None, key=None):
+    """读取当前主机类型的校准结果，没有时使用默认系数"""
+    path = path or Config.COST_MODEL_FILE
+    try:
+        with open(path) as f:
+            entry = json.load(f).get(key or host_key())
+    except (OSError, ValueError):
+        entry = None
+    if not entry:
+        return CostModel()
+    coefficients = dict(DEFAULT_COEFFICIENTS)
+    coefficients.update(entry['coefficients'])
+    return CostModel(coefficients, calibrated=True)
+
+
+def save_model(model, samples, path=None, key=None):
+    path = path or Config.COST_MODEL_FILE
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[key or host_key()] = {
+        'coefficients': model.coefficients,
+        'samples': samples,
+        'calibrated_at': time.time(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def memory_budget_mb():
+    """MEMORY_BUDGET_MB，未设置时取容器内存上限(cgroup)的85%，没有上限时为0(不限制)"""
+    if Config.MEMORY_BUDGET_MB > 0:
+        return Config.MEMORY_BUDGET_MB
+    for path in ('/sys/fs/cgroup/memory.max',                       # cgroup v2
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):   # cgroup v1
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # 没有上限时v2为max，v1为一个接近2^63的数
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value) / 2. ** 20 * 0.85
+    return 0.
+
+
+class Decision:
+    """准入决定：action为admit/downscale/tile，plans为推理区域，None表示整张图在原分辨率上推理"""
+
+    def __init__(self, action, cost, plans=None, work_side=None):
+        self.action = action
+        self.cost = cost
+        self.plans = plans
+        self.work_side = work_side
+
+    def __repr__(self):
+        return (f"Decision({self.action}, memory={self.cost.memory_mb:.0f}MB, "
+                f"latency={self.cost.latency_ms:.0f}ms, work_side={self.work_side}, "
+                f"tiles={len(self.plans) if self.plans else 0})")
+
+
+class AdmissionController:
+    """
+    推理前的准入控制：内存预算决定处理方式，预计排队时间决定是否接受
+
+    Args:
+        model: CostModel
+        budget_mb: 进程内存预算，0表示不按内存控制
+        max_queue_ms: 排队任务的预测耗时之和上限，0表示不限制
+        min_scale: 缩小推理的最小缩放比例(相对于MAX_WORKING_SIDE的缩小)，更小时改为分块
+        max_tiles: 分块数上限，超过时仍然缩小推理
+    """
+
+    def __init__(self, model, budget_mb=0., max_queue_ms=0., min_scale=0.5, max_tiles=16):
+        self.model = model
+        self.budget_mb = budget_mb
+        self.max_queue_ms = max_queue_ms
+        self.min_scale = min_scale
+        self.max_tiles = max_tiles
+        self._pending_ms = 0.
+        self._lock = threading.Lock()
+
+    def estimate(self, height, width, engine='neural', max_working_side=0):
+        """只知道图像尺寸时(解码之前)估计任务耗时，大图按MAX_WORKING_SIDE缩小"""
+        if highres.needs_downscale(width, height, max_working_side):
+            scale = max_working_side / float(max(height, width))
+            height, width = int(height * scale), int(width * scale)
+        return self.model.predict(height, width, engine=engine)
+
+    @contextlib.contextmanager
+    def queued(self, cost):
+        """排队期间计入待处理耗时；超过max_queue_ms时抛出Overloaded，队列为空时总是接受"""
+        with self._lock:
+            pending = self._pending_ms
+            if self.max_queue_ms > 0 and pending > 0 and \
+                    pending + cost.latency_ms > self.max_queue_ms:
+                raise Overloaded(f"{pending:.0f}ms of work queued, "
+                                 f"limit {self.max_queue_ms:.0f}ms",
+                                 retry_after_s=int(math.ceil(pending / 1000.)))
+            self._pending_ms += cost.latency_ms
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending_ms -= cost.latency_ms
+
+    @property
+    def pending_ms(self):
+        return self._pending_ms
+
+    def plan(self, mask, bbox=None, max_working_side=0):
+        """
+        决定神经网络推理的方式
+
+        Args:
+            mask: 原分辨率单通道mask (H, W)
+            bbox: mask包围盒，None时从mask计算
+            max_working_side: Config.MAX_WORKING_SIDE，大图本来就在缩小的ROI上推理
+
+        Returns:
+            Decision
+
+        Raises:
+            JobTooLarge: 缩小推理也无法满足内存预算
+        """
+        image_h, image_w = mask.shape[:2]
+        plans = None
+        if highres.needs_downscale(image_w, image_h, max_working_side):
+            plan = highres.plan_region(mask, max_working_side, bbox=bbox)
+            if plan is None:
+                return Decision('admit', JobCost(0., 0.), [])
+            plans = [plan]
+            work_w, work_h = plan.work_size
+        else:
+            work_h, work_w = image_h // 8 * 8, image_w // 8 * 8
+        mask_fraction = float(np.count_nonzero(mask)) / mask.size
+        cost = self.model.predict(work_h, work_w, work_h * work_w * mask_fraction)
+        if self.budget_mb <= 0 or cost.memory_mb <= self.budget_mb:
+            return Decision('admit', cost, plans)
+
+        # 预算内的最大推理尺寸
+        side = self.model.max_side(min(work_h, work_w) / float(max(work_h, work_w)),
+                                   self.budget_mb, mask_fraction)
+        if side <= 0:
+            raise JobTooLarge(f"{cost.memory_mb:.0f}MB predicted for {work_w}x{work_h}, "
+                              f"budget {self.budget_mb:.0f}MB")
+        plan = highres.plan_region(mask, side, bbox=bbox)
+        if plan is None:
+            return Decision('admit', JobCost(0., 0.), [])
+        work_w, work_h = plan.work_size
+        downscale = Decision('downscale', self.model.predict(
+            work_h, work_w, work_h * work_w * mask_fraction), [plan], side)
+        # 缩小比例相对于MAX_WORKING_SIDE的缩小计算，大图本来就在缩小的ROI上推理
+        base_scale = plans[0].scale if plans else 1.
+        if plan.scale >= self.min_scale * base_scale:
+            return downscale
+
+        # 缩小太多会丢失细节，改为在原分辨率上分块，块接近正方形
+        tile_side = self.model.max_side(1., self.budget_mb, mask_fraction)
+        tiles = highres.plan_tiles(mask, tile_side, bbox=bbox)
+        if len(tiles) > self.max_tiles:
+            # 块数过多时仍然使用预算内的缩小推理，缩小和分块都不满足预算时才拒绝
+            logger.info(f"{len(tiles)} tiles of {tile_side}px needed, limit {self.max_tiles}, "
+                        f"downscaling to {side}px instead")
+            return downscale
+        side = tile_side
+        costs = [self.model.predict(p.work_size[1], p.work_size[0],
+                                    p.work_size[0] * p.work_size[1] * mask_fraction)
+                 for p in tiles]
+        cost = JobCost(max(c.memory_mb for c in costs), sum(c.latency_ms for c in costs))
+        return Decision('tile', cost, tiles, side)
+
+    def video_batch(self, height, width, mask_area, batch):
+        """
+        内存预算内最大的视频批大小(不超过batch)
+
+        Raises:
+            JobTooLarge: 单帧也超过预算
+        """
+        while batch > 1 and self.budget_mb > 0 and self.model.predict(
+                height, width, mask_area, batch).memory_mb > self.budget_mb:
+            batch -= 1
+        cost = self.model.predict(height, width, mask_area, batch)
+        if self.budget_mb > 0 and cost.memory_mb > self.budget_mb:
+            raise JobTooLarge(f"{cost.memory_mb:.0f}MB predicted for a {width}x{height} "
+                              f"frame, budget {self.budget_mb:.0f}MB")
+        return batch
+
+
+def admission_from_config():
+    """按Config创建准入控制"""
+    model = load_model()
+    budget = memory_budget_mb()
+    logger.info(f"Admission control: budget={budget:.0f}MB, "
+                f"max_queue={Config.ADMISSION_MAX_QUEUE_MS:.0f}ms, "
+                f"cost model {'calibrated' if model.calibrated else 'default'}")
+    return AdmissionController(model, budget_mb=budget,
+                               max_queue_ms=Config.ADMISSION_MAX_QUEUE_MS,
+                               min_scale=Config.MIN_DOWNSCALE,
+                               max_tiles=Config.MAX_TILES)
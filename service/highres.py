@@ -0,0 +1,154 @@
+import logging
+import math
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class HighResPlan:
+    """高分辨率图像的处理计划：在缩小后的ROI上推理，再放大回原分辨率合成"""
+
+    def __init__(self, roi, work_size, scale):
+        self.roi = roi                  # (y0, y1, x0, x1)，原图坐标
+        self.work_size = work_size      # (w, h)，推理分辨率，8的倍数
+        self.scale = scale              # 推理分辨率 / ROI分辨率
+
+    def __repr__(self):
+        return f"HighResPlan(roi={self.roi}, work_size={self.work_size}, scale={self.scale:.3f})"
+
+
+def needs_downscale(image_w, image_h, max_side):
+    """max_side<=0 表示关闭该模式"""
+    return max_side > 0 and max(image_w, image_h) > max_side
+
+
+def plan_region(mask, max_side, context=0.5, grid=8, bbox=None):
+    """
+    根据mask的包围盒确定推理区域和缩放比例
+
+    Args:
+        mask: 单通道mask (H, W)，非0为水印区域
+        max_side: 推理分辨率的最长边上限
+        context: 包围盒向外扩展的比例，为上下文注意力提供背景
+        grid: 推理尺寸需要对齐的倍数
+        bbox: 预先计算的包围盒(y0, y1, x0, x1)，None时从mask计算
+
+    Returns:
+        HighResPlan or None: mask为空时返回None
+    """
+    if bbox is None:
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0:
+            return None
+        bbox = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    image_h, image_w = mask.shape[:2]
+    y0, y1, x0, x1 = bbox
+    margin = int(max(y1 - y0, x1 - x0) * context)
+    y0, y1 = max(0, y0 - margin), min(image_h, y1 + margin)
+    x0, x1 = max(0, x0 - margin), min(image_w, x1 + margin)
+
+    roi_h, roi_w = y1 - y0, x1 - x0
+    scale = min(1., max_side / float(max(roi_h, roi_w)))
+    work_w = max(grid, int(roi_w * scale) // grid * grid)
+    work_h = max(grid, int(roi_h * scale) // grid * grid)
+    return HighResPlan((y0, y1, x0, x1), (work_w, work_h), scale)
+
+
+def plan_tiles(mask, tile_side, overlap=0.25, grid=8, bbox=None):
+    """
+    把mask包围盒(向外扩展overlap/2个块的上下文)切成互相重叠的块，
+    每块在原分辨率上推理，用于缩小后细节损失过大的情况
+
+    Args:
+        mask: 单通道mask (H, W)，非0为水印区域
+        tile_side: 块的最长边上限
+        overlap: 相邻块重叠的比例
+
+    Returns:
+        list: scale为1的HighResPlan，不包含mask的块被跳过
+    """
+    if bbox is None:
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0:
+            return []
+        bbox = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    image_h, image_w = mask.shape[:2]
+    tile_side = max(grid, tile_side // grid * grid)
+    step = max(grid, int(tile_side * (1 - overlap)))
+    margin = (tile_side - step) // 2
+    y0, y1, x0, x1 = bbox
+    y0, y1 = max(0, y0 - margin), min(image_h, y1 + margin)
+    x0, x1 = max(0, x0 - margin), min(image_w, x1 + margin)
+
+    th = max(grid, min(tile_side, image_h) // grid * grid)
+    tw = max(grid, min(tile_side, image_w) // grid * grid)
+    plans = []
+    for ty in _tile_starts(y0, y1, tile_side, step):
+        for tx in _tile_starts(x0, x1, tile_side, step):
+            # 靠近边缘的块向内移动，保持尺寸为grid的倍数
+            ty, tx = max(0, min(ty, image_h - th)), max(0, min(tx, image_w - tw))
+            if not mask[ty:ty + th, tx:tx + tw].any():
+                continue
+            plans.append(HighResPlan((ty, ty + th, tx, tx + tw), (tw, th), 1.))
+    return plans
+
+
+def _tile_starts(start, stop, side, step):
+    """覆盖[start, stop)的块起点，最后一块与stop对齐"""
+    if stop - start <= side:
+        return [start]
+    return list(range(start, stop - side, step)) + [stop - side]
+
+
+def prepare(image, mask, plan):
+    """
+    生成推理输入：裁剪ROI并缩小到推理分辨率
+
+    Returns:
+        tuple: (work_image RGB, work_mask (h, w, 1) 0/255)
+    """
+    y0, y1, x0, x1 = plan.roi
+    work_image = cv2.resize(image[y0:y1, x0:x1], plan.work_size,
+                            interpolation=cv2.INTER_AREA)
+    work_mask = cv2.resize(mask[y0:y1, x0:x1], plan.work_size,
+                           interpolation=cv2.INTER_AREA)
+    # 缩小后的mask向外扩展1像素，保证放大后完全覆盖原分辨率的mask
+    work_mask = cv2.dilate((work_mask > 0).astype(np.uint8), np.ones((3, 3), np.uint8))
+    work_mask = work_mask[:, :, None] * 255
+    return work_image, work_mask
+
+
+def restore(image, mask, inpainted, plan, detail=0.):
+    """
+    把推理结果放大回ROI尺寸，只在mask内合成到原图
+
+    Args:
+        image: 原始RGB图像 (H, W, 3)
+        mask: 原分辨率单通道mask (H, W)
+        inpainted: 推理分辨率的RGB结果
+        plan: HighResPlan
+        detail: 叠加原图高频细节的权重，0为关闭。适用于半透明水印，
+            权重过大会把水印边缘带回结果中
+
+    Returns:
+        np.ndarray: 原分辨率的RGB结果
+    """
+    y0, y1, x0, x1 = plan.roi
+    roi = image[y0:y1, x0:x1]
+    roi_h, roi_w = roi.shape[:2]
+    up = cv2.resize(inpainted, (roi_w, roi_h), interpolation=cv2.INTER_CUBIC)
+    up = up.astype(np.float32)
+    if detail > 0 and plan.scale < 1.:
+        sigma = 0.5 / plan.scale
+        ksize = 2 * int(math.ceil(3 * sigma)) + 1
+        roi_f = roi.astype(np.float32)
+        high_freq = roi_f - cv2.GaussianBlur(roi_f, (ksize, ksize), sigma)
+        up += detail * high_freq
+
+    m = (mask[y0:y1, x0:x1] > 0)[:, :, None]
+    result = image.copy()
+    result[y0:y1, x0:x1] = np.where(
+        m, np.clip(up, 0, 255).astype(np.uint8), roi)
+    return result
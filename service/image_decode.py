@@ -0,0 +1,256 @@
+"""
+有界的图像解码
+
+先只读文件头得到格式、尺寸和EXIF方向，超过像素上限的图像在解码前就被拒绝。
+JPEG在需要缩小时用cv2的IMREAD_REDUCED_*直接按1/2、1/4、1/8解码，解码结果
+在转换通道顺序时写入可复用的连续uint8缓冲区，不再经过PIL的convert和
+np.array产生多份全尺寸拷贝。每种格式的解码耗时和像素内存记录在stats中。
+
+    info = probe(path)                # 只读文件头
+    image, info = decode_image(path, max_side=2048, buffer=ImageBuffer())
+"""
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config.config import Config
+
+logger = logging.getLogger(__name__)
+
+EXIF_ORIENTATION = 0x0112
+
+# EXIF方向 -> 把图像转正的操作(对应PIL的ImageOps.exif_transpose)
+_ORIENTATION_OPS = {
+    2: [(cv2.flip, 1)],
+    3: [(cv2.rotate, cv2.ROTATE_180)],
+    4: [(cv2.flip, 0)],
+    5: [(cv2.transpose, None)],
+    6: [(cv2.rotate, cv2.ROTATE_90_CLOCKWISE)],
+    7: [(cv2.transpose, None), (cv2.flip, -1)],
+    8: [(cv2.rotate, cv2.ROTATE_90_COUNTERCLOCKWISE)],
+}
+
+# 缩小倍数 -> cv2的缩小解码标志，从大到小尝试
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+class ImageTooLarge(ValueError):
+    """图像像素数超过上限"""
+
+
+class ImageInfo:
+    """文件头信息，width/height是文件中存储的尺寸(转正之前)"""
+
+    def __init__(self, format, width, height, mode, orientation=1):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.orientation = orientation if orientation in _ORIENTATION_OPS else 1
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    @property
+    def size(self):
+        """转正之后的(width, height)"""
+        if self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+    def describe(self):
+        return {
+            'format': self.format,
+            'size': list(self.size),
+            'mode': self.mode,
+            'orientation': self.orientation,
+        }
+
+
+def _exif(image):
+    """文件头中的EXIF，不触发解码"""
+    if image.format != 'PNG':
+        return image.getexif()
+    # PNG的getexif()为了找图像数据之后的eXIf块会解码整张图，这里只看文件头
+    exif = Image.Exif()
+    if 'exif' in image.info:
+        exif.load(image.info['exif'])
+    return exif
+
+
+def probe(path, max_pixels=None):
+    """
+    只读取文件头
+
+    Args:
+        path: 图像路径
+        max_pixels: 像素上限，None时使用Config.MAX_IMAGE_PIXELS，0表示不限制
+
+    Returns:
+        ImageInfo
+
+    Raises:
+        ImageTooLarge: 像素数超过上限
+        PIL.UnidentifiedImageError: 不是可识别的图像
+    """
+    if max_pixels is None:
+        max_pixels = Config.MAX_IMAGE_PIXELS
+    try:
+        with Image.open(path) as image:
+            try:
+                orientation = _exif(image).get(EXIF_ORIENTATION, 1)
+            except Exception:
+                # EXIF损坏不影响解码，只是不做转正
+                orientation = 1
+            info = ImageInfo(image.format, image.width, image.height,
+                             image.mode, orientation)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    if max_pixels and info.pixels > max_pixels:
+        raise ImageTooLarge(f"Image has {info.pixels} pixels "
+                            f"({info.width}x{info.height}), limit is {max_pixels}")
+    return info
+
+
+class ImageBuffer:
+    """
+    可复用的解码缓冲区，只增不减
+
+    返回的数组是缓冲区的视图，下一次解码会覆盖它，调用方需要在下一次解码前
+    用完或自行拷贝。不是线程安全的，每个处理线程使用自己的缓冲区。
+    """
+
+    def __init__(self):
+        self._data = np.empty(0, np.uint8)
+
+    def get(self, height, width, channels=3):
+        size = height * width * channels
+        if self._data.size < size:
+            self._data = np.empty(size, np.uint8)
+        return self._data[:size].reshape(height, width, channels)
+
+
+class DecodeStats:
+    """按格式统计解码次数、耗时和像素内存峰值，线程安全"""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, format, seconds, peak_bytes, reduced):
+        with self._lock:
+            entry = self._stats.setdefault(format, {
+                'count': 0, 'reduced': 0, 'total_ms': 0., 'max_ms': 0.,
+                'peak_mb': 0.})
+            ms = seconds * 1000.
+            entry['count'] += 1
+            entry['reduced'] += int(reduced)
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['peak_mb'] = max(entry['peak_mb'], peak_bytes / 2. ** 20)
+
+    def summary(self):
+        with self._lock:
+            return {format: dict(entry, mean_ms=entry['total_ms'] / entry['count'])
+                    for format, entry in self._stats.items()}
+
+
+stats = DecodeStats()
+
+
+def _target_size(width, height, max_side):
+    """按最长边限制缩小后的尺寸(文件中的方向)，不需要缩小时为None"""
+    if not max_side or max(width, height) <= max_side:
+        return None
+    scale = max_side / float(max(width, height))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def _read(path, info, target):
+    """
+    解码为BGR(或PIL回退时的RGB)像素
+
+    Returns:
+        tuple: (像素, 是否为BGR, 缩小倍数)
+    """
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    factor = 1
+    if target is not None and info.format == 'JPEG':
+        # 选最大的缩小倍数，解码结果仍不小于目标尺寸，剩下的由resize完成
+        for reduce, reduced_flag in _REDUCED_FLAGS:
+            if info.width // reduce >= target[0] and info.height // reduce >= target[1]:
+                flags = reduced_flag | cv2.IMREAD_IGNORE_ORIENTATION
+                factor = reduce
+                break
+    pixels = cv2.imread(path, flags)
+    if pixels is not None:
+        return pixels, True, factor
+    # cv2不支持的格式(如GIF)回退到PIL
+    with Image.open(path) as image:
+        return np.asarray(image.convert('RGB')), False, 1
+
+
+def decode_image(path, max_side=0, buffer=None, info=None, max_pixels=None):
+    """
+    解码为转正后的RGB图像
+
+    Args:
+        path: 图像路径
+        max_side: 最长边上限，超过时缩小(JPEG直接缩小解码)，0表示原尺寸
+        buffer: ImageBuffer，结果写入其中；None时分配新数组
+        info: 已经probe得到的ImageInfo
+        max_pixels: 见probe
+
+    Returns:
+        tuple: (RGB图像 (H, W, 3) uint8 C连续, ImageInfo)
+
+    Raises:
+        ImageTooLarge: 像素数超过上限
+    """
+    start = time.time()
+    if info is None:
+        info = probe(path, max_pixels)
+    target = _target_size(info.width, info.height, max_side)
+    pixels, bgr, factor = _read(path, info, target)
+    peak_bytes = pixels.nbytes
+    if target is not None and (pixels.shape[1], pixels.shape[0]) != target:
+        pixels = cv2.resize(pixels, target, interpolation=cv2.INTER_AREA)
+        peak_bytes += pixels.nbytes
+
+    ops = _ORIENTATION_OPS.get(info.orientation, [])
+    height, width = pixels.shape[:2]
+    if info.orientation in (5, 6, 7, 8):
+        height, width = width, height
+    output = buffer.get(height, width) if buffer is not None \
+        else np.empty((height, width, 3), np.uint8)
+    peak_bytes += output.nbytes
+
+    if ops:
+        if bgr:
+            cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB, dst=pixels)
+        op, arg = ops[0]
+        if arg is None:
+            op(pixels, dst=output)
+        else:
+            op(pixels, arg, dst=output)
+        for op, arg in ops[1:]:
+            op(output, arg, dst=output)
+    elif bgr:
+        cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB, dst=output)
+    else:
+        np.copyto(output, pixels)
+
+    elapsed = time.time() - start
+    stats.record(info.format, elapsed, peak_bytes, factor > 1)
+    logger.debug(f"Decoded {info.format} {info.width}x{info.height} -> "
+                 f"{width}x{height} in {elapsed * 1000.:.1f}ms (reduce 1/{factor})")
+    return output, info
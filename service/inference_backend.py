@@ -0,0 +1,450 @@
+"""
+推理后端抽象
+
+所有后端的接口相同：load()加载模型，run()对一批图像推理，capabilities()
+报告支持的能力。图像为uint8 [B, H, W, 3] RGB，mask为uint8 [1或B, H, W, 1]
+(0或255)，输出为RGB，bgr=True时输出BGR（可以直接cv2.imwrite）。
+debug='attention'时同一次推理还返回contextual attention的flow图像。
+
+    backend = create_backend('tensorflow', checkpoint_dir='model/')
+    result = backend.run(images, masks, quality='full', bgr=True)
+"""
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from config.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceBackend:
+    """推理后端基类"""
+
+    name = None
+
+    def load(self):
+        """加载模型，在第一次run之前调用"""
+        raise NotImplementedError
+
+    def capabilities(self):
+        """
+        Returns:
+            dict: name, qualities, max_batch, dynamic_shapes, input_size, device,
+                debug(支持的debug输出)
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def run(self, images, masks, quality='full', bgr=False, debug=None):
+        """
+        对一批图像推理
+
+        Args:
+            images: uint8 [B, H, W, 3] RGB
+            masks: uint8 [1, H, W, 1]（整批共用）或 [B, H, W, 1]
+            quality: 'full'或'preview'
+            bgr: 输出BGR通道顺序
+            debug: None，或capabilities()['debug']中的一项
+
+        Returns:
+            np.ndarray: uint8 [B, H, W, 3]；有debug时为(结果, debug图像)，
+                都是uint8 [B, H, W, 3]
+        """
+        images = np.asarray(images)
+        masks = np.asarray(masks)
+        capabilities = self.capabilities()
+        if quality not in capabilities['qualities']:
+            raise ValueError(f"Backend {self.name} does not support quality={quality}")
+        if debug is not None and debug not in capabilities.get('debug', ()):
+            raise ValueError(f"Backend {self.name} does not support debug={debug}")
+        if len(masks) == 1 or all(np.array_equal(masks[0], m) for m in masks[1:]):
+            return self._run_batch(images, masks[0], quality, bgr, debug)
+        # 模型要求整批共用一个mask，mask不同时逐张处理
+        results = [self._run_batch(images[i:i+1], masks[i], quality, bgr, debug)
+                   for i in range(len(images))]
+        if debug is None:
+            return np.concatenate(results)
+        return tuple(np.concatenate(r) for r in zip(*results))
+
+    def _run_batch(self, images, mask, quality, bgr, debug=None):
+        """images [B, H, W, 3]，共用mask [H, W, 1]"""
+        raise NotImplementedError
+
+
+class TensorFlowBackend(InferenceBackend):
+    """
+    基于neuralgym/TF 1.15图的后端
+
+    权重只从checkpoint读取一次；每个(batch, H, W, quality)构建一次图并缓存
+    会话，相同尺寸的请求直接复用。guided模型的边缘图在图中从输入图像计算。
+    full图中还有attention flow图像的输出，只在debug='attention'时计算。
+
+    Args:
+        guided: 是否为边缘引导模型，None时使用配置文件中的guided
+    """
+
+    name = 'tensorflow'
+
+    def __init__(self, checkpoint_dir='model/', config_path='inpaint.yml',
+                 thread_settings=None, max_graphs=4, guided=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.guided = guided
+        self.config_path = config_path
+        self.thread_settings = thread_settings
+        self.max_graphs = max_graphs
+        self.FLAGS = None
+        self.model = None
+        self._weights = {}
+        self._graphs = collections.OrderedDict()
+        # 正在推理的会话的引用计数；被淘汰时仍在使用的会话在最后一次推理结束后关闭
+        self._in_use = collections.Counter()
+        self._retired = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        import neuralgym as ng
+        from inpaint_model import InpaintCAModel
+
+        self.FLAGS = ng.Config(self.config_path)
+        if self.guided is not None:
+            self.FLAGS['guided'] = self.guided
+        self.model = InpaintCAModel()
+        if not os.path.exists(self.checkpoint_dir):
+            raise FileNotFoundError(f"Checkpoint not found: {self.checkpoint_dir}")
+        logger.info(f"TensorFlow backend ready (checkpoint={self.checkpoint_dir}, "
+                    f"guided={self.FLAGS.guided})")
+
+    def capabilities(self):
+        return {
+            'name': self.name,
+            'qualities': ('full', 'preview'),
+            'max_batch': None,
+            'dynamic_shapes': True,
+            'input_size': None,
+            'device': 'cpu/gpu',
+            'debug': ('attention',),
+        }
+
+    def close(self):
+        with self._lock:
+            for sess, _, _, _ in self._graphs.values():
+                self._release(sess)
+            self._graphs.clear()
+
+    def _release(self, sess):
+        """关闭不再缓存的会话，正在推理时推迟到推理结束(持有self._lock时调用)"""
+        if self._in_use[sess]:
+            self._retired.add(sess)
+        else:
+            sess.close()
+
+    def _variable(self, name):
+        """读取checkpoint中的变量（支持quantize_model.py生成的低精度模型），只读一次"""
+        from quantization import load_variable
+        if name not in self._weights:
+            self._weights[name] = load_variable(self.checkpoint_dir, name)
+        return self._weights[name]
+
+    def session_for(self, batch, height, width, quality='full', bgr=False):
+        """
+        获取(或构建)指定输入尺寸的会话
+
+        输入是uint8图像和单通道mask，不在图中嵌入任何常量，输出直接是uint8
+
+        Returns:
+            tuple: (sess, image_placeholder, mask_placeholder, output_tensor)，
+                输入名为'image'和'mask'，输出名为'output'，quality为full时
+                attention flow图像名为'attention'；会话可能在之后被淘汰关闭，
+                推理请用_run_batch
+        """
+        with self._lock:
+            return self._lookup(batch, height, width, quality, bgr)
+
+    @contextlib.contextmanager
+    def _using(self, batch, height, width, quality, bgr):
+        """在with块内持有会话，其他线程淘汰缓存时不会关闭它"""
+        with self._lock:
+            entry = self._lookup(batch, height, width, quality, bgr)
+            self._in_use[entry[0]] += 1
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                sess = entry[0]
+                self._in_use[sess] -= 1
+                if not self._in_use[sess]:
+                    del self._in_use[sess]
+                    if sess in self._retired:
+                        self._retired.discard(sess)
+                        sess.close()
+
+    def _lookup(self, batch, height, width, quality, bgr):
+        """session_for的实现，持有self._lock时调用"""
+        import tensorflow as tf
+        from service.thread_tuning import session_config
+
+        key = (batch, height, width, quality, bgr)
+        if key in self._graphs:
+            self._graphs.move_to_end(key)
+            return self._graphs[key]
+
+        graph = tf.Graph()
+        with graph.as_default():
+            image_ph = tf.placeholder(
+                tf.uint8, shape=(batch, height, width, 3), name='image')
+            mask_ph = tf.placeholder(
+                tf.uint8, shape=(1, height, width, 1), name='mask')
+            output = self.model.build_uint8_server_graph(
+                self.FLAGS, image_ph, mask_ph, quality=quality,
+                reverse_channels=bgr, attention=quality == 'full')
+            if quality == 'full':
+                output, attention = output
+                tf.identity(attention, name='attention')
+            output = tf.identity(output, name='output')
+            sess = tf.Session(
+                graph=graph, config=session_config(self.thread_settings))
+            for var in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+                var.load(self._variable(var.op.name), sess)
+        graph.finalize()
+        logger.info(f"Built inference graph for {key}")
+
+        self._graphs[key] = (sess, image_ph, mask_ph, output)
+        while len(self._graphs) > self.max_graphs:
+            _, (old_sess, _, _, _) = self._graphs.popitem(last=False)
+            self._release(old_sess)
+        return self._graphs[key]
+
+    def _run_batch(self, images, mask, quality, bgr, debug=None):
+        batch, height, width, _ = images.shape
+        if debug == 'attention' and quality != 'full':
+            raise ValueError("debug=attention needs quality=full")
+        with self._using(batch, height, width, quality, bgr) as (sess, image_ph, mask_ph, output):
+            if debug == 'attention':
+                # 同一次推理同时取出结果和flow图像
+                output = (output, sess.graph.get_tensor_by_name('attention:0'))
+            return sess.run(output, feed_dict={image_ph: images, mask_ph: mask[None]})
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    基于ONNX Runtime的CPU后端，模型由export_onnx.py导出
+
+    导出的模型输入尺寸固定，其他尺寸的图像先缩放到模型尺寸推理，再放大回
+    原尺寸并只在mask内合成。
+    """
+
+    name = 'onnxruntime'
+
+    def __init__(self, model_path='model/inpaint.onnx', thread_settings=None):
+        self.model_path = model_path
+        self.thread_settings = thread_settings
+        self.sessions = {}
+        self.input_size = None
+
+    @staticmethod
+    def preview_path(model_path):
+        root, ext = os.path.splitext(model_path)
+        return f"{root}_preview{ext}"
+
+    def load(self):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "The onnxruntime backend requires `pip install onnxruntime`")
+        options = ort.SessionOptions()
+        if self.thread_settings:
+            options.intra_op_num_threads = \
+                self.thread_settings['intra_op_parallelism_threads']
+            options.inter_op_num_threads = \
+                self.thread_settings['inter_op_parallelism_threads']
+        paths = {'full': self.model_path,
+                 'preview': self.preview_path(self.model_path)}
+        for quality, path in paths.items():
+            if os.path.exists(path):
+                self.sessions[quality] = ort.InferenceSession(
+                    path, sess_options=options,
+                    providers=['CPUExecutionProvider'])
+        if 'full' not in self.sessions:
+            raise FileNotFoundError(f"ONNX model not found: {self.model_path}")
+        shape = self.sessions['full'].get_inputs()[0].shape
+        self.input_size = (shape[1], shape[2])
+        logger.info(f"ONNX Runtime backend ready (model={self.model_path}, "
+                    f"input_size={self.input_size}, qualities={list(self.sessions)})")
+
+    def capabilities(self):
+        return {
+            'name': self.name,
+            'qualities': tuple(self.sessions),
+            'max_batch': 1,
+            'dynamic_shapes': False,
+            'input_size': self.input_size,
+            'device': 'cpu',
+            'debug': (),
+        }
+
+    def _run_batch(self, images, mask, quality, bgr, debug=None):
+        session = self.sessions[quality]
+        model_h, model_w = self.input_size
+        height, width = images.shape[1:3]
+        resized = (height, width) != (model_h, model_w)
+        if resized:
+            model_mask = cv2.resize(mask[:, :, 0], (model_w, model_h),
+                                    interpolation=cv2.INTER_NEAREST)[:, :, None]
+        else:
+            model_mask = mask
+
+        results = []
+        for image in images:
+            if resized:
+                image_in = cv2.resize(image, (model_w, model_h),
+                                      interpolation=cv2.INTER_AREA)
+            else:
+                image_in = image
+            result = session.run(None, {'image:0': image_in[None],
+                                        'mask:0': model_mask[None]})[0][0]
+            if resized:
+                result = cv2.resize(result, (width, height),
+                                    interpolation=cv2.INTER_CUBIC)
+                result = np.where(mask > 127, result, image)
+            results.append(result)
+        results = np.stack(results)
+        return np.ascontiguousarray(results[..., ::-1]) if bgr else results
+
+
+class OpenCVBackend(InferenceBackend):
+    """
+    基于cv2.inpaint的经典修复后端(Telea或Navier-Stokes)
+
+    不需要模型，耗时与mask面积成正比，比神经网络快几个数量级，但大面积
+    区域的纹理效果较差。用作过载时的降级路径，也适合很小的mask。
+    """
+
+    name = 'opencv'
+
+    METHODS = {
+        'telea': cv2.INPAINT_TELEA,
+        'ns': cv2.INPAINT_NS,
+    }
+
+    def __init__(self, method='telea', radius=3):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown cv2.inpaint method: {method}, "
+                             f"available: {sorted(self.METHODS)}")
+        self.method = method
+        self.radius = radius
+
+    def load(self):
+        logger.info(f"OpenCV backend ready (method={self.method}, radius={self.radius})")
+
+    def capabilities(self):
+        return {
+            'name': self.name,
+            'qualities': ('full', 'preview'),
+            'max_batch': None,
+            'dynamic_shapes': True,
+            'input_size': None,
+            'device': 'cpu',
+            'debug': (),
+        }
+
+    def _run_batch(self, images, mask, quality, bgr, debug=None):
+        mask = (mask[:, :, 0] > 127).astype(np.uint8)
+        # cv2.inpaint对每个通道独立处理，直接输入目标通道顺序，不需要额外转换
+        if bgr:
+            images = images[..., ::-1]
+        return np.stack([
+            cv2.inpaint(np.ascontiguousarray(image), mask, self.radius,
+                        self.METHODS[self.method])
+            for image in images])
+
+
+class StubBackend(InferenceBackend):
+    """
+    不做推理的后端，按设定的耗时等待后原样返回输入
+
+    用于压测(test/load_test.py)：在没有模型和TensorFlow的情况下单独测试HTTP和排队层。
+    耗时 = latency_ms + ms_per_megapixel * 批次总像素(百万)。
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency_ms=50., ms_per_megapixel=0.):
+        self.latency_ms = latency_ms
+        self.ms_per_megapixel = ms_per_megapixel
+
+    def load(self):
+        logger.info(f"Stub backend ready (latency_ms={self.latency_ms}, "
+                    f"ms_per_megapixel={self.ms_per_megapixel})")
+
+    def capabilities(self):
+        return {
+            'name': self.name,
+            'qualities': ('full', 'preview'),
+            'max_batch': None,
+            'dynamic_shapes': True,
+            'input_size': None,
+            'device': 'none',
+            'debug': (),
+        }
+
+    def _run_batch(self, images, mask, quality, bgr, debug=None):
+        megapixels = images.shape[0] * images.shape[1] * images.shape[2] / 1e6
+        time.sleep((self.latency_ms + self.ms_per_megapixel * megapixels) / 1000.)
+        if bgr:
+            return np.ascontiguousarray(images[..., ::-1])
+        return images.copy()
+
+
+BACKENDS = {
+    TensorFlowBackend.name: TensorFlowBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+    OpenCVBackend.name: OpenCVBackend,
+    StubBackend.name: StubBackend,
+}
+
+
+def create_backend(name, **kwargs):
+    """创建并加载后端"""
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown inference backend: {name}, "
+                         f"available: {sorted(BACKENDS)}")
+    backend = cls(**kwargs)
+    backend.load()
+    return backend
+
+
+def backend_from_config(checkpoint_dir=None, thread_settings=None):
+    """按Config.INFERENCE_BACKEND创建后端"""
+    name = Config.INFERENCE_BACKEND
+    if name == OnnxRuntimeBackend.name:
+        return create_backend(name, model_path=Config.ONNX_MODEL_PATH,
+                              thread_settings=thread_settings)
+    if name == TensorFlowBackend.name:
+        guided = None if Config.GUIDED_MODEL == '' else Config.GUIDED_MODEL == '1'
+        return create_backend(name, checkpoint_dir=checkpoint_dir or Config.MODEL_PATH,
+                              thread_settings=thread_settings, guided=guided)
+    if name == OpenCVBackend.name:
+        return classical_backend_from_config()
+    if name == StubBackend.name:
+        return create_backend(name, latency_ms=Config.STUB_LATENCY_MS,
+                              ms_per_megapixel=Config.STUB_MS_PER_MEGAPIXEL)
+    return create_backend(name)
+
+
+def classical_backend_from_config():
+    """按Config.CLASSICAL_INPAINT_*创建cv2.inpaint后端"""
+    return create_backend(OpenCVBackend.name,
+                          method=Config.CLASSICAL_INPAINT_METHOD,
+                          radius=Config.CLASSICAL_INPAINT_RADIUS)
@@ -0,0 +1,246 @@
+"""
+水印mask注册表
+
+启动时扫描 <MASK_DIR>/<水印类型>/<变体>/mask.png，变体目录名可以是
+landscape、portrait(兼容旧的potrait拼写)、square或任意名称，方向和纵横比
+从mask图像本身读取。每个模板预先计算二值化mask、包围盒和覆盖率，查询时
+选择纵横比最接近的变体，缩放结果按尺寸缓存。mask目录变化时自动重新加载。
+
+    registry = default_registry()
+    entry = registry.get('istock', 1024, 683)
+    entry.mask, entry.bbox, entry.coverage
+"""
+import collections
+import logging
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config.config import Config
+
+logger = logging.getLogger(__name__)
+
+MASK_FILENAME = 'mask.png'
+
+
+def orientation_of(width, height):
+    if width > height:
+        return 'landscape'
+    if width < height:
+        return 'portrait'
+    return 'square'
+
+
+def bounding_box(mask):
+    """
+    Returns:
+        tuple or None: 非0区域的(y0, y1, x0, x1)，mask为空时为None
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+class MaskTemplate:
+    """一个水印模板：原始分辨率的二值化mask及其几何信息"""
+
+    def __init__(self, watermark_type, variant, path):
+        self.watermark_type = watermark_type
+        self.variant = variant
+        self.path = path
+        mask = Image.open(path)
+        if mask.mode != 'L':
+            mask = mask.convert('L')
+        mask = np.array(mask)
+        self.mask = np.where(mask > 127, 255, 0).astype(np.uint8)
+        self.height, self.width = self.mask.shape
+        self.orientation = orientation_of(self.width, self.height)
+        self.aspect = self.width / float(self.height)
+        box = bounding_box(self.mask)
+        # 包围盒按相对坐标保存，缩放到任意尺寸时直接换算
+        self.bbox = None if box is None else (
+            box[0] / self.height, box[1] / self.height,
+            box[2] / self.width, box[3] / self.width)
+        self.coverage = float(np.count_nonzero(self.mask)) / self.mask.size
+
+    def describe(self):
+        return {
+            'variant': self.variant,
+            'orientation': self.orientation,
+            'size': [self.width, self.height],
+            'bbox': self.bbox,
+            'coverage': self.coverage,
+        }
+
+
+class MaskEntry:
+    """缩放到目标图像尺寸的mask"""
+
+    def __init__(self, template, mask, bbox, coverage):
+        self.template = template
+        self.mask = mask            # (h, w, 1) uint8 0/255，只读
+        self.bbox = bbox            # (y0, y1, x0, x1)，mask为空时为None
+        self.coverage = coverage    # mask占图像面积的比例
+
+
+class MaskRegistry:
+    """
+    水印mask注册表，线程安全
+
+    Args:
+        root: mask目录
+        reload_interval: 检查目录变化的最小间隔(秒)，0表示不自动重新加载
+        cache_size: 缩放结果的缓存数量
+    """
+
+    def __init__(self, root='utils', reload_interval=2., cache_size=32):
+        self.root = root
+        self.reload_interval = reload_interval
+        self.cache_size = cache_size
+        self._templates = {}
+        self._cache = collections.OrderedDict()
+        self._signature = None
+        self._checked_at = 0.
+        self._warned = set()
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _scan_signature(self):
+        """目录结构和mask文件修改时间的摘要，变化时需要重新加载"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            entries.append((dirpath, os.stat(dirpath).st_mtime_ns))
+            if MASK_FILENAME in filenames:
+                path = os.path.join(dirpath, MASK_FILENAME)
+                entries.append((path, os.stat(path).st_mtime_ns))
+        return tuple(entries)
+
+    def reload(self):
+        """重新扫描mask目录"""
+        templates = collections.defaultdict(list)
+        signature = self._scan_signature()
+        names = sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+        for watermark_type in names:
+            type_dir = os.path.join(self.root, watermark_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for variant in sorted(os.listdir(type_dir)):
+                path = os.path.join(type_dir, variant, MASK_FILENAME)
+                if not os.path.isfile(path):
+                    continue
+                try:
+                    templates[watermark_type].append(
+                        MaskTemplate(watermark_type, variant, path))
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to load mask {path}: {e}")
+        with self._lock:
+            self._templates = dict(templates)
+            self._cache.clear()
+            self._warned.clear()
+            self._signature = signature
+            self._checked_at = time.time()
+        logger.info(f"Mask registry loaded from {self.root}: " + ", ".join(
+            f"{t}({', '.join(m.variant for m in ms)})"
+            for t, ms in self._templates.items()))
+
+    def _maybe_reload(self):
+        if self.reload_interval <= 0 or \
+                time.time() - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = time.time()
+        try:
+            changed = self._scan_signature() != self._signature
+        except OSError:
+            changed = True
+        if changed:
+            logger.info("Mask directory changed, reloading")
+            self.reload()
+
+    def types(self):
+        self._maybe_reload()
+        return sorted(self._templates)
+
+    def describe(self):
+        self._maybe_reload()
+        return {t: [m.describe() for m in ms]
+                for t, ms in self._templates.items()}
+
+    def templates(self, watermark_type):
+        """一种水印类型的全部变体"""
+        self._maybe_reload()
+        templates = self._templates.get(watermark_type)
+        if not templates:
+            raise KeyError(f"Unknown watermark type: {watermark_type}")
+        return list(templates)
+
+    def template(self, watermark_type, width, height):
+        """选择纵横比最接近的模板，同方向的模板优先"""
+        self._maybe_reload()
+        templates = self._templates.get(watermark_type)
+        if not templates:
+            raise KeyError(f"Unknown watermark type: {watermark_type}")
+        orientation = orientation_of(width, height)
+        aspect = width / float(height)
+        best = min(templates, key=lambda m: (
+            m.orientation != orientation, abs(math.log(m.aspect / aspect))))
+        if best.orientation != orientation and \
+                (watermark_type, orientation) not in self._warned:
+            self._warned.add((watermark_type, orientation))
+            logger.warning(f"No {orientation} mask for {watermark_type}, "
+                           f"resizing the {best.variant} mask")
+        return best
+
+    def get(self, watermark_type, width, height):
+        """
+        获取缩放到图像尺寸的mask
+
+        Returns:
+            MaskEntry
+        """
+        template = self.template(watermark_type, width, height)
+        key = (template.path, width, height)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        mask = cv2.resize(template.mask, (width, height),
+                          interpolation=cv2.INTER_LINEAR)
+        mask = np.where(mask > 127, 255, 0).astype(np.uint8)[:, :, None]
+        mask.flags.writeable = False
+        if template.bbox is None:
+            bbox, coverage = None, 0.
+        else:
+            # 从模板的包围盒换算，扩展1像素覆盖插值误差，不需要扫描整张mask
+            y0, y1, x0, x1 = template.bbox
+            bbox = (max(0, int(y0 * height) - 1), min(height, int(math.ceil(y1 * height)) + 1),
+                    max(0, int(x0 * width) - 1), min(width, int(math.ceil(x1 * width)) + 1))
+            coverage = template.coverage
+        entry = MaskEntry(template, mask, bbox, coverage)
+        with self._lock:
+            self._cache[key] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+
+_default_registry = None
+_default_lock = threading.Lock()
+
+
+def default_registry():
+    """按Config.MASK_DIR创建的全局注册表"""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = MaskRegistry(
+                Config.MASK_DIR, reload_interval=Config.MASK_RELOAD_INTERVAL)
+        return _default_registry
@@ -0,0 +1,158 @@
+"""
+推理调度：按优先级通道加权公平地分配推理
+
+所有推理共用一个模型和同一组线程，一次只运行一个任务。以前视频在整个处理
+期间持有服务锁，图像请求要等几分钟。调度器把任务分到通道(image、video)，
+每个通道有权重，空闲后按加权公平排队(start-time fair queuing)授予下一个
+推理槽位：
+
+    每个通道有虚拟时间，任务结束时加上 耗时/权重
+    授予虚拟时间最小的通道中最早排队的任务，相同时先声明的通道优先
+    通道从空闲变为活跃时，虚拟时间提升到当前授予的任务的起点，
+    空闲期间不积累额度
+
+视频每批帧申请一次槽位，批之间让出推理，图像请求最多等待一批。两个通道都
+有任务时按权重分配推理时间，例如image=4、video=1时视频仍能得到约1/5。
+
+    scheduler = Scheduler({'image': 4., 'video': 1.})
+    with scheduler.slot('video', token):
+        backend.run(frames, mask)
+
+排队时传入CancelToken，任务被取消、超过期限或客户端断开时离开队列并抛出
+Cancelled，不占用推理。
+"""
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from config.config import Config
+from service.cancellation import Cancelled
+
+logger = logging.getLogger(__name__)
+
+# 排队时检查取消(客户端断开)的间隔(秒)
+POLL_INTERVAL_S = 0.25
+
+
+class Lane:
+    """一个优先级通道：权重、排队的任务和统计"""
+
+    def __init__(self, name, weight):
+        if weight <= 0:
+            raise ValueError(f"Lane {name} needs a positive weight, got {weight}")
+        self.name = name
+        self.weight = float(weight)
+        self.waiting = collections.deque()
+        self.vtime = 0.
+        self.jobs = 0
+        self.busy_s = 0.
+        self.wait_s = 0.
+        self.max_wait_s = 0.
+        self.cancelled = 0
+
+    def describe(self):
+        return {
+            'weight': self.weight,
+            'waiting': len(self.waiting),
+            'jobs': self.jobs,
+            'busy_s': self.busy_s,
+            'mean_wait_ms': self.wait_s / self.jobs * 1000. if self.jobs else 0.,
+            'max_wait_ms': self.max_wait_s * 1000.,
+            'cancelled': self.cancelled,
+        }
+
+
+class Scheduler:
+    """
+    加权公平的推理调度器，线程安全
+
+    Args:
+        weights: {通道名: 权重}，权重越大分到的推理时间越多，
+            相同条件下先列出的通道优先
+    """
+
+    def __init__(self, weights):
+        self.lanes = collections.OrderedDict(
+            (name, Lane(name, weight)) for name, weight in weights.items())
+        self._order = {name: i for i, name in enumerate(self.lanes)}
+        self._holder = None
+        self._clock = 0.
+        self._cond = threading.Condition()
+
+    def _next(self):
+        """下一个获得槽位的任务，没有排队的任务时为None"""
+        lanes = [lane for lane in self.lanes.values() if lane.waiting]
+        if not lanes:
+            return None
+        lane = min(lanes, key=lambda l: (l.vtime, self._order[l.name]))
+        return lane.waiting[0]
+
+    @contextlib.contextmanager
+    def slot(self, lane, token=None):
+        """
+        等待并持有推理槽位；同一通道内按排队顺序授予
+
+        Args:
+            lane: 通道名
+            token: CancelToken，排队期间被取消时离开队列
+
+        Raises:
+            KeyError: 未知的通道
+            Cancelled: 排队期间任务被取消
+        """
+        lane = self.lanes[lane]
+        ticket = object()
+        queued_at = time.time()
+        with self._cond:
+            if not lane.waiting:
+                lane.vtime = max(lane.vtime, self._clock)
+            lane.waiting.append(ticket)
+            while True:
+                if token is not None and token.reason is not None:
+                    lane.waiting.remove(ticket)
+                    lane.cancelled += 1
+                    # 可能轮到其他通道
+                    self._cond.notify_all()
+                    raise Cancelled(token.reason)
+                if self._holder is None and self._next() is ticket:
+                    break
+                self._cond.wait(None if token is None else self._poll_timeout(token))
+            lane.waiting.popleft()
+            self._holder = ticket
+            self._clock = lane.vtime
+        started = time.time()
+        wait_s = started - queued_at
+        try:
+            yield
+        finally:
+            with self._cond:
+                elapsed = time.time() - started
+                lane.vtime += elapsed / lane.weight
+                lane.jobs += 1
+                lane.busy_s += elapsed
+                lane.wait_s += wait_s
+                lane.max_wait_s = max(lane.max_wait_s, wait_s)
+                self._holder = None
+                self._cond.notify_all()
+
+    @staticmethod
+    def _poll_timeout(token):
+        remaining = token.remaining_s()
+        if remaining is None:
+            return POLL_INTERVAL_S
+        return min(POLL_INTERVAL_S, remaining + 0.001)
+
+    def summary(self):
+        """每个通道的权重、排队数、完成的槽位数、推理时间、等待时间和排队时取消的任务数"""
+        with self._cond:
+            return {name: lane.describe() for name, lane in self.lanes.items()}
+
+
+def scheduler_from_config():
+    """按Config创建图像和视频两个通道的调度器"""
+    weights = {'image': Config.IMAGE_LANE_WEIGHT, 'video': Config.VIDEO_LANE_WEIGHT}
+    logger.info("Inference scheduler: " +
+                ", ".join(f"{name}={weight}" for name, weight in weights.items()))
+    return Scheduler(weights)
@@ -0,0 +1,283 @@
+"""
+TensorFlow CPU线程配置的自动调优
+
+每组候选配置(intra/inter线程池, OpenMP/MKL环境变量)在独立子进程中运行一次
+代表性推理并计时，最优配置按主机类型保存到JSON文件，之后所有会话都使用它。
+OpenMP/MKL环境变量必须在导入TensorFlow之前设置，所以本模块不在顶层导入TF。
+
+用法:
+    python -m service.thread_tuning --tune
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from config.config import Config
+
+logger = logging.getLogger(__name__)
+
+# 由调优结果控制的环境变量
+ENV_KEYS = {
+    'omp_num_threads': 'OMP_NUM_THREADS',
+    'mkl_num_threads': 'MKL_NUM_THREADS',
+    'kmp_blocktime': 'KMP_BLOCKTIME',
+    'kmp_affinity': 'KMP_AFFINITY',
+}
+
+
+def available_cpus():
+    """容器内实际可用的CPU数（考虑亲和性和cgroup配额）"""
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    quota = None
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            q, period = f.read().split()
+            if q != 'max':
+                quota = int(q) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                q = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if q > 0:
+                quota = q / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        n = min(n, max(1, int(math.ceil(quota))))
+    return n
+
+
+def host_key():
+    """主机类型标识：架构-CPU型号-可用CPU数"""
+    model = platform.processor() or 'unknown'
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f"{platform.machine()}-{model}-{available_cpus()}cpu"
+
+
+def candidate_settings(n_cpus=None):
+    """生成候选配置"""
+    n = n_cpus or available_cpus()
+    intra_options = sorted({n, max(1, n // 2)}, reverse=True)
+    candidates = []
+    for intra in intra_options:
+        for inter in sorted({1, 2} if n > 1 else {1}):
+            for blocktime in (0, 1):
+                candidates.append({
+                    'intra_op_parallelism_threads': intra,
+                    'inter_op_parallelism_threads': inter,
+                    'omp_num_threads': intra,
+                    'mkl_num_threads': intra,
+                    'kmp_blocktime': blocktime,
+                    'kmp_affinity': 'granularity=fine,compact,1,0',
+                })
+    return candidates
+
+
+def load_settings(path=None, key=None):
+    """读取当前主机类型已保存的最优配置，没有时返回None"""
+    path = path or Config.THREAD_TUNING_FILE
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    entry = data.get(key or host_key())
+    return entry['best'] if entry else None
+
+
+def save_settings(best, trials, path=None, key=None):
+    path = path or Config.THREAD_TUNING_FILE
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[key or host_key()] = {
+        'best': best,
+        'trials': trials,
+        'tuned_at': time.time(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def apply_environment(settings):
+    """在导入TensorFlow之前设置OpenMP/MKL环境变量，用户显式设置的变量优先"""
+    if not settings:
+        return
+    for key, env in ENV_KEYS.items():
+        if key in settings and env not in os.environ:
+            os.environ[env] = str(settings[key])
+
+
+def session_config(settings=None):
+    """
+    创建会话配置，所有tf.Session都应使用它
+
+    Args:
+        settings: 调优配置，None时读取已保存的配置
+
+    Returns:
+        tf.ConfigProto
+    """
+    import tensorflow as tf
+    if settings is None:
+        settings = load_settings()
+    sess_config = tf.ConfigProto()
+    sess_config.gpu_options.allow_growth = True
+    if settings:
+        sess_config.intra_op_parallelism_threads = \
+            settings['intra_op_parallelism_threads']
+        sess_config.inter_op_parallelism_threads = \
+            settings['inter_op_parallelism_threads']
+    return sess_config
+
+
+def run_trial(settings, height, width, runs):
+    """
+    在当前进程中对一组配置计时（由autotune在子进程中调用）
+
+    使用随机初始化的权重，计算量和真实模型相同，不需要checkpoint
+    """
+    import numpy as np
+    import tensorflow as tf
+    import neuralgym as ng
+    from inpaint_model import InpaintCAModel
+    from preprocess_image import load_mask_channel
+
+    FLAGS = ng.Config('inpaint.yml')
+    image = np.random.randint(0, 255, (1, height, width, 3), dtype=np.uint8)
+    mask = load_mask_channel('istock', width, height)[None]
+    with tf.Session(config=session_config(settings)) as sess:
+        image_ph = tf.placeholder(tf.uint8, shape=image.shape)
+        mask_ph = tf.placeholder(tf.uint8, shape=mask.shape)
+        output = InpaintCAModel().build_uint8_server_graph(
+            FLAGS, image_ph, mask_ph)
+        sess.run(tf.global_variables_initializer())
+        feed = {image_ph: image, mask_ph: mask}
+        sess.run(output, feed_dict=feed)
+        latencies = []
+        for _ in range(runs):
+            t = time.time()
+            sess.run(output, feed_dict=feed)
+            latencies.append((time.time() - t) * 1000.)
+    return latencies
+
+
+def autotune(height=512, width=680, runs=3, path=None):
+    """
+    对所有候选配置计时，保存并返回最优配置
+
+    Returns:
+        dict: 最优配置
+    """
+    key = host_key()
+    trials = []
+    for settings in candidate_settings():
+        env = dict(os.environ)
+        for k, name in ENV_KEYS.items():
+            env[name] = str(settings[k])
+        cmd = [sys.executable, '-m', 'service.thread_tuning', '--trial',
+               json.dumps(settings), '--height', str(height),
+               '--width', str(width), '--runs', str(runs)]
+        trial = dict(settings)
+        try:
+            out = subprocess.run(cmd, env=env, check=True,
+                                 stdout=subprocess.PIPE, timeout=1800)
+            latencies = json.loads(out.stdout.decode().strip().splitlines()[-1])
+            trial['mean_latency_ms'] = sum(latencies) / len(latencies)
+            trial['min_latency_ms'] = min(latencies)
+        except (subprocess.SubprocessError, ValueError, IndexError) as e:
+            logger.warning(f"Thread tuning trial failed {settings}: {e}")
+            trial['error'] = str(e)
+        logger.info(f"Thread tuning trial: {trial}")
+        trials.append(trial)
+
+    ok = [t for t in trials if 'mean_latency_ms' in t]
+    if not ok:
+        raise RuntimeError("All thread tuning trials failed")
+    best = min(ok, key=lambda t: t['mean_latency_ms'])
+    save_settings(best, trials, path=path, key=key)
+    logger.info(f"Best thread settings for {key}: {best}")
+    return best
+
+
+def format_report(trials):
+    lines = ['intra inter blocktime   mean_ms    min_ms']
+    for t in trials:
+        if 'error' in t:
+            lines.append('{:>5} {:>5} {:>9}   failed: {}'.format(
+                t['intra_op_parallelism_threads'],
+                t['inter_op_parallelism_threads'], t['kmp_blocktime'],
+                t['error']))
+        else:
+            lines.append('{:>5} {:>5} {:>9} {:>9.1f} {:>9.1f}'.format(
+                t['intra_op_parallelism_threads'],
+                t['inter_op_parallelism_threads'], t['kmp_blocktime'],
+                t['mean_latency_ms'], t['min_latency_ms']))
+    return '\n'.join(lines)
+
+
+def startup():
+    """
+    进程启动时调用（在导入TensorFlow之前）：应用已保存的配置，
+    THREAD_AUTOTUNE=1时对尚未调优的主机类型先调优，=force时总是重新调优
+    """
+    settings = load_settings()
+    mode = Config.THREAD_AUTOTUNE
+    if mode == 'force' or (mode == '1' and settings is None):
+        try:
+            settings = autotune()
+        except Exception as e:
+            logger.error(f"Thread autotune failed: {e}")
+    apply_environment(settings)
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tune', action='store_true',
+                        help='Benchmark all candidates and persist the best.')
+    parser.add_argument('--trial', default='', type=str,
+                        help='Internal: time one JSON encoded candidate.')
+    parser.add_argument('--height', default=512, type=int)
+    parser.add_argument('--width', default=680, type=int)
+    parser.add_argument('--runs', default=3, type=int)
+    args = parser.parse_args()
+
+    if args.trial:
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+        print(json.dumps(run_trial(json.loads(args.trial), args.height,
+                                   args.width, args.runs)))
+    elif args.tune:
+        logging.basicConfig(level=logging.INFO)
+        best = autotune(args.height, args.width, args.runs)
+        with open(Config.THREAD_TUNING_FILE) as f:
+            trials = json.load(f)[host_key()]['trials']
+        print('Host: {}'.format(host_key()))
+        print(format_report(trials))
+        print('Best: {}'.format(best))
+    else:
+        print('Host: {}'.format(host_key()))
+        print('Settings: {}'.format(load_settings()))
@@ -0,0 +1,189 @@
+"""
+水印定位和存在性检测
+
+在缩小后的图像上，用mask注册表中各水印模板的字形做多尺度匹配，得到水印
+类型、位置和尺度。水印通常是半透明的浅色叠加层，匹配分数是高通滤波后字形
+内部与字形外一圈的平均亮度差，再除以这一范围内的平均起伏，和图像本身的
+对比度无关。匹配成功时把模板放到匹配位置生成紧凑的mask；没有匹配时返回
+None，调用方可以跳过推理直接返回原图。
+"""
+import logging
+import math
+
+import cv2
+import numpy as np
+
+from service.mask_registry import MaskEntry, bounding_box
+
+logger = logging.getLogger(__name__)
+
+
+class Detection(MaskEntry):
+    """检测结果，同时可以作为MaskEntry使用"""
+
+    def __init__(self, template, mask, bbox, coverage, score, scale):
+        super().__init__(template, mask, bbox, coverage)
+        self.watermark_type = template.watermark_type
+        self.score = score      # 字形内外的归一化亮度差
+        self.scale = scale      # 原图上的水印尺寸 / 模板包围盒尺寸
+
+    def describe(self):
+        return {
+            'watermark_type': self.watermark_type,
+            'variant': self.template.variant,
+            'score': self.score,
+            'scale': self.scale,
+            'bbox': self.bbox,
+            'coverage': self.coverage,
+        }
+
+
+def highpass(gray, sigma=6.):
+    """去掉低频的光照变化，只保留水印这种尺度的细节"""
+    gray = gray.astype(np.float32)
+    return gray - cv2.GaussianBlur(gray, (0, 0), sigma)
+
+
+def _correlate(image, kernel):
+    """以kernel左上角为锚点的相关，只保留kernel完全落在图像内的位置"""
+    h, w = kernel.shape
+    result = cv2.filter2D(image, -1, kernel, anchor=(0, 0),
+                          borderType=cv2.BORDER_CONSTANT)
+    return result[:image.shape[0] - h + 1, :image.shape[1] - w + 1]
+
+
+class WatermarkDetector:
+    """
+    Args:
+        registry: MaskRegistry
+        detect_side: 匹配时图像最长边的尺寸
+        threshold: 判定为有水印的最低分数
+        scales: 相对于"模板拉伸到整张图"时尺度的搜索倍率，默认0.51~1.33按10%递增，包含1(水印随图像一起缩放)
+        ring: 字形外参与比较的一圈的宽度(检测分辨率)，也决定了能容忍的尺度误差
+        dilate: 生成的mask向外扩展的像素数(原图分辨率)
+    """
+
+    def __init__(self, registry, detect_side=512, threshold=0.7,
+                 scales=tuple(1.1 ** i for i in range(-7, 4)),
+                 ring=3, dilate=3):
+        self.registry = registry
+        self.detect_side = detect_side
+        self.threshold = threshold
+        self.scales = scales
+        self.ring = ring
+        self.dilate = dilate
+        self._crops = {}
+
+    def _crop(self, template):
+        """模板包围盒内的字形（按模板路径缓存，重新加载后模板对象会变化）"""
+        cached = self._crops.get(template.path)
+        if cached is not None and cached[0] is template:
+            return cached[1]
+        height, width = template.mask.shape
+        y0, y1, x0, x1 = template.bbox
+        crop = template.mask[int(y0 * height):int(math.ceil(y1 * height)),
+                             int(x0 * width):int(math.ceil(x1 * width))]
+        self._crops[template.path] = (template, crop)
+        return crop
+
+    def _kernels(self, crop, w, h):
+        """缩放后的字形内外差分核，以及归一化用的平均核"""
+        glyph = (cv2.resize(crop, (w, h), interpolation=cv2.INTER_AREA) > 127)
+        glyph = glyph.astype(np.uint8)
+        size = 2 * self.ring + 1
+        ring = cv2.dilate(glyph, np.ones((size, size), np.uint8)) - glyph
+        inside, outside = glyph.sum(), ring.sum()
+        if inside == 0 or outside == 0:
+            return None, None
+        contrast = glyph / float(inside) - ring / float(outside)
+        support = (glyph | ring) / float(inside + outside)
+        return contrast.astype(np.float32), support.astype(np.float32)
+
+    def _match(self, detail, template, base_scale):
+        """
+        在高通图上对一个模板做多尺度匹配
+
+        Returns:
+            tuple: (score, scale, (x, y))，尺度和位置都在检测分辨率下
+        """
+        crop = self._crop(template)
+        magnitude = np.abs(detail)
+        best = (-1., None, None)
+        for factor in self.scales:
+            scale = base_scale * factor
+            w = int(round(crop.shape[1] * scale))
+            h = int(round(crop.shape[0] * scale))
+            if w < 8 or h < 8 or w > detail.shape[1] or h > detail.shape[0]:
+                continue
+            contrast, support = self._kernels(crop, w, h)
+            if contrast is None:
+                continue
+            # 亮度差除以同一范围内的平均起伏(+1避免纯色区域除0)
+            result = _correlate(detail, contrast) / \
+                (_correlate(magnitude, support) + 1.)
+            _, score, _, loc = cv2.minMaxLoc(result)
+            if score > best[0]:
+                best = (float(score), scale, loc)
+        return best
+
+    def detect(self, image, watermark_types=None):
+        """
+        检测水印
+
+        Args:
+            image: RGB图像 (H, W, 3), uint8
+            watermark_types: 候选水印类型，None表示注册表中的所有类型
+
+        Returns:
+            Detection or None: 没有匹配时为None
+        """
+        image_h, image_w = image.shape[:2]
+        ratio = min(1., self.detect_side / float(max(image_h, image_w)))
+        small = cv2.resize(image, (max(1, int(image_w * ratio)),
+                                   max(1, int(image_h * ratio))),
+                           interpolation=cv2.INTER_AREA)
+        detail = highpass(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY))
+        small_h, small_w = detail.shape
+
+        best = None
+        for watermark_type in watermark_types or self.registry.types():
+            template = self.registry.template(watermark_type, image_w, image_h)
+            if template.bbox is None:
+                continue
+            # 模板拉伸到整张图时的尺度，水印通常按等比缩放，取几何平均
+            base_scale = math.sqrt(small_w / float(template.width) *
+                                   small_h / float(template.height))
+            score, scale, loc = self._match(detail, template, base_scale)
+            logger.debug(f"Watermark {watermark_type}/{template.variant}: "
+                         f"score={score:.3f} scale={scale}")
+            if scale is not None and (best is None or score > best[0]):
+                best = (score, scale, loc, template)
+
+        if best is None or best[0] < self.threshold:
+            logger.info(f"No watermark detected (best score "
+                        f"{best[0] if best else float('nan'):.3f})")
+            return None
+        return self._place(best, ratio, image_w, image_h)
+
+    def _place(self, best, ratio, image_w, image_h):
+        """把匹配到的模板放回原图分辨率，生成mask"""
+        score, scale, (x, y), template = best
+        crop = self._crop(template)
+        full_scale = scale / ratio
+        w = max(1, int(round(crop.shape[1] * full_scale)))
+        h = max(1, int(round(crop.shape[0] * full_scale)))
+        x0, y0 = int(round(x / ratio)), int(round(y / ratio))
+        x1, y1 = min(image_w, x0 + w), min(image_h, y0 + h)
+        placed = cv2.resize(crop, (w, h), interpolation=cv2.INTER_LINEAR)
+        mask = np.zeros((image_h, image_w), np.uint8)
+        mask[y0:y1, x0:x1] = placed[:y1 - y0, :x1 - x0]
+        if self.dilate > 0:
+            size = 2 * self.dilate + 1
+            mask = cv2.dilate(mask, np.ones((size, size), np.uint8))
+        mask = np.where(mask > 127, 255, 0).astype(np.uint8)[:, :, None]
+        mask.flags.writeable = False
+        coverage = float(np.count_nonzero(mask)) / mask.size
+        detection = Detection(template, mask, bounding_box(mask[:, :, 0]),
+                              coverage, score, full_scale)
+        logger.info(f"Watermark detected: {detection.describe()}")
+        return detection
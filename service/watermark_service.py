@@ -1,52 +1,131 @@
 import os
 import cv2
 import numpy as np
-import tensorflow as tf
-import neuralgym as ng
-from PIL import Image
 import logging
 import threading
 import time
 import tempfile
 import shutil
 import json
-import moviepy.editor as mp
 
-from preprocess_image import preprocess_image
-from inpaint_model import InpaintCAModel
+from config.config import Config
+from service import highres
+from service import thread_tuning
+from service.cancellation import Cancelled, JobRegistry
+from service.cost_model import JobTooLarge, Overloaded, admission_from_config
+from service.image_decode import ImageBuffer, decode_image, probe
+from service.mask_registry import default_registry
+from service.scheduler import scheduler_from_config
+from service.watermark_detector import WatermarkDetector
+from service.inference_backend import backend_from_config, classical_backend_from_config
 
 logger = logging.getLogger(__name__)
 
 class WatermarkRemovalService:
     """基于原始main.py逻辑的水印去除服务类"""
 
+    # 与inpaint_model.QUALITY_LEVELS相同，这里不导入模型(TensorFlow)
+    QUALITY_LEVELS = ('full', 'preview')
+    # neural为神经网络模型，classical为cv2.inpaint降级路径，auto按mask大小和排队时间选择
+    ENGINES = ('auto', 'neural', 'classical')
+    # watermark_type为auto时在所有水印类型中检测
+    AUTO_TYPE = 'auto'
+    # attention: 同一次推理输出contextual attention的flow图像
+    DEBUG_OPTIONS = ('attention',)
+
     def __init__(self):
-        self.FLAGS = None
-        self.model = None
-        self.checkpoint_dir = 'model/'
-        self._lock = threading.Lock()
-        self.sess = None
-        self.output_tensor = None
-        self.input_placeholder = None
-        self._load_config()
-        logger.info("WatermarkRemovalService initialized")
-
-    def _load_config(self):
-        """加载配置文件 - 基于原始main.py第26-30行"""
-        try:
-            # 设置TensorFlow日志级别
-            os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-            
-            # 加载配置，就像原始main.py第26行
-            self.FLAGS = ng.Config('inpaint.yml')
-            # 创建模型实例，就像原始main.py第30行
-            self.model = InpaintCAModel()
-            logger.info("Model configuration loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load config: {e}")
-            raise e
+        self.checkpoint_dir = Config.MODEL_PATH
+        # 图像和视频按通道加权公平地共享推理，视频每批帧之间让出
+        self.scheduler = scheduler_from_config()
+        # 进行中的任务(task_id -> CancelToken)，供取消接口使用
+        self.jobs = JobRegistry()
+        self._backend_lock = threading.Lock()
+        # 推理后端（Config.INFERENCE_BACKEND），第一次推理时加载
+        self.backend = None
+        self.classical_backend = None
+        # 自动调优得到的线程配置，应用到所有会话
+        self.thread_settings = thread_tuning.load_settings()
+        # 水印mask注册表，启动时加载所有水印类型，目录变化时自动重新加载
+        self.masks = default_registry()
+        # 图像解码缓冲区，图像处理在image通道的槽位内串行进行，所有请求复用同一个
+        self._decode_buffer = ImageBuffer()
+        # 水印定位：在缩小的图像上匹配模板，得到紧凑的mask，没有水印时跳过推理
+        self.detector = WatermarkDetector(
+            self.masks, detect_side=Config.DETECT_SIDE,
+            threshold=Config.DETECT_THRESHOLD)
+        # 准入控制：按预测的峰值内存决定处理方式，排队过长时拒绝
+        self.admission = admission_from_config()
+        # TensorFlow在第一次推理时才导入，导入前设置日志级别
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+        logger.info(f"WatermarkRemovalService initialized "
+                    f"(backend={Config.INFERENCE_BACKEND}, checkpoint={self.checkpoint_dir})")
+
+    def _get_backend(self):
+        """加载推理后端（只加载一次，之后所有请求复用）"""
+        if self.backend is None:
+            with self._backend_lock:
+                if self.backend is None:
+                    self.backend = backend_from_config(
+                        checkpoint_dir=self.checkpoint_dir,
+                        thread_settings=self.thread_settings)
+                    logger.info(f"Inference backend loaded: {self.backend.capabilities()}")
+        return self.backend
+
+    def load_backend(self):
+        """加载并返回推理后端，供批处理和目录监听(watch_folder.py)复用同一个后端"""
+        return self._get_backend()
 
-    def process_image(self, input_path, output_path, watermark_type='istock'):
+    def debug_options(self):
+        """推理后端支持的debug输出"""
+        return tuple(d for d in self._get_backend().capabilities().get('debug', ())
+                     if d in self.DEBUG_OPTIONS)
+
+    def _get_classical_backend(self):
+        if self.classical_backend is None:
+            with self._backend_lock:
+                if self.classical_backend is None:
+                    self.classical_backend = classical_backend_from_config()
+        return self.classical_backend
+
+    def _select_engine(self, coverage, queue_ms):
+        """
+        engine=auto时选择引擎：排队时间超过SLO或mask很小时使用经典修复，
+        过载时降级而不是让请求失败
+
+        Args:
+            coverage: mask占图像面积的比例
+            queue_ms: 请求的排队时间
+        """
+        slo_ms = Config.QUEUE_LATENCY_SLO_MS
+        if slo_ms > 0 and queue_ms > slo_ms:
+            logger.info(f"Queue latency {queue_ms:.0f}ms over SLO {slo_ms:.0f}ms, "
+                        f"using classical inpainting")
+            return 'classical'
+        max_ratio = Config.CLASSICAL_MAX_MASK_RATIO
+        if max_ratio > 0:
+            if coverage <= max_ratio:
+                logger.info(f"Mask covers {coverage:.4%} of the image, "
+                            f"using classical inpainting")
+                return 'classical'
+        return 'neural'
+
+    def _locate(self, image, watermark_type, detect):
+        """
+        获取图像的mask：检测时用匹配到的位置和尺度生成紧凑的mask，
+        否则把水印类型的模板缩放到整张图
+
+        Returns:
+            MaskEntry or None: 检测不到水印时为None
+        """
+        if not detect and watermark_type != self.AUTO_TYPE:
+            image_h, image_w = image.shape[:2]
+            return self.masks.get(watermark_type, image_w, image_h)
+        types = None if watermark_type == self.AUTO_TYPE else [watermark_type]
+        return self.detector.detect(image, types)
+
+    def process_image(self, input_path, output_path, watermark_type='istock',
+                      quality='full', engine='auto', detect=None, info=None,
+                      debug=None, debug_path=None, token=None):
         """
         处理图像去水印 - 完全基于原始main.py的逻辑
         
@@ -54,80 +133,167 @@ class WatermarkRemovalService:
             input_path: 输入图像路径
             output_path: 输出图像路径  
             watermark_type: 水印类型
+            quality: 'full'为完整两阶段结果，'preview'只运行第一阶段用于快速预览
+            engine: 'neural'、'classical'(cv2.inpaint)或'auto'
+            detect: 先定位水印，没有水印时直接输出原图；None时使用
+                Config.WATERMARK_DETECTION。watermark_type为auto时总是检测
+            info: 已读取的图像文件头(image_decode.probe)，None时在这里读取
+            debug: 'attention'时把attention flow图像写到debug_path，只用神经
+                网络引擎和full质量，engine为auto时使用neural
+            token: CancelToken，在排队、解码、检测和每个块之间检查
             
         Returns:
-            bool: 处理是否成功
+            str or None: 实际使用的引擎('neural'或'classical')，没有检测到
+                水印时为'none'，失败时为None
+
+        Raises:
+            JobTooLarge: 缩小或分块后仍超过内存预算
+            Overloaded: 排队的任务过多
+            Cancelled: 任务被取消、超过期限或客户端断开，不写输出
         """
+        if detect is None:
+            detect = Config.WATERMARK_DETECTION == '1'
+        if debug is not None and engine == 'auto':
+            engine = 'neural'
+        queued_at = time.time()
         try:
-            with self._lock:  # 确保线程安全
-                logger.info(f"Processing image: {input_path}")
-                
-                # 步骤1: 加载和预处理图像 (就像main.py第31-32行)
-                image = Image.open(input_path)
-                input_image = preprocess_image(image, watermark_type)
-                
-                # 步骤2: 检查预处理结果 (就像main.py第37行)
-                if input_image.shape == (0,):
-                    logger.error("Image preprocessing failed - unsupported size")
-                    return False
-                
-                # 步骤3: 重置默认图 (就像main.py第33行)
-                tf.reset_default_graph()
-                
-                # 步骤4: 创建会话配置 (就像main.py第35-36行)
-                sess_config = tf.ConfigProto()
-                sess_config.gpu_options.allow_growth = True
-                
-                # 步骤5: 在会话中执行所有操作 (就像main.py第38-58行)
-                with tf.Session(config=sess_config) as sess:
-                    # 将输入图像转换为TensorFlow常量 (第39行)
-                    input_image_tensor = tf.constant(input_image, dtype=tf.float32)
-                    
-                    # 构建服务器图 (第40行)
-                    output = self.model.build_server_graph(self.FLAGS, input_image_tensor)
-                    
-                    # 后处理输出 (第41-43行)
-                    output = (output + 1.) * 127.5
-                    output = tf.reverse(output, [-1])
-                    output = tf.saturate_cast(output, tf.uint8)
-                    
-                    # 加载预训练模型 (第44-53行)
-                    vars_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-                    assign_ops = []
-                    for var in vars_list:
-                        vname = var.name
-                        from_name = vname
-                        try:
-                            var_value = tf.contrib.framework.load_variable(
-                                self.checkpoint_dir, from_name
-                            )
-                            assign_ops.append(tf.assign(var, var_value))
-                        except Exception as e:
-                            logger.warning(f"Could not load variable {vname}: {e}")
-                    
-                    # 运行变量赋值 (第53行)
-                    sess.run(assign_ops)
-                    logger.info('Model loaded for this inference')
-                    
-                    # 执行推理 (第55行)
-                    result = sess.run(output)
-                    
-                    # 保存结果 (第56-57行)
-                    cv2.imwrite(output_path, cv2.cvtColor(
-                        result[0][:, :, ::-1], cv2.COLOR_BGR2RGB
-                    ))
+            if info is None:
+                info = probe(input_path)
+            # 按文件头中的尺寸估计耗时，计入排队的工作量
+            estimate = self.admission.estimate(
+                info.height, info.width, 'classical' if engine == 'classical' else 'neural',
+                Config.MAX_WORKING_SIDE)
+            if token is not None:
+                token.check()
+            with self.admission.queued(estimate), self.scheduler.slot('image', token):
+                queue_ms = (time.time() - queued_at) * 1000.
+
+                # 步骤1: 加载图像，按EXIF方向转正，超过MAX_DECODE_SIDE时缩小解码
+                image, info = decode_image(input_path, max_side=Config.MAX_DECODE_SIDE,
+                                           buffer=self._decode_buffer, info=info)
+                image_h, image_w = image.shape[:2]
+                if token is not None:
+                    token.check()
+
+                # 步骤2: 获取mask，检测不到水印时不需要推理
+                entry = self._locate(image, watermark_type, detect)
+                if token is not None:
+                    token.check()
+                if entry is None:
+                    cv2.imwrite(output_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+                    logger.info(f"No watermark in {input_path}, returning the input image")
+                    return 'none'
+
+                if engine == 'auto':
+                    engine = self._select_engine(entry.coverage, queue_ms)
+                logger.info(f"Processing image: {input_path} ({info.format} {image_w}x{image_h}, "
+                            f"quality={quality}, engine={engine}, queued {queue_ms:.0f}ms)")
+
+                if engine == 'classical':
+                    # 经典修复不需要对齐到8的倍数，直接在原分辨率上处理
+                    result = self._get_classical_backend().run(
+                        image[None], entry.mask[None], bgr=True)[0]
+                else:
+                    # 按预测的峰值内存决定推理方式，超过预算时缩小或分块
+                    decision = self.admission.plan(entry.mask[:, :, 0], entry.bbox,
+                                                   Config.MAX_WORKING_SIDE)
+                    if decision.action != 'admit':
+                        logger.info(f"Over the memory budget of "
+                                    f"{self.admission.budget_mb:.0f}MB: {decision}")
+                    if decision.plans is None:
+                        # 步骤3: 推理 (就像main.py第55行)，模型直接输出BGR
+                        h, w = image_h // 8 * 8, image_w // 8 * 8
+                        result = self._run_model(image[:h, :w], entry.mask[:h, :w],
+                                                 quality, bgr=True, debug=debug)
+                        if debug is not None:
+                            result, debug_image = result
+                            cv2.imwrite(debug_path, debug_image)
+                    else:
+                        # 大图、缩小或分块：在ROI上推理，只在mask内合成回原分辨率
+                        result = self._process_regions(image, entry, decision.plans,
+                                                       quality, debug=debug, token=token)
+                        if debug is not None:
+                            result, debug_image = result
+                            cv2.imwrite(debug_path, cv2.cvtColor(debug_image, cv2.COLOR_RGB2BGR))
+                        result = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+
+                # 保存结果 (第56-57行)
+                cv2.imwrite(output_path, result)
                 
                 logger.info(f"Image processed successfully: {output_path}")
-                return True
+                return engine
                 
+        except (JobTooLarge, Overloaded):
+            raise
+        except Cancelled as e:
+            logger.info(f"Image {input_path} {e.reason}, stopped")
+            raise
         except Exception as e:
             logger.error(f"Error processing image: {e}")
             import traceback
             logger.error(traceback.format_exc())
-            return False
+            return None
+
+    def _run_model(self, image, mask, quality='full', bgr=False, debug=None):
+        """
+        对单张图像执行一次推理
+
+        Args:
+            image: RGB图像 (H, W, 3), uint8
+            mask: mask (H, W, 1), uint8 0/255
+            quality: 'full'或'preview'
+            bgr: 输出BGR，可以直接cv2.imwrite
+            debug: None或'attention'
+
+        Returns:
+            np.ndarray: 结果图像 (H, W, 3), uint8；有debug时为(结果, debug图像)
+        """
+        result = self._get_backend().run(image[None], mask[None], quality,
+                                         bgr=bgr, debug=debug)
+        if debug is None:
+            return result[0]
+        return tuple(r[0] for r in result)
+
+    def _process_regions(self, image, entry, plans, quality='full', debug=None, token=None):
+        """
+        在缩小的ROI或原分辨率的块上依次推理，放大后只在mask内合成到原分辨率。
+        后面的块以前面块的结果为上下文，推理开销由每个区域的尺寸限定
+
+        Args:
+            image: 原分辨率的RGB图像 (H, W, 3), uint8
+            entry: 图像尺寸的MaskEntry
+            plans: highres.HighResPlan列表(AdmissionController.plan)
+            debug: 'attention'时每个区域的flow图像缩放到ROI后拼到原分辨率，
+                区域外为白色(没有位移)
+            token: CancelToken，每个区域之前检查
+
+        Returns:
+            np.ndarray: 原分辨率的RGB结果图像；有debug时为(结果, debug图像)
+        """
+        image_h, image_w = image.shape[:2]
+        mask = entry.mask[:, :, 0]
+        debug_image = None if debug is None else np.full_like(image, 255)
+        if not plans:
+            logger.info("Empty mask, returning the input image")
+            return image if debug is None else (image, debug_image)
+        result = image
+        for plan in plans:
+            if token is not None:
+                token.check()
+            logger.info(f"Input {image_w}x{image_h}: {plan}")
+            work_image, work_mask = highres.prepare(result, mask, plan)
+            inpainted = self._run_model(work_image, work_mask, quality, debug=debug)
+            if debug is not None:
+                inpainted, flow = inpainted
+                y0, y1, x0, x1 = plan.roi
+                debug_image[y0:y1, x0:x1] = cv2.resize(flow, (x1 - x0, y1 - y0),
+                                                       interpolation=cv2.INTER_NEAREST)
+            result = highres.restore(result, mask, inpainted, plan,
+                                     detail=Config.HIGHRES_DETAIL)
+        return result if debug is None else (result, debug_image)
 
     def process_video(self, input_path, output_path, 
-        watermark_type='istock', task_id=None):
+        watermark_type='istock', task_id=None, token=None):
         """
         处理视频去水印
         
@@ -136,168 +302,150 @@ class WatermarkRemovalService:
             output_path: 输出视频路径
             watermark_type: 水印类型
             task_id: 任务ID，用于进度跟踪
+            token: CancelToken，在每帧和每批之间检查，取消时删除临时文件和
+                未完成的输出，进度状态为cancelled；被同一task_id的新任务取代时
+                不更新进度，进度属于新任务
         
         Returns:
             bool: 处理是否成功
         """
+        # 输出先写到同目录下每个任务单独的临时文件，完成后改名为output_path，
+        # 取消或出错时只删除自己的临时文件，不影响同一输出路径上的其他任务
+        partial_path = None
         try:
-            with self._lock:
-                logger.info(f"Processing video: {input_path}")
+            # moviepy(以及imageio/ffmpeg)只在视频路径上导入
+            import moviepy.editor as mp
 
-                # 加载视频
-                video = mp.VideoFileClip(input_path)
-                
-                # 调试信息：打印视频属性
-                logger.info(f"Video duration: {video.duration}")
-                logger.info(f"Video fps: {video.fps}")
-                logger.info(f"Video size: {video.size}")
+            # 解码和编码不占用推理，只有每批帧的推理在video通道的槽位内进行
+            logger.info(f"Processing video: {input_path}")
 
-                # 尝试获取duration和fps，如果为None则使用备用方法
-                duration = video.duration
-                fps = video.fps
+            # 加载视频
+            video = mp.VideoFileClip(input_path)
+            
+            # 调试信息：打印视频属性
+            logger.info(f"Video duration: {video.duration}")
+            logger.info(f"Video fps: {video.fps}")
+            logger.info(f"Video size: {video.size}")
 
-                logger.info(f"---video: {video} duration: {duration} fps: {fps}---")
-                
-                # 检查视频长度限制（60秒）
-                if duration > 60:
-                    logger.error("Video duration exceeds 60 seconds limit")
-                    return False
+            duration = video.duration
+            fps = video.fps
 
-                # 创建临时目录处理帧
-                temp_dir = tempfile.mkdtemp()
+            # 检查视频长度限制（60秒）
+            if duration > 60:
+                logger.error("Video duration exceeds 60 seconds limit")
+                video.close()
+                return False
+
+            # 创建临时目录存放无音轨的中间视频
+            temp_dir = tempfile.mkdtemp()
+            writer = None
 
-                # 初始化TensorFlow会话（只初始化一次）
-                tf.reset_default_graph()
-                sess_config = tf.ConfigProto()
-                sess_config.gpu_options.allow_growth = True
+            try:
+                # 所有帧尺寸相同，mask只需加载一次
+                video_w, video_h = video.size
+                w, h = video_w // 8 * 8, video_h // 8 * 8
+                mask = self.masks.get(watermark_type, video_w, video_h).mask[:h, :w]
+                # 内存预算内最大的批大小
+                batch_size = self.admission.video_batch(
+                    h, w, np.count_nonzero(mask), Config.VIDEO_BATCH_SIZE)
+                total_frames = max(1, int(duration * fps))
 
-                try:
-                    # 提取和处理帧 - 逐帧处理，不预加载模型
-                    frames = []
-                    total_frames = int(duration * fps)
+                silent_path = os.path.join(temp_dir, "silent.mp4")
+                writer = cv2.VideoWriter(
+                    silent_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
 
-                    for i, frame in enumerate(video.iter_frames()):
+                # 按批处理帧，整批共用同一个mask
+                batch = []
+                processed = 0
+                for frame in video.iter_frames():
+                    if token is not None:
+                        token.check()
+                    batch.append(frame[:h, :w])
+                    if len(batch) == batch_size:
+                        self._write_frames(writer, batch, mask, batch_size, token)
+                        processed += len(batch)
+                        batch = []
                         if task_id:
-                            self._update_progress(task_id, i / total_frames * 0.8)  # 80%用于处理帧
-
-                        # 保存帧为临时图片
-                        frame_path = os.path.join(temp_dir, f"frame_{i:06d}.png")
-                        cv2.imwrite(frame_path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
-
-                        # 处理帧去水印（使用单独的方法）
-                        processed_frame_path = os.path.join(temp_dir, f"processed_{i:06d}.png")
-                        logger.info(f"正在处理第 {i+1}/{total_frames} 帧")
-                        success = self._process_single_frame(frame_path, processed_frame_path, watermark_type)
-                        if success:
-                            frames.append(processed_frame_path)
-                        else:
-                            logger.warning(f"Failed to process frame {i}")
-                            frames.append(frame_path)  # 使用原帧
-
-                finally:
-                    # 清理临时文件
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    video.close()
+                            self._update_progress(task_id, min(processed / total_frames, 1.) * 0.8)  # 80%用于处理帧
+                        logger.info(f"正在处理第 {processed}/{total_frames} 帧")
+                if batch:
+                    self._write_frames(writer, batch, mask, batch_size, token)
+                writer.release()
+                writer = None
+                if token is not None:
+                    token.check()
+
+                # 合成原音轨并编码为H.264
+                clip = mp.VideoFileClip(silent_path)
+                if video.audio is not None:
+                    clip = clip.set_audio(video.audio)
+                fd, partial_path = tempfile.mkstemp(
+                    suffix=os.path.splitext(output_path)[1] or '.mp4', prefix='.partial-',
+                    dir=os.path.dirname(output_path) or '.')
+                os.close(fd)
+                clip.write_videofile(partial_path, codec='libx264',
+                                     audio_codec='aac', logger=None)
+                clip.close()
+                os.replace(partial_path, output_path)
+
+            finally:
+                # 取消或出错时也释放编码器，再清理临时文件
+                if writer is not None:
+                    writer.release()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                video.close()
+
+            if task_id:
+                self._update_progress(task_id, 1.)
+            logger.info(f"Video processed successfully: {output_path}")
+            return True
+
+        except Cancelled as e:
+            logger.info(f"Video {input_path} {e.reason}, stopped")
+            self._remove_partial(partial_path)
+            if task_id and e.reason != 'superseded':
+                self._update_progress(task_id, -1, status='cancelled')
+            return False
 
         except Exception as e:
             logger.error(f"Error processing video: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            self._remove_partial(partial_path)
             if task_id:
                 self._update_progress(task_id, -1)  # 标记失败
             return False
 
-    def _process_single_frame(self, input_path, output_path, watermark_type):
-        try:
-            # 预处理图像
-            image = Image.open(input_path)
-            input_image = preprocess_image(image, watermark_type)
-
-            if input_image.shape == (0,):
-                return False
-
-            # 重置默认图并创建新会话 (和process_image方法相同的逻辑)
-            tf.reset_default_graph()
-            
-            # 创建会话配置
-            sess_config = tf.ConfigProto()
-            sess_config.gpu_options.allow_growth = True
-            
-            # 在会话中执行推理
-            with tf.Session(config=sess_config) as sess:
-                # 将输入图像转换为TensorFlow常量
-                input_image_tensor = tf.constant(input_image, dtype=tf.float32)
-                
-                # 构建服务器图
-                output = self.model.build_server_graph(self.FLAGS, input_image_tensor)
-                
-                # 后处理输出
-                output = (output + 1.) * 127.5
-                output = tf.reverse(output, [-1])
-                output = tf.saturate_cast(output, tf.uint8)
-                
-                # 加载预训练模型
-                vars_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-                assign_ops = []
-                for var in vars_list:
-                    vname = var.name
-                    from_name = vname
-                    try:
-                        var_value = tf.contrib.framework.load_variable(
-                            self.checkpoint_dir, from_name
-                        )
-                        assign_ops.append(tf.assign(var, var_value))
-                    except Exception as e:
-                        logger.warning(f"Could not load variable {vname}: {e}")
-                
-                # 运行变量赋值
-                sess.run(assign_ops)
-                
-                # 执行推理
-                result = sess.run(output)
-                
-                # 保存结果
-                cv2.imwrite(output_path, cv2.cvtColor(
-                    result[0][:, :, ::-1], cv2.COLOR_BGR2RGB
-                ))
-
-            return True
-        except Exception as e:
-            logger.error(f"Error processing frame: {e}")
-            return False
-
-    def _process_single_frame_with_session(self, input_path, output_path, watermark_type, sess, input_placeholder, output_tensor):
-        """
-        使用已有的TensorFlow会话处理单帧（避免重复加载模型）
-        """
+    @staticmethod
+    def _remove_partial(path):
+        """删除未完成的输出文件，path为None时什么也不做"""
+        if path is None:
+            return
         try:
-            # 预处理图像
-            image = Image.open(input_path)
-            input_image = preprocess_image(image, watermark_type)
-
-            if input_image.shape == (0,):
-                return False
-
-            # 使用已有的会话执行推理
-            result = sess.run(output_tensor, feed_dict={input_placeholder: input_image})
-
-            # 保存结果
-            cv2.imwrite(output_path, cv2.cvtColor(
-                result[0][:, :, ::-1], cv2.COLOR_BGR2RGB
-            ))
+            os.remove(path)
+        except OSError:
+            pass
 
-            return True
-        except Exception as e:
-            logger.error(f"Error processing frame with session: {e}")
-            return False
+    def _write_frames(self, writer, frames, mask, batch_size, token=None):
+        """推理一批RGB帧并写入视频"""
+        count = len(frames)
+        # 不足一批时用最后一帧补齐，复用同一个批大小的计算图
+        frames = frames + [frames[-1]] * (batch_size - count)
+        # 每批单独申请槽位，批之间图像请求可以插入
+        with self.scheduler.slot('video', token):
+            results = self._get_backend().run(np.stack(frames), mask[None], bgr=True)
+        for result in results[:count]:
+            writer.write(result)
 
-    def _update_progress(self, task_id, progress):
+    def _update_progress(self, task_id, progress, status=None):
         progress_file = f"progress_{task_id}.json"
+        if status is None:
+            status = "failed" if progress < 0 else ("completed" if progress >= 1 else "processing")
         progress_data = {
             "task_id": task_id,
             "progress": progress,
             "timestamp": time.time(),
-            "status": "processing" if progress >= 0 else "failed"
+            "status": status
         }
 
         try:
@@ -0,0 +1,365 @@
+"""HTTP load test for the watermark removal API.
+
+Built out from test_api.py: the same requests, sent concurrently. Image and
+video jobs arrive at their own rates, either open-loop (Poisson arrivals at
+--image_rate/--video_rate, independent of how fast the server answers) or
+closed-loop (--concurrency clients, each sending its next request when the
+previous one finished). Open-loop latency is measured from the scheduled
+arrival, so time spent waiting for a free client thread is included.
+
+Reports p50/p95/p99 latency, error, 413 and 429 rates, and throughput per
+--interval seconds. A video job counts from upload until its progress
+reports completed or failed.
+
+With --start_app the API is started locally with INFERENCE_BACKEND=--backend.
+The default `stub` backend replaces inference by a fixed delay
+(--stub_latency_ms), so the HTTP and queueing layers are measured on their own.
+
+    python test/load_test.py --start_app --image_rate 4 --video_rate 0.1 --duration 60
+    python test/load_test.py --base_url http://localhost:8080 --arrival closed --concurrency 8
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--base_url', default='http://localhost:8080', type=str)
+parser.add_argument('--start_app', action='store_true',
+                    help='Start app.py locally for the duration of the test.')
+parser.add_argument('--backend', default='stub', type=str,
+                    help='INFERENCE_BACKEND of the started app.')
+parser.add_argument('--stub_latency_ms', default=50., type=float)
+parser.add_argument('--arrival', default='open', choices=['open', 'closed'])
+parser.add_argument('--image_rate', default=2., type=float,
+                    help='Image jobs per second (open-loop), or their share of the mix.')
+parser.add_argument('--video_rate', default=0., type=float,
+                    help='Video jobs per second (open-loop), or their share of the mix.')
+parser.add_argument('--concurrency', default=4, type=int,
+                    help='Clients of the closed-loop test.')
+parser.add_argument('--max_in_flight', default=64, type=int,
+                    help='Open-loop client threads; arrivals beyond are counted as dropped.')
+parser.add_argument('--duration', default=30., type=float, help='Seconds of arrivals.')
+parser.add_argument('--images', nargs='+', default=['image.png'],
+                    help='Uploaded images, one chosen per request. Missing files are '
+                         'replaced by a synthetic --image_size image.')
+parser.add_argument('--image_size', default='512x680', type=str, help='HxW')
+parser.add_argument('--video', default='', type=str,
+                    help='Uploaded video. Empty for a synthetic one.')
+parser.add_argument('--watermark_type', default='istock', type=str)
+parser.add_argument('--engine', default='auto', type=str)
+parser.add_argument('--quality', default='full', type=str)
+parser.add_argument('--download', action='store_true',
+                    help='Also download each result, as test_api.py does.')
+parser.add_argument('--timeout', default=300., type=float,
+                    help='Seconds before a request or video job counts as an error.')
+parser.add_argument('--poll_interval', default=0.5, type=float)
+parser.add_argument('--interval', default=5., type=float,
+                    help='Seconds per bucket of the throughput timeline.')
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--output', default='load_test.json', type=str)
+
+Result = collections.namedtuple('Result', 'kind scheduled end status error latency_ms')
+
+
+def synthetic_image(size):
+    import cv2
+    height, width = [int(v) for v in size.split('x')]
+    rng = np.random.RandomState(0)
+    small = rng.randint(0, 256, (height // 16 + 1, width // 16 + 1, 3)).astype(np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def synthetic_video(path, frames=24, size=(256, 256), fps=12):
+    import cv2
+    height, width = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    rng = np.random.RandomState(0)
+    for _ in range(frames):
+        writer.write(rng.randint(0, 256, (height, width, 3)).astype(np.uint8))
+    writer.release()
+
+
+def load_payloads(args, tmp):
+    """(filename, bytes) for every image, and for the video"""
+    images = []
+    for path in args.images:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+    if not images:
+        images.append(('synthetic.png', synthetic_image(args.image_size)))
+    video = args.video
+    if not video and args.video_rate > 0:
+        video = os.path.join(tmp, 'synthetic.mp4')
+        synthetic_video(video)
+    payload = None
+    if video:
+        with open(video, 'rb') as f:
+            payload = (os.path.basename(video), f.read())
+    return images, payload
+
+
+class Client:
+    """Sends one job and waits for its result. One requests.Session per thread."""
+
+    def __init__(self, args, images, video):
+        self.args = args
+        self.images = images
+        self.video = video
+        self._local = threading.local()
+        self._rng = np.random.RandomState(args.seed)
+        self._rng_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def run(self, kind, scheduled):
+        try:
+            if kind == 'video':
+                status, error = self._video()
+            else:
+                status, error = self._image()
+        except requests.RequestException as e:
+            status, error = None, type(e).__name__
+        end = time.time()
+        return Result(kind, scheduled, end, status, error, (end - scheduled) * 1000.)
+
+    def _image(self):
+        with self._rng_lock:
+            name, data = self.images[self._rng.randint(len(self.images))]
+        response = self.session.post(
+            f"{self.args.base_url}/api/v1/remove-watermark",
+            files={'image': (name, data)},
+            data={'watermark_type': self.args.watermark_type,
+                  'engine': self.args.engine, 'quality': self.args.quality},
+            timeout=self.args.timeout)
+        if response.status_code != 200:
+            return response.status_code, _error(response)
+        if self.args.download:
+            download = self.session.get(
+                f"{self.args.base_url}{response.json()['download_url']}",
+                timeout=self.args.timeout)
+            if download.status_code != 200:
+                return download.status_code, 'download failed'
+        return 200, None
+
+    def _video(self):
+        name, data = self.video
+        start = time.time()
+        response = self.session.post(
+            f"{self.args.base_url}/api/v1/remove-watermark-video",
+            files={'video': (name, data)},
+            data={'watermark_type': self.args.watermark_type},
+            timeout=self.args.timeout)
+        if response.status_code != 202:
+            return response.status_code, _error(response)
+        result = response.json()
+        while time.time() - start < self.args.timeout:
+            time.sleep(self.args.poll_interval)
+            progress = self.session.get(f"{self.args.base_url}{result['progress_url']}",
+                                        timeout=self.args.timeout).json()
+            if progress.get('status') == 'completed':
+                break
+            if progress.get('status') == 'failed':
+                return 500, 'video failed'
+        else:
+            return None, 'video timeout'
+        if self.args.download:
+            download = self.session.get(f"{self.args.base_url}{result['download_url']}",
+                                        timeout=self.args.timeout)
+            if download.status_code != 200:
+                return download.status_code, 'download failed'
+        return 200, None
+
+
+def _error(response):
+    try:
+        return response.json().get('error')
+    except ValueError:
+        return response.text[:200]
+
+
+def arrivals(rates, duration, seed):
+    """Poisson arrivals per kind, merged: [(offset_s, kind)]"""
+    rng = np.random.RandomState(seed)
+    events = []
+    for kind, rate in rates.items():
+        if rate <= 0:
+            continue
+        t = rng.exponential(1. / rate)
+        while t < duration:
+            events.append((t, kind))
+            t += rng.exponential(1. / rate)
+    return sorted(events)
+
+
+def run_open_loop(client, args):
+    results = []
+    dropped = collections.Counter()
+    in_flight = threading.Semaphore(args.max_in_flight)
+    lock = threading.Lock()
+
+    def task(kind, scheduled):
+        try:
+            result = client.run(kind, scheduled)
+            with lock:
+                results.append(result)
+        finally:
+            in_flight.release()
+
+    events = arrivals({'image': args.image_rate, 'video': args.video_rate},
+                      args.duration, args.seed)
+    start = time.time()
+    with ThreadPoolExecutor(args.max_in_flight) as pool:
+        for offset, kind in events:
+            delay = start + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not in_flight.acquire(blocking=False):
+                dropped[kind] += 1
+                continue
+            pool.submit(task, kind, start + offset)
+    return results, dropped, start
+
+
+def run_closed_loop(client, args):
+    results = []
+    lock = threading.Lock()
+    total = args.image_rate + args.video_rate
+    video_share = args.video_rate / total if total > 0 else 0.
+    start = time.time()
+
+    def worker(index):
+        rng = np.random.RandomState(args.seed + index)
+        while time.time() - start < args.duration:
+            kind = 'video' if rng.rand() < video_share else 'image'
+            result = client.run(kind, time.time())
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, collections.Counter(), start
+
+
+def summarize(results, dropped, start, interval):
+    """Latency percentiles and error rates per job kind, and a throughput timeline"""
+    def stats(subset, dropped_count):
+        count = len(subset) + dropped_count
+        ok = [r.latency_ms for r in subset if r.status == 200]
+        codes = collections.Counter(r.status for r in subset)
+        errors = sum(1 for r in subset if r.status is None or r.status >= 500)
+        report = {
+            'requests': count,
+            'succeeded': len(ok),
+            'dropped': dropped_count,
+            'error_rate': errors / count if count else 0.,
+            'rate_413': codes[413] / count if count else 0.,
+            'rate_429': codes[429] / count if count else 0.,
+            'status_codes': {str(k): v for k, v in sorted(codes.items(), key=str)},
+        }
+        if ok:
+            report.update({f'p{q}_latency_ms': float(np.percentile(ok, q))
+                           for q in (50, 95, 99)})
+            report['mean_latency_ms'] = float(np.mean(ok))
+        return report
+
+    end = max([r.end for r in results], default=start)
+    report = {
+        'wall_s': end - start,
+        'throughput_per_s': sum(1 for r in results if r.status == 200) / max(end - start, 1e-9),
+        'all': stats(results, sum(dropped.values())),
+    }
+    for kind in sorted(set(r.kind for r in results) | set(dropped)):
+        report[kind] = stats([r for r in results if r.kind == kind], dropped[kind])
+
+    timeline = []
+    buckets = collections.defaultdict(list)
+    for r in results:
+        buckets[int((r.end - start) // interval)].append(r)
+    for index in range(int((end - start) // interval) + 1):
+        bucket = buckets.get(index, [])
+        ok = [r.latency_ms for r in bucket if r.status == 200]
+        timeline.append({
+            't_s': index * interval,
+            'completed': len(bucket),
+            'throughput_per_s': len(ok) / interval,
+            'errors': sum(1 for r in bucket if r.status is None or r.status >= 500),
+            'rejected_413': sum(1 for r in bucket if r.status == 413),
+            'rejected_429': sum(1 for r in bucket if r.status == 429),
+            'p95_latency_ms': float(np.percentile(ok, 95)) if ok else None,
+        })
+    report['timeline'] = timeline
+    return report
+
+
+def start_app(args, log):
+    env = dict(os.environ, INFERENCE_BACKEND=args.backend,
+               STUB_LATENCY_MS=str(args.stub_latency_ms))
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('app.py exited with code {}'.format(process.returncode))
+        try:
+            if requests.get(f"{args.base_url}/health", timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('app.py did not become healthy within 120s')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        images, video = load_payloads(args, tmp)
+        app = None
+        if args.start_app:
+            log = open(os.path.join(tmp, 'app.log'), 'wb')
+            app = start_app(args, log)
+        try:
+            response = requests.get(f"{args.base_url}/health")
+            print(f"Health check: {response.status_code}, {response.json()}")
+            client = Client(args, images, video)
+            run = run_open_loop if args.arrival == 'open' else run_closed_loop
+            results, dropped, start = run(client, args)
+        finally:
+            if app is not None:
+                app.terminate()
+                app.wait()
+                log.close()
+
+    report = summarize(results, dropped, start, args.interval)
+    report['args'] = vars(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for kind in ('all', 'image', 'video'):
+        if kind in report:
+            r = report[kind]
+            print(f"{kind:6s} n={r['requests']:5d} ok={r['succeeded']:5d} "
+                  f"p50={r.get('p50_latency_ms', 0):8.1f}ms p95={r.get('p95_latency_ms', 0):8.1f}ms "
+                  f"p99={r.get('p99_latency_ms', 0):8.1f}ms errors={r['error_rate']:.1%} "
+                  f"413={r['rate_413']:.1%} 429={r['rate_429']:.1%} dropped={r['dropped']}")
+    print(f"throughput {report['throughput_per_s']:.2f}/s, report written to {args.output}")
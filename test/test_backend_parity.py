@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('neuralgym')
+pytest.importorskip('onnxruntime')
+
+from service.inference_backend import create_backend
+
+CHECKPOINT_DIR = os.environ.get('MODEL_PATH', 'model/')
+ONNX_MODEL_PATH = os.environ.get('ONNX_MODEL_PATH', 'model/inpaint.onnx')
+
+if not os.path.exists(os.path.join(CHECKPOINT_DIR, 'checkpoint')) or \
+        not os.path.exists(ONNX_MODEL_PATH):
+    pytest.skip('needs a checkpoint and a model exported by export_onnx.py',
+                allow_module_level=True)
+
+
+@pytest.fixture(scope='module')
+def backends():
+    tf_backend = create_backend('tensorflow', checkpoint_dir=CHECKPOINT_DIR)
+    onnx_backend = create_backend('onnxruntime', model_path=ONNX_MODEL_PATH)
+    yield tf_backend, onnx_backend
+    tf_backend.close()
+
+
+def _inputs(height, width, seed=0):
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (1, height, width, 3)).astype(np.uint8)
+    # smooth the noise so the inpainting has some structure to copy
+    image = np.cumsum(image, axis=2) % 256
+    mask = np.zeros((1, height, width, 1), np.uint8)
+    mask[:, height//4:height//2, width//3:width*2//3] = 255
+    return image.astype(np.uint8), mask
+
+
+def test_capabilities(backends):
+    for backend in backends:
+        caps = backend.capabilities()
+        assert caps['name'] == backend.name
+        assert 'full' in caps['qualities']
+
+
+@pytest.mark.parametrize('quality', ['full', 'preview'])
+def test_onnx_matches_tensorflow(backends, quality):
+    tf_backend, onnx_backend = backends
+    if quality not in onnx_backend.capabilities()['qualities']:
+        pytest.skip('{} model not exported'.format(quality))
+    height, width = onnx_backend.capabilities()['input_size']
+    image, mask = _inputs(height, width)
+    expected = tf_backend.run(image, mask, quality).astype(np.float32)
+    actual = onnx_backend.run(image, mask, quality).astype(np.float32)
+    assert expected.shape == actual.shape
+    diff = np.abs(expected - actual)
+    # outputs are uint8, allow rounding differences only
+    assert diff.mean() < 0.5
+    assert np.percentile(diff, 99.9) <= 2
+
+
+def test_onnx_resizes_other_shapes(backends):
+    _, onnx_backend = backends
+    height, width = onnx_backend.capabilities()['input_size']
+    image, mask = _inputs(height // 2, width // 2, seed=1)
+    result = onnx_backend.run(image, mask)
+    assert result.shape == image.shape
+    # pixels outside the mask are untouched
+    outside = mask[..., 0] == 0
+    np.testing.assert_array_equal(result[outside], image[outside])
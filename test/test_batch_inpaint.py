@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from batch_inpaint import BatchRunner, Manifest, read_flist
+from service.inference_backend import create_backend
+
+
+class CountingBackend:
+    """Wraps a backend and records the batch sizes it is called with."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.batches = []
+
+    def run(self, images, masks, quality='full', bgr=False):
+        self.batches.append(images.shape)
+        return self.backend.run(images, masks, quality, bgr)
+
+
+@pytest.fixture
+def catalogue(tmp_path):
+    rng = np.random.RandomState(0)
+    lines = []
+    sizes = [(60, 90), (64, 96), (60, 90), (100, 70), (64, 96), (100, 70), (61, 91)]
+    for i, (height, width) in enumerate(sizes):
+        image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        mask = np.zeros((height, width), np.uint8)
+        mask[10:20, 10:40] = 255
+        image_path = str(tmp_path / f'{i}.png')
+        mask_path = str(tmp_path / f'{i}_mask.png')
+        cv2.imwrite(image_path, image)
+        cv2.imwrite(mask_path, mask)
+        lines.append(f'{image_path} {mask_path} {tmp_path}/out/{i}.png')
+    lines.append(f'{tmp_path}/missing.png {tmp_path}/out/missing.png')
+    flist = tmp_path / 'images.flist'
+    flist.write_text('\n'.join(lines) + '\n')
+    return str(flist)
+
+
+def _run(flist, backend, batch_size=2):
+    manifest = Manifest(flist + '.manifest.jsonl')
+    runner = BatchRunner(backend, manifest, batch_size=batch_size, bucket=32,
+                         decode_workers=2, write_workers=2)
+    try:
+        return runner.run(read_flist(flist))
+    finally:
+        manifest.close()
+
+
+def test_batches_by_bucket_and_writes_originals(catalogue):
+    backend = CountingBackend(create_backend('opencv'))
+    report = _run(catalogue, backend)
+    assert report['done'] == 7 and report['failed'] == 1
+    # 60x90, 64x96 and 61x91 share the 64x96 bucket, 100x70 pads to 128x96
+    assert sorted(backend.batches) == sorted([(2, 64, 96, 3), (2, 64, 96, 3),
+                                              (1, 64, 96, 3), (2, 128, 96, 3)])
+    for line in open(catalogue).read().splitlines()[:-1]:
+        image_path, mask_path, output = line.split()
+        image = cv2.imread(image_path)
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        expected = create_backend('opencv').run(
+            image[None, :, :, ::-1], mask[None, :, :, None], bgr=True)[0]
+        result = cv2.imread(output)
+        assert result.shape == image.shape
+        outside = mask == 0
+        np.testing.assert_array_equal(result[outside], image[outside])
+        assert np.abs(result.astype(int) - expected).mean() < 2
+
+
+def test_resume_skips_finished(catalogue):
+    _run(catalogue, create_backend('opencv'))
+    records = [json.loads(line) for line in open(catalogue + '.manifest.jsonl')]
+    assert sum(r['status'] == 'done' for r in records) == 7
+    assert [r for r in records if r['status'] == 'failed'][0]['output'].endswith('missing.png')
+
+    os.remove(records[0]['output'])
+    backend = CountingBackend(create_backend('opencv'))
+    report = _run(catalogue, backend)
+    assert report['skipped'] == 6
+    assert report['done'] == 1 and report['failed'] == 1
+    assert sum(shape[0] for shape in backend.batches) == 1
+
+
+def test_registry_masks_share_a_batch(tmp_path):
+    from service.mask_registry import MaskRegistry
+
+    template = np.zeros((300, 400), np.uint8)
+    template[100:180, 60:340] = 255
+    (tmp_path / 'masks' / 'logo' / 'landscape').mkdir(parents=True)
+    cv2.imwrite(str(tmp_path / 'masks' / 'logo' / 'landscape' / 'mask.png'), template)
+    registry = MaskRegistry(str(tmp_path / 'masks'), reload_interval=0)
+
+    rng = np.random.RandomState(0)
+    lines = []
+    for i, (height, width) in enumerate([(60, 90), (64, 96), (61, 91), (62, 93)]):
+        image_path = str(tmp_path / f'{i}.png')
+        cv2.imwrite(image_path, rng.randint(0, 256, (height, width, 3)).astype(np.uint8))
+        lines.append(f'{image_path} {tmp_path}/out/{i}.png')
+    flist = tmp_path / 'images.flist'
+    flist.write_text('\n'.join(lines) + '\n')
+
+    backend = CountingBackend(create_backend('opencv'))
+    manifest = Manifest(str(flist) + '.manifest.jsonl')
+    runner = BatchRunner(backend, manifest, registry=registry, watermark_type='logo',
+                         batch_size=4, bucket=32)
+    try:
+        report = runner.run(read_flist(str(flist)))
+    finally:
+        manifest.close()
+    assert report['done'] == 4
+    # different sizes in one bucket: a single full batch
+    assert backend.batches == [(4, 64, 96, 3)]
+    for i, line in enumerate(lines):
+        image_path, output = line.split()
+        image = cv2.imread(image_path)
+        result = cv2.imread(output)
+        height, width = image.shape[:2]
+        outside = registry.get('logo', width, height).mask[:, :, 0] == 0
+        assert result.shape == image.shape
+        np.testing.assert_array_equal(result[outside], image[outside])
+        assert np.abs(result[~outside].astype(int) - image[~outside]).mean() > 5
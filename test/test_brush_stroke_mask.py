@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('neuralgym')
+
+from inpaint_ops import bank_brush_strokes, brush_stroke_bank, draw_strokes
+from inpaint_ops import random_brush_strokes
+
+
+def _reference(starts, ends, widths, height, width):
+    """Pixels within half the width of a segment, one segment at a time."""
+    y, x = np.mgrid[:height, :width].astype(np.float64)
+    mask = np.zeros((height, width), bool)
+    for (ax, ay), (bx, by), w in zip(starts, ends, widths):
+        if w <= 0:
+            continue
+        abx, aby = bx - ax, by - ay
+        t = np.clip(((x - ax) * abx + (y - ay) * aby) / max(abx**2 + aby**2, 1e-6), 0, 1)
+        mask |= (x - ax - t * abx)**2 + (y - ay - t * aby)**2 <= (w / 2.)**2
+    return mask
+
+
+def test_draw_strokes_matches_reference():
+    rng = np.random.RandomState(0)
+    height, width = 90, 130
+    starts = (rng.rand(8, 2) * [width, height]).astype(np.float32)
+    ends = (rng.rand(8, 2) * [width, height]).astype(np.float32)
+    widths = rng.randint(12, 40, 8).astype(np.float32)
+    widths[[2, 5]] = 0
+    ends[3] = starts[3]  # a single dot
+    expected = _reference(starts, ends, widths, height, width)
+
+    tf.reset_default_graph()
+    exact = draw_strokes(tf.constant(starts), tf.constant(ends), tf.constant(widths),
+                         height, width)
+    coarse = draw_strokes(tf.constant(starts), tf.constant(ends), tf.constant(widths),
+                          height, width, stride=4)
+    with tf.Session() as sess:
+        exact, coarse = sess.run([exact, coarse])
+    assert exact.shape == coarse.shape == (height, width)
+    # only rounding at the boundary may differ
+    assert (exact != expected).sum() <= 5
+    assert (coarse & expected).sum() / (coarse | expected).sum() > 0.97
+
+
+def test_random_brush_strokes():
+    height, width = 128, 160
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    mask = random_brush_strokes(height, width)
+    assert mask.shape.as_list() == [height, width, 1]
+    with tf.Session() as sess:
+        masks = np.stack([sess.run(mask)[:, :, 0] for _ in range(300)])
+    assert set(np.unique(masks)) <= {0., 1.}
+    coverage = masks.mean(axis=(1, 2))
+    assert coverage.min() > 0 and 0.05 < coverage.mean() < 0.4
+    assert len({m.tobytes() for m in masks}) == len(masks)
+    # strokes drift to the right and are flipped half of the time, so on
+    # average the masks are centred
+    area = masks.sum(axis=(1, 2))
+    cx = (masks.sum(axis=1) * np.arange(width)).sum(axis=1) / area / width
+    cy = (masks.sum(axis=2) * np.arange(height)).sum(axis=1) / area / height
+    assert abs(cx.mean() - 0.5) < 0.06 and abs(cy.mean() - 0.5) < 0.06
+
+
+def test_brush_stroke_bank(tmp_path):
+    height, width = 64, 96
+    path = str(tmp_path / 'bank.npy')
+    tf.set_random_seed(0)
+    bank = brush_stroke_bank(path, 70, height, width)
+    assert isinstance(bank, np.memmap)
+    assert bank.shape == (70, height, width) and bank.dtype == np.uint8
+    assert set(np.unique(bank)) <= {0, 1} and bank.any(axis=(1, 2)).all()
+    assert not (tmp_path / 'bank.npy.partial').exists()
+    # an existing bank is reused, not rewritten
+    np.testing.assert_array_equal(brush_stroke_bank(path, 10, height, width), bank)
+    with pytest.raises(ValueError):
+        brush_stroke_bank(path, 70, width, height)
+
+    tf.reset_default_graph()
+    mask = bank_brush_strokes(bank)
+    assert mask.shape.as_list() == [height, width, 1]
+    with tf.Session() as sess:
+        masks = np.stack([sess.run(mask)[:, :, 0] for _ in range(100)])
+    assert set(np.unique(masks)) <= {0., 1.}
+    # flips and wrap-around shifts keep the masked area of a bank entry
+    areas = set(bank.sum(axis=(1, 2)).tolist())
+    assert all(area in areas for area in masks.sum(axis=(1, 2)).tolist())
+    assert len({m.tobytes() for m in masks}) > 90
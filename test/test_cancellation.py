@@ -0,0 +1,52 @@
+import socket
+import time
+
+import pytest
+
+from service.cancellation import CancelToken, Cancelled, JobRegistry, socket_disconnected
+
+
+def test_token_deadline():
+    token = CancelToken()
+    assert token.reason is None and token.remaining_s() is None
+    token.check()
+    token = CancelToken(deadline_s=0.02)
+    assert 0 < token.remaining_s() <= 0.02
+    time.sleep(0.03)
+    with pytest.raises(Cancelled) as e:
+        token.check()
+    assert e.value.reason == 'deadline'
+    # the first reason is kept
+    token.cancel()
+    assert token.reason == 'deadline'
+
+
+def test_registry_cancel_and_supersede():
+    registry = JobRegistry()
+    first, second = CancelToken(), CancelToken()
+    assert not registry.cancel('a')
+    with registry.track('a', first):
+        assert registry.active() == ['a']
+        with registry.track('a', second):
+            assert first.reason == 'superseded' and second.reason is None
+            assert registry.cancel('a')
+            assert second.reason == 'cancelled'
+        # the superseded job does not unregister its replacement
+        assert registry.active() == []
+    assert not registry.cancel('a')
+
+
+def test_socket_disconnected():
+    server, client = socket.socketpair()
+    disconnected = socket_disconnected(server)
+    token = CancelToken(disconnected=disconnected)
+    try:
+        assert not disconnected()
+        client.sendall(b'x')
+        assert not disconnected()
+        server.recv(1)
+        client.close()
+        assert disconnected()
+        assert token.reason == 'disconnected'
+    finally:
+        server.close()
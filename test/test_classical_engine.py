@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+
+from service.inference_backend import create_backend
+
+
+def _inputs(batch=2, height=64, width=96):
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (batch, height, width, 3)).astype(np.uint8)
+    masks = np.zeros((1, height, width, 1), np.uint8)
+    masks[:, 20:30, 40:60] = 255
+    return images, masks
+
+
+@pytest.mark.parametrize('method', ['telea', 'ns'])
+def test_only_masked_region_changes(method):
+    backend = create_backend('opencv', method=method)
+    images, masks = _inputs()
+    result = backend.run(images, masks)
+    assert result.shape == images.shape
+    assert result.dtype == np.uint8
+    outside = np.broadcast_to(masks == 0, images.shape)
+    np.testing.assert_array_equal(result[outside], images[outside])
+    assert not np.array_equal(result[~outside], images[~outside])
+
+
+def test_fills_from_surroundings():
+    backend = create_backend('opencv')
+    images = np.full((1, 64, 64, 3), 200, np.uint8)
+    masks = np.zeros((1, 64, 64, 1), np.uint8)
+    masks[:, 24:40, 24:40] = 255
+    images[:, 24:40, 24:40] = 0
+    result = backend.run(images, masks)
+    assert np.abs(result.astype(int) - 200).max() <= 5
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        create_backend('opencv', method='patchmatch')
+
+
+def test_bgr_output():
+    backend = create_backend('opencv')
+    images, masks = _inputs()
+    rgb = backend.run(images, masks)
+    bgr = backend.run(images, masks, bgr=True)
+    np.testing.assert_array_equal(bgr, rgb[..., ::-1])
+
+
+def test_stub_backend_returns_input_after_delay():
+    backend = create_backend('stub', latency_ms=20.)
+    images, masks = _inputs()
+    t = time.time()
+    result = backend.run(images, masks)
+    assert time.time() - t >= 0.02
+    np.testing.assert_array_equal(result, images)
+    np.testing.assert_array_equal(backend.run(images, masks, bgr=True), images[..., ::-1])
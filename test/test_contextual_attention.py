@@ -0,0 +1,225 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('neuralgym')
+
+from neuralgym.ops.layers import resize
+from inpaint_ops import contextual_attention, flow_to_image_tf, highlight_flow_tf
+from inpaint_ops import COLORWHEEL, flow_to_image, highlight_flow
+
+
+def _contextual_attention_loop(f, b, mask=None, ksize=3, stride=1, rate=1,
+                                fuse_k=3, softmax_scale=10., training=True, fuse=True):
+    """Per-sample loop implementation the batched layer replaced."""
+    # get shapes
+    raw_fs = tf.shape(f)
+    raw_int_fs = f.get_shape().as_list()
+    raw_int_bs = b.get_shape().as_list()
+    # extract patches from background with stride and rate
+    kernel = 2*rate
+    raw_w = tf.extract_image_patches(
+        b, [1,kernel,kernel,1], [1,rate*stride,rate*stride,1], [1,1,1,1], padding='SAME')
+    raw_w = tf.reshape(raw_w, [raw_int_bs[0], -1, kernel, kernel, raw_int_bs[3]])
+    raw_w = tf.transpose(raw_w, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
+    # downscaling foreground option: downscaling both foreground and
+    # background for matching and use original background for reconstruction.
+    f = resize(f, scale=1./rate, func=tf.image.resize_nearest_neighbor)
+    b = resize(b, to_shape=[int(raw_int_bs[1]/rate), int(raw_int_bs[2]/rate)], func=tf.image.resize_nearest_neighbor)  # https://github.com/tensorflow/tensorflow/issues/11651
+    if mask is not None:
+        mask = resize(mask, scale=1./rate, func=tf.image.resize_nearest_neighbor)
+    fs = tf.shape(f)
+    int_fs = f.get_shape().as_list()
+    f_groups = tf.split(f, int_fs[0], axis=0)
+    # from t(H*W*C) to w(b*k*k*c*h*w)
+    bs = tf.shape(b)
+    int_bs = b.get_shape().as_list()
+    w = tf.extract_image_patches(
+        b, [1,ksize,ksize,1], [1,stride,stride,1], [1,1,1,1], padding='SAME')
+    w = tf.reshape(w, [int_fs[0], -1, ksize, ksize, int_fs[3]])
+    w = tf.transpose(w, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
+    # process mask
+    if mask is None:
+        mask = tf.zeros([1, bs[1], bs[2], 1])
+    m = tf.extract_image_patches(
+        mask, [1,ksize,ksize,1], [1,stride,stride,1], [1,1,1,1], padding='SAME')
+    m = tf.reshape(m, [1, -1, ksize, ksize, 1])
+    m = tf.transpose(m, [0, 2, 3, 4, 1])  # transpose to b*k*k*c*hw
+    m = m[0]
+    mm = tf.cast(tf.equal(tf.reduce_mean(m, axis=[0,1,2], keep_dims=True), 0.), tf.float32)
+    w_groups = tf.split(w, int_bs[0], axis=0)
+    raw_w_groups = tf.split(raw_w, int_bs[0], axis=0)
+    y = []
+    offsets = []
+    k = fuse_k
+    scale = softmax_scale
+    fuse_weight = tf.reshape(tf.eye(k), [k, k, 1, 1])
+    for xi, wi, raw_wi in zip(f_groups, w_groups, raw_w_groups):
+        # conv for compare
+        wi = wi[0]
+        wi_normed = wi / tf.maximum(tf.sqrt(tf.reduce_sum(tf.square(wi), axis=[0,1,2])), 1e-4)
+        yi = tf.nn.conv2d(xi, wi_normed, strides=[1,1,1,1], padding="SAME")
+
+        # conv implementation for fuse scores to encourage large patches
+        if fuse:
+            yi = tf.reshape(yi, [1, fs[1]*fs[2], bs[1]*bs[2], 1])
+            yi = tf.nn.conv2d(yi, fuse_weight, strides=[1,1,1,1], padding='SAME')
+            yi = tf.reshape(yi, [1, fs[1], fs[2], bs[1], bs[2]])
+            yi = tf.transpose(yi, [0, 2, 1, 4, 3])
+            yi = tf.reshape(yi, [1, fs[1]*fs[2], bs[1]*bs[2], 1])
+            yi = tf.nn.conv2d(yi, fuse_weight, strides=[1,1,1,1], padding='SAME')
+            yi = tf.reshape(yi, [1, fs[2], fs[1], bs[2], bs[1]])
+            yi = tf.transpose(yi, [0, 2, 1, 4, 3])
+        yi = tf.reshape(yi, [1, fs[1], fs[2], bs[1]*bs[2]])
+
+        # softmax to match
+        yi *=  mm  # mask
+        yi = tf.nn.softmax(yi*scale, 3)
+        yi *=  mm  # mask
+
+        offset = tf.argmax(yi, axis=3, output_type=tf.int32)
+        offset = tf.stack([offset // fs[2], offset % fs[2]], axis=-1)
+        # deconv for patch pasting
+        # 3.1 paste center
+        wi_center = raw_wi[0]
+        yi = tf.nn.conv2d_transpose(yi, wi_center, tf.concat([[1], raw_fs[1:]], axis=0), strides=[1,rate,rate,1]) / 4.
+        y.append(yi)
+        offsets.append(offset)
+    y = tf.concat(y, axis=0)
+    y.set_shape(raw_int_fs)
+    offsets = tf.concat(offsets, axis=0)
+    offsets.set_shape(int_bs[:3] + [2])
+    # case1: visualize optical flow: minus current position
+    h_add = tf.tile(tf.reshape(tf.range(bs[1]), [1, bs[1], 1, 1]), [bs[0], 1, bs[2], 1])
+    w_add = tf.tile(tf.reshape(tf.range(bs[2]), [1, 1, bs[2], 1]), [bs[0], bs[1], 1, 1])
+    offsets = offsets - tf.concat([h_add, w_add], axis=3)
+    # to flow image
+    flow = flow_to_image_tf(offsets)
+    # # case2: visualize which pixels are attended
+    # flow = highlight_flow_tf(offsets * tf.cast(mask, tf.int32))
+    if rate != 1:
+        flow = resize(flow, scale=rate, func=tf.image.resize_bilinear)
+    return y, flow
+
+
+def _inputs(batch, height, width, channels, seed=0):
+    rng = np.random.RandomState(seed)
+    f = rng.randn(batch, height, width, channels).astype(np.float32)
+    b = rng.randn(batch, height, width, channels).astype(np.float32)
+    mask = np.zeros((1, height, width, 1), np.float32)
+    mask[:, height//4:height*3//4, width//3:width*2//3] = 1.
+    return f, b, mask
+
+
+@pytest.mark.parametrize('batch', [1, 3])
+@pytest.mark.parametrize('kwargs', [
+    dict(rate=2),
+    dict(rate=1),
+    dict(rate=2, fuse=False),
+    dict(rate=2, use_mask=False),
+    dict(rate=4),
+])
+def test_batched_matches_loop(batch, kwargs):
+    kwargs = dict(kwargs)
+    use_mask = kwargs.pop('use_mask', True)
+    f, b, mask = _inputs(batch, 32, 48, 8)
+    tf.reset_default_graph()
+    ft, bt = tf.constant(f), tf.constant(b)
+    mt = tf.constant(mask) if use_mask else None
+    y, flow = contextual_attention(ft, bt, mt, **kwargs)
+    y_ref, flow_ref = _contextual_attention_loop(ft, bt, mt, **kwargs)
+    assert y.get_shape().as_list() == y_ref.get_shape().as_list()
+    with tf.Session() as sess:
+        y, flow, y_ref, flow_ref = sess.run([y, flow, y_ref, flow_ref])
+    np.testing.assert_allclose(y, y_ref, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(flow, flow_ref, atol=1e-3)
+
+
+def test_gradients_match_loop():
+    f, b, mask = _inputs(2, 16, 16, 4)
+    tf.reset_default_graph()
+    ft, bt = tf.constant(f), tf.constant(b)
+    y, _ = contextual_attention(ft, bt, tf.constant(mask), rate=2)
+    y_ref, _ = _contextual_attention_loop(ft, bt, tf.constant(mask), rate=2)
+    grads = tf.gradients(tf.reduce_sum(tf.square(y)), [ft, bt])
+    grads_ref = tf.gradients(tf.reduce_sum(tf.square(y_ref)), [ft, bt])
+    with tf.Session() as sess:
+        grads, grads_ref = sess.run([grads, grads_ref])
+    for g, g_ref in zip(grads, grads_ref):
+        np.testing.assert_allclose(g, g_ref, rtol=1e-3, atol=1e-3)
+
+
+def test_graph_size_independent_of_batch():
+    sizes = []
+    for batch in (1, 4):
+        graph = tf.Graph()
+        with graph.as_default():
+            f, b, mask = _inputs(batch, 16, 16, 4)
+            contextual_attention(tf.constant(f), tf.constant(b),
+                                 tf.constant(mask), rate=2)
+        sizes.append(len(graph.get_operations()))
+    assert sizes[0] == sizes[1]
+
+
+def _flow_to_image_loop(flow):
+    """Per-sample, per-channel implementation flow_to_image replaced."""
+    out = []
+    for i in range(flow.shape[0]):
+        u = flow[i, :, :, 0].astype(np.float64)
+        v = flow[i, :, :, 1].astype(np.float64)
+        rad = np.sqrt(u ** 2 + v ** 2)
+        u = u / (np.max(rad) + np.finfo(float).eps)
+        v = v / (np.max(rad) + np.finfo(float).eps)
+        rad = np.sqrt(u ** 2 + v ** 2)
+        ncols = len(COLORWHEEL)
+        fk = (np.arctan2(-v, -u) / np.pi + 1) / 2 * (ncols - 1) + 1
+        k0 = np.floor(fk).astype(int)
+        k1 = k0 + 1
+        k1[k1 == ncols+1] = 1
+        f = fk - k0
+        img = np.zeros(u.shape + (3,))
+        for c in range(3):
+            col0 = COLORWHEEL[k0-1, c] / 255
+            col1 = COLORWHEEL[k1-1, c] / 255
+            col = (1-f) * col0 + f * col1
+            col = np.where(rad <= 1, 1 - rad*(1-col), col*0.75)
+            img[:, :, c] = np.uint8(np.floor(255 * col))
+        out.append(img)
+    return np.float32(np.uint8(out))
+
+
+def test_flow_to_image():
+    rng = np.random.RandomState(0)
+    flow = rng.randint(-20, 21, (3, 24, 40, 2)).astype(np.int32)
+    flow[1] //= 4
+    flow[2] = 0
+    original = flow.copy()
+    expected = _flow_to_image_loop(flow)
+    np.testing.assert_array_equal(flow_to_image(flow), expected)
+    np.testing.assert_array_equal(flow, original)
+    # no motion is white
+    assert (expected[2] == 255).all()
+
+    tf.reset_default_graph()
+    out = flow_to_image_tf(tf.constant(flow))
+    assert out.get_shape().as_list() == [3, 24, 40, 3]
+    with tf.Session() as sess:
+        out = sess.run(out)
+    # float32 round-off may move the truncation by one level
+    assert np.abs((out + 1.) * 127.5 - expected).max() <= 1.001
+
+
+def test_highlight_flow():
+    rng = np.random.RandomState(0)
+    flow = np.stack([rng.randint(-24, 24, (2, 24, 40)),
+                     rng.randint(-40, 40, (2, 24, 40))], axis=-1)
+    expected = np.full((2, 24, 40, 3), 144., np.float32)
+    for i in range(2):
+        for h in range(24):
+            for w in range(40):
+                expected[i, flow[i, h, w, 0], flow[i, h, w, 1]] = 255.
+    np.testing.assert_array_equal(highlight_flow(flow), expected)
+    tf.reset_default_graph()
+    with tf.Session() as sess:
+        out = sess.run(highlight_flow_tf(tf.constant(flow, tf.int32)))
+    np.testing.assert_allclose((out + 1.) * 127.5, expected, atol=1e-3)
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+
+from service import highres
+from service.cost_model import (AdmissionController, CostModel, JobCost, JobTooLarge,
+                                Overloaded)
+
+
+def _model():
+    # 500MB + 1000MB/MP + 4000MB/MP^2
+    return CostModel({'neural': {'memory_mb': [500., 1000., 4000., 0.],
+                                 'latency_ms': [10., 1000., 0., 0.]}})
+
+
+def _mask(height, width, box):
+    mask = np.zeros((height, width), np.uint8)
+    y0, y1, x0, x1 = box
+    mask[y0:y1, x0:x1] = 255
+    return mask
+
+
+def test_fit_recovers_coefficients():
+    truth = _model()
+    samples = []
+    for height, width, batch in [(128, 128, 1), (256, 256, 1), (256, 384, 1),
+                                 (512, 512, 1), (512, 680, 1), (256, 256, 2)]:
+        cost = truth.predict(height, width, batch=batch)
+        samples.append({'height': height, 'width': width, 'batch': batch,
+                        'mask_area': 0, **cost._asdict()})
+    model = CostModel().fit(samples)
+    for sample in samples:
+        cost = model.predict(sample['height'], sample['width'], batch=sample['batch'])
+        assert cost.memory_mb == pytest.approx(sample['memory_mb'], rel=1e-6)
+        assert cost.latency_ms == pytest.approx(sample['latency_ms'], rel=1e-6)
+    assert min(min(c) for c in model.coefficients['neural'].values()) >= 0
+
+
+def test_max_side_fits_budget():
+    model = _model()
+    side = model.max_side(0.75, 2000.)
+    assert model.predict(side, int(side * 0.75)).memory_mb <= 2000.
+    assert model.predict(side + 8, int((side + 8) * 0.75)).memory_mb > 2000.
+    assert model.max_side(1., 400.) == 0
+
+
+def test_plan_admit_downscale_tile_reject():
+    model = _model()
+    controller = AdmissionController(model, budget_mb=1500., min_scale=0.5, max_tiles=16)
+    # 256x256: 0.066MP -> ~580MB
+    assert controller.plan(_mask(256, 256, (100, 150, 100, 150))).action == 'admit'
+
+    # a small watermark in a large image: cropping around it is enough
+    decision = controller.plan(_mask(1024, 1024, (400, 600, 400, 600)))
+    assert decision.action in ('admit', 'downscale')
+    assert decision.cost.memory_mb <= 1500.
+
+    # a mask spanning the image needs to be downscaled
+    decision = controller.plan(_mask(1024, 1024, (0, 1024, 0, 1024)))
+    assert decision.action == 'downscale'
+    assert decision.plans[0].scale >= 0.5
+    assert decision.cost.memory_mb <= 1500.
+
+    # ... and tiled when that would lose too much detail
+    decision = controller.plan(_mask(1600, 1600, (0, 1600, 0, 1600)))
+    assert decision.action == 'tile'
+    assert all(p.scale == 1. for p in decision.plans)
+    assert decision.cost.memory_mb <= 1500.
+
+    # too many tiles: downscale within the budget instead of rejecting
+    decision = controller.plan(_mask(8192, 8192, (0, 8192, 0, 8192)))
+    assert decision.action == 'downscale'
+    assert decision.cost.memory_mb <= 1500.
+
+    # rejected only when not even a downscaled plan fits
+    with pytest.raises(JobTooLarge):
+        AdmissionController(model, budget_mb=400.).plan(_mask(1024, 1024, (0, 1024, 0, 1024)))
+
+
+def test_large_photo_with_default_settings():
+    # default coefficients, 85% of the 4G limit in docker-compose.yml and the
+    # Config defaults for MIN_DOWNSCALE, MAX_TILES and MAX_WORKING_SIDE
+    controller = AdmissionController(CostModel(), budget_mb=0.85 * 4096,
+                                     min_scale=0.5, max_tiles=16)
+    for height, width in [(3000, 4000), (4000, 6000)]:
+        # a watermark across the middle of the photo
+        mask = _mask(height, width, (height // 3, height * 2 // 3, width // 8, width * 7 // 8))
+        decision = controller.plan(mask, max_working_side=1536)
+        assert decision.action in ('downscale', 'tile')
+        assert decision.cost.memory_mb <= 0.85 * 4096
+
+
+def test_unlimited_budget_admits():
+    controller = AdmissionController(_model(), budget_mb=0.)
+    decision = controller.plan(_mask(4096, 4096, (0, 4096, 0, 4096)))
+    assert decision.action == 'admit' and decision.plans is None
+
+
+def test_tiles_cover_mask():
+    mask = _mask(901, 1303, (50, 901, 100, 1303))
+    tiles = highres.plan_tiles(mask, 400)
+    covered = np.zeros(mask.shape, bool)
+    for plan in tiles:
+        y0, y1, x0, x1 = plan.roi
+        assert (x1 - x0, y1 - y0) == plan.work_size
+        assert max(plan.work_size) <= 400 and plan.work_size[0] % 8 == 0
+        covered[y0:y1, x0:x1] = True
+    assert covered[mask > 0].all()
+
+
+def test_video_batch_shrinks_to_budget():
+    controller = AdmissionController(_model(), budget_mb=1700.)
+    assert controller.video_batch(256, 256, 0, 4) == 4
+    assert controller.video_batch(512, 512, 0, 4) == 2
+    with pytest.raises(JobTooLarge):
+        controller.video_batch(800, 800, 0, 4)
+
+
+def test_queue_limit():
+    controller = AdmissionController(_model(), max_queue_ms=1000.)
+    cost = JobCost(0., 600.)
+    with controller.queued(cost):
+        with pytest.raises(Overloaded) as e:
+            with controller.queued(cost):
+                pass
+        assert e.value.retry_after_s == 1
+    # an empty queue accepts any job
+    with controller.queued(JobCost(0., 5000.)):
+        pass
+    assert controller.pending_ms == 0
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+tf = pytest.importorskip('tensorflow')
+ng = pytest.importorskip('neuralgym')
+
+from inpaint_model import InpaintCAModel
+from inpaint_ops import edge_guidance, image2edge
+
+
+def _images(batch=3, height=32, width=40):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, (batch, height, width, 3)).astype(np.uint8)
+
+
+def test_image2edge_matches_per_image_laplacian():
+    images = _images()
+    expected = np.float32(np.uint8([
+        cv2.Laplacian(image, cv2.CV_64F, ksize=3, scale=2) for image in images]))
+    np.testing.assert_array_equal(image2edge(images), expected)
+
+
+def test_edge_guidance_matches_image2edge():
+    images = _images()
+    threshold = 0.6
+    tf.reset_default_graph()
+    edges = edge_guidance(tf.constant(images), threshold)
+    edges_float = edge_guidance(tf.constant(images.astype(np.float32)), threshold)
+    with tf.Session() as sess:
+        edges, edges_float = sess.run([edges, edges_float])
+    expected = (image2edge(images)[:, :, :, 0:1] / 255. > threshold).astype(np.float32)
+    assert edges.shape == (3, 32, 40, 1)
+    np.testing.assert_array_equal(edges, expected)
+    np.testing.assert_array_equal(edges_float, expected)
+
+
+def test_guided_graph_without_edge_files():
+    FLAGS = ng.Config('inpaint.yml')
+    FLAGS['guided'] = True
+    images = _images(2, 64, 96)
+    mask = np.zeros((1, 64, 96, 1), np.uint8)
+    mask[:, 16:40, 24:64] = 255
+
+    tf.reset_default_graph()
+    model = InpaintCAModel()
+    image_ph = tf.placeholder(tf.uint8, images.shape)
+    mask_ph = tf.placeholder(tf.uint8, mask.shape)
+    output = model.build_uint8_server_graph(FLAGS, image_ph, mask_ph)
+    # image, edge map, ones and mask channels
+    kernel = [v for v in tf.global_variables() if 'conv1/kernel' in v.name][0]
+    assert kernel.shape[2] == 6
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        result = sess.run(output, feed_dict={image_ph: images, mask_ph: mask})
+    assert result.shape == images.shape
+    outside = np.broadcast_to(mask == 0, images.shape)
+    assert np.abs(result[outside].astype(int) - images[outside]).max() <= 1
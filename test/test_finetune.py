@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('neuralgym')
+cv2 = pytest.importorskip('cv2')
+
+from finetune import image_dataset, mask_dataset, watermark_mask_bank
+from inpaint_ops import brush_stroke_bank
+from service.mask_registry import MaskRegistry
+
+
+@pytest.mark.parametrize('random_crop', [False, True])
+def test_image_dataset(tmp_path, random_crop):
+    rng = np.random.RandomState(0)
+    paths = []
+    for i, (height, width) in enumerate([(90, 120), (200, 150), (64, 300)]):
+        paths.append(str(tmp_path / f'{i}.png'))
+        cv2.imwrite(paths[-1], rng.randint(0, 256, (height, width, 3)).astype(np.uint8))
+    paths.append(str(tmp_path / 'broken.jpg'))
+    (tmp_path / 'broken.jpg').write_bytes(b'not an image')
+
+    tf.reset_default_graph()
+    dataset = image_dataset(paths, [96, 128, 3], 2, random_crop=random_crop,
+                            cache=str(tmp_path / 'cache'), shuffle_buffer=4)
+    batch = tf.data.make_one_shot_iterator(dataset).get_next()
+    with tf.Session() as sess:
+        batches = [sess.run(batch) for _ in range(6)]
+    for images in batches:
+        assert images.shape == (2, 96, 128, 3) and images.dtype == np.float32
+        assert images.min() >= 0 and images.max() <= 255
+    assert (tmp_path / 'cache.index').exists()
+
+
+def test_watermark_masks():
+    registry = MaskRegistry('utils', reload_interval=0)
+    bank = watermark_mask_bank(registry, [], 128, 192)
+    assert bank.shape[1:] == (128, 192, 1) and set(np.unique(bank)) <= {0., 1.}
+
+    tf.reset_default_graph()
+    mask = tf.data.make_one_shot_iterator(
+        mask_dataset([128, 192, 3], bank, watermark_prob=1.)).get_next()
+    with tf.Session() as sess:
+        masks = np.stack([sess.run(mask) for _ in range(50)])
+    assert masks.shape == (50, 1, 128, 192, 1)
+    assert set(np.unique(masks)) <= {0., 1.}
+    # rescaled by up to 25% and shifted, so neither identical nor far off
+    coverage = masks.mean(axis=(1, 2, 3, 4)) / bank[0].mean()
+    assert 0.4 < coverage.min() and coverage.max() < 1.7
+    assert len({m.tobytes() for m in masks}) > 40
+
+
+def test_brush_bank_masks(tmp_path):
+    bank = brush_stroke_bank(str(tmp_path / 'bank.npy'), 20, 64, 96)
+    tf.reset_default_graph()
+    mask = tf.data.make_one_shot_iterator(
+        mask_dataset([64, 96, 3], brush_bank=bank, parallel_calls=2)).get_next()
+    with tf.Session() as sess:
+        masks = np.stack([sess.run(mask) for _ in range(10)])
+    assert masks.shape == (10, 1, 64, 96, 1)
+    assert set(np.unique(masks)) <= {0., 1.} and masks.any(axis=(1, 2, 3, 4)).all()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('neuralgym')
+
+from inpaint_ops import gen_conv, gen_deconv
+
+
+def _compare(build):
+    """Build the layer unfused and fused with shared variables."""
+    tf.reset_default_graph()
+    np.random.seed(0)
+    x = tf.constant(np.random.randn(2, 16, 20, 12).astype(np.float32))
+    with tf.variable_scope('layer'):
+        ref = build(x, False)
+    with tf.variable_scope('layer', reuse=True):
+        out = build(x, True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for var in tf.global_variables():
+            sess.run(tf.assign(var, np.random.randn(
+                *var.get_shape().as_list()).astype(np.float32) * 0.3))
+        ref, out = sess.run([ref, out])
+    assert ref.shape == out.shape
+    np.testing.assert_allclose(ref, out, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(ksize=3),
+    dict(ksize=5),
+    dict(ksize=3, stride=2),
+    dict(ksize=3, rate=2),
+    dict(ksize=3, rate=4, padding='SYMMETRIC'),
+    dict(ksize=3, activation=tf.nn.relu),
+])
+def test_gen_conv_fused_matches(kwargs):
+    _compare(lambda x, fused: gen_conv(
+        x, 16, name='conv', fused=fused, **kwargs))
+
+
+def test_gen_deconv_fused_matches():
+    _compare(lambda x, fused: gen_deconv(
+        x, 16, name='upsample', fused=fused))
+
+
+def test_fused_uses_checkpoint_variable_names():
+    tf.reset_default_graph()
+    x = tf.zeros([1, 8, 8, 4])
+    with tf.variable_scope('inpaint_net'):
+        gen_conv(x, 16, 3, name='conv1', fused=True)
+        gen_deconv(x, 16, name='conv13_upsample', fused=True)
+    names = sorted(v.name for v in tf.global_variables())
+    assert names == [
+        'inpaint_net/conv1/bias:0',
+        'inpaint_net/conv1/kernel:0',
+        'inpaint_net/conv13_upsample/conv13_upsample_conv/bias:0',
+        'inpaint_net/conv13_upsample/conv13_upsample_conv/kernel:0',
+    ]
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+pytest.importorskip('cv2')
+
+from service.image_decode import ImageBuffer, ImageTooLarge, decode_image, probe, stats
+
+
+def _image(height=60, width=90):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('orientation', range(1, 9))
+def test_exif_orientation(tmp_path, orientation):
+    path = str(tmp_path / 'image.png')
+    image = Image.fromarray(_image())
+    exif = image.getexif()
+    exif[0x0112] = orientation
+    image.save(path, exif=exif)
+    expected = np.array(ImageOps.exif_transpose(Image.open(path)).convert('RGB'))
+
+    result, info = decode_image(path)
+    assert info.orientation == orientation
+    assert info.size == (expected.shape[1], expected.shape[0])
+    assert result.flags.c_contiguous
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_reduced_jpeg(tmp_path):
+    path = str(tmp_path / 'image.jpg')
+    image = _image(25, 40).repeat(32, axis=0).repeat(32, axis=1)
+    Image.fromarray(image).save(path, quality=95)
+
+    full, _ = decode_image(path)
+    assert full.shape == (800, 1280, 3)
+    reduced, info = decode_image(path, max_side=300)
+    assert info.format == 'JPEG'
+    assert reduced.shape == (188, 300, 3)
+    expected = np.array(Image.fromarray(full).resize((300, 188), Image.BILINEAR))
+    assert np.abs(reduced.astype(int) - expected).mean() < 4
+    assert stats.summary()['JPEG']['reduced'] >= 1
+
+
+def test_buffer_is_reused(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.fromarray(_image()).save(path)
+    buffer = ImageBuffer()
+    first, _ = decode_image(path, buffer=buffer)
+    second, _ = decode_image(path, buffer=buffer)
+    assert np.shares_memory(first, second)
+    np.testing.assert_array_equal(second, _image())
+
+
+def test_pil_fallback(tmp_path):
+    path = str(tmp_path / 'image.gif')
+    Image.fromarray(_image()).convert('P').save(path)
+    result, info = decode_image(path)
+    assert info.format == 'GIF'
+    assert result.shape == (60, 90, 3)
+
+
+def test_too_large(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.fromarray(_image()).save(path)
+    assert probe(path, max_pixels=60 * 90).pixels == 60 * 90
+    with pytest.raises(ImageTooLarge):
+        probe(path, max_pixels=60 * 90 - 1)
+    with pytest.raises(ImageTooLarge):
+        decode_image(path, max_pixels=100)
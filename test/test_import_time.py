@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('cv2')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# importing TensorFlow alone takes several seconds
+BUDGET_S = float(os.environ.get('IMPORT_TIME_BUDGET_S') or 2.)
+
+
+@pytest.mark.parametrize('module', ['app', 'batch_inpaint', 'watch_folder'])
+def test_import_time(tmp_path, module):
+    output = tmp_path / 'report.json'
+    subprocess.run([sys.executable, os.path.join('benchmark', 'bench_import.py'),
+                    '--modules', module, '--output', str(output)],
+                   cwd=ROOT, env=dict(os.environ, INFERENCE_BACKEND='stub'),
+                   check=True, stdout=subprocess.DEVNULL)
+    report, = json.loads(output.read_text())
+    assert report['heavy'] == []
+    assert report['wall_s'] < BUDGET_S, report['packages']
@@ -0,0 +1,73 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from service.mask_registry import MaskRegistry
+
+
+def _write_mask(root, watermark_type, variant, width, height, box):
+    mask = np.zeros((height, width), np.uint8)
+    y0, y1, x0, x1 = box
+    mask[y0:y1, x0:x1] = 255
+    path = os.path.join(str(root), watermark_type, variant)
+    os.makedirs(path, exist_ok=True)
+    Image.fromarray(mask).save(os.path.join(path, 'mask.png'))
+
+
+@pytest.fixture
+def root(tmp_path):
+    _write_mask(tmp_path, 'istock', 'landscape', 200, 100, (40, 60, 50, 150))
+    return tmp_path
+
+
+def test_geometry(root):
+    registry = MaskRegistry(str(root), reload_interval=0)
+    assert registry.types() == ['istock']
+    entry = registry.get('istock', 400, 200)
+    assert entry.mask.shape == (200, 400, 1)
+    assert entry.mask.dtype == np.uint8
+    assert set(np.unique(entry.mask)) == {0, 255}
+    assert not entry.mask.flags.writeable
+    assert entry.coverage == pytest.approx(20 * 100 / 20000.)
+    y0, y1, x0, x1 = entry.bbox
+    ys, xs = np.nonzero(entry.mask[:, :, 0])
+    assert y0 <= ys.min() and ys.max() < y1 and x0 <= xs.min() and xs.max() < x1
+    assert (y1 - y0) - (ys.max() + 1 - ys.min()) <= 2
+    assert registry.get('istock', 400, 200) is entry
+
+
+def test_portrait_falls_back_to_closest_variant(root):
+    registry = MaskRegistry(str(root), reload_interval=0)
+    entry = registry.get('istock', 300, 500)
+    assert entry.template.variant == 'landscape'
+    assert entry.mask.shape == (500, 300, 1)
+
+
+def test_picks_closest_aspect_variant(root):
+    _write_mask(root, 'istock', 'potrait', 100, 200, (80, 120, 10, 90))
+    _write_mask(root, 'istock', 'wide', 300, 100, (40, 60, 50, 250))
+    registry = MaskRegistry(str(root), reload_interval=0)
+    assert registry.template('istock', 300, 600).variant == 'potrait'
+    assert registry.template('istock', 1600, 900).variant == 'landscape'
+    assert registry.template('istock', 2100, 700).variant == 'wide'
+
+
+def test_unknown_type(root):
+    registry = MaskRegistry(str(root), reload_interval=0)
+    with pytest.raises(KeyError):
+        registry.get('shutterstock', 100, 100)
+
+
+def test_hot_reload(root):
+    registry = MaskRegistry(str(root), reload_interval=0.01)
+    old = registry.get('istock', 200, 100)
+    _write_mask(root, 'shutterstock', 'landscape', 200, 100, (0, 10, 0, 10))
+    _write_mask(root, 'istock', 'landscape', 200, 100, (0, 50, 0, 100))
+    time.sleep(0.05)
+    assert registry.types() == ['istock', 'shutterstock']
+    new = registry.get('istock', 200, 100)
+    assert new is not old
+    assert new.coverage == pytest.approx(0.25)
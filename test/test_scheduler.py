@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+from service.cancellation import CancelToken, Cancelled
+from service.scheduler import Scheduler
+
+
+def _wait_queued(scheduler, counts):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        summary = scheduler.summary()
+        if all(summary[lane]['waiting'] == n for lane, n in counts.items()):
+            return
+        time.sleep(0.005)
+    raise AssertionError(f"Jobs not queued: {scheduler.summary()}")
+
+
+class _Clock:
+    """Replaces the time module in service.scheduler, so slot durations
+    and hence the order of grants do not depend on thread timing"""
+
+    def __init__(self):
+        self.now = 0.
+
+    def time(self):
+        return self.now
+
+
+def test_weighted_share(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr('service.scheduler.time', clock)
+    # the jobs queue behind a slot in a third lane, so both lanes start even
+    scheduler = Scheduler({'image': 3., 'video': 1., 'hold': 1.})
+    order = []
+
+    def job(lane):
+        with scheduler.slot(lane):
+            order.append(lane[0])
+            clock.now += 1.
+
+    threads = [threading.Thread(target=job, args=(lane,))
+               for lane in ['video'] * 8 + ['image'] * 8]
+    with scheduler.slot('hold'):
+        for thread in threads:
+            thread.start()
+        _wait_queued(scheduler, {'image': 8, 'video': 8})
+    for thread in threads:
+        thread.join()
+    # image gets 3/4 of the inference time while both lanes are busy, ties
+    # go to the lane listed first
+    assert ''.join(order) == 'iviiiviiivivvvvv'
+    summary = scheduler.summary()
+    assert summary['image']['jobs'] == 8 and summary['video']['jobs'] == 8
+    assert summary['image']['busy_s'] == summary['video']['busy_s'] == 8.
+    assert summary['image']['waiting'] == summary['video']['waiting'] == 0
+
+
+def test_image_waits_for_one_video_batch():
+    scheduler = Scheduler({'image': 4., 'video': 1.})
+    batch_s = 0.05
+    done = threading.Event()
+
+    def video():
+        for _ in range(20):
+            with scheduler.slot('video'):
+                time.sleep(batch_s)
+        done.set()
+
+    thread = threading.Thread(target=video)
+    thread.start()
+    time.sleep(batch_s * 2.5)
+    waits = []
+    for _ in range(3):
+        queued_at = time.time()
+        with scheduler.slot('image'):
+            waits.append(time.time() - queued_at)
+        time.sleep(batch_s)
+    assert not done.is_set()
+    thread.join()
+    assert max(waits) < batch_s * 2
+    assert scheduler.summary()['video']['jobs'] == 20
+
+
+def test_unknown_lane():
+    scheduler = Scheduler({'image': 1.})
+    with pytest.raises(KeyError):
+        with scheduler.slot('video'):
+            pass
+    with pytest.raises(ValueError):
+        Scheduler({'image': 0.})
+
+
+def test_cancelled_while_queued():
+    scheduler = Scheduler({'image': 1., 'video': 1.})
+    cancelled = CancelToken()
+    expired = CancelToken(deadline_s=0.05)
+    errors = {}
+
+    def queue(name, token):
+        try:
+            with scheduler.slot('image', token):
+                pass
+        except Cancelled as e:
+            errors[name] = e.reason
+
+    with scheduler.slot('video'):
+        threads = [threading.Thread(target=queue, args=args)
+                   for args in [('cancelled', cancelled), ('expired', expired)]]
+        for thread in threads:
+            thread.start()
+        _wait_queued(scheduler, {'image': 2})
+        cancelled.cancel()
+        started = time.time()
+        for thread in threads:
+            thread.join(2)
+        # both leave the queue while the slot is still held
+        assert time.time() - started < 1
+        assert scheduler.summary()['image']['waiting'] == 0
+    assert errors == {'cancelled': 'cancelled', 'expired': 'deadline'}
+    assert scheduler.summary()['image']['cancelled'] == 2
+    assert scheduler.summary()['image']['jobs'] == 0
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+ng = pytest.importorskip('neuralgym')
+
+from inpaint_model import InpaintCAModel
+
+
+@pytest.mark.parametrize('quality', ['full', 'preview'])
+def test_uint8_graph_matches_float_graph(quality):
+    FLAGS = ng.Config('inpaint.yml')
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (2, 64, 96, 3)).astype(np.uint8)
+    mask = np.zeros((1, 64, 96, 1), np.uint8)
+    mask[:, 16:40, 24:64] = 255
+
+    tf.reset_default_graph()
+    model = InpaintCAModel()
+    batch_data = np.concatenate(
+        [images, np.broadcast_to(mask, images.shape[:3] + (3,))], axis=2)
+    ref = model.build_server_graph(
+        FLAGS, tf.constant(batch_data.astype(np.float32)), quality=quality)
+    ref = tf.saturate_cast((ref + 1.) * 127.5, tf.uint8)
+    image_ph = tf.placeholder(tf.uint8, images.shape)
+    mask_ph = tf.placeholder(tf.uint8, mask.shape)
+    out = model.build_uint8_server_graph(
+        FLAGS, image_ph, mask_ph, reuse=True, quality=quality)
+    out_bgr = model.build_uint8_server_graph(
+        FLAGS, image_ph, mask_ph, reuse=True, quality=quality,
+        reverse_channels=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        ref, out, out_bgr = sess.run(
+            [ref, out, out_bgr], feed_dict={image_ph: images, mask_ph: mask})
+    assert out.dtype == np.uint8 and out.shape == images.shape
+    # float round-off may move the truncation by one level
+    assert np.abs(out.astype(int) - ref).max() <= 1
+    np.testing.assert_array_equal(out_bgr, out[..., ::-1])
+    # only the masked region is inpainted
+    outside = np.broadcast_to(mask == 0, images.shape)
+    assert np.abs(out[outside].astype(int) - images[outside]).max() <= 1
+
+
+def test_uint8_graph_attention():
+    FLAGS = ng.Config('inpaint.yml')
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (2, 64, 96, 3)).astype(np.uint8)
+    mask = np.zeros((1, 64, 96, 1), np.uint8)
+    mask[:, 16:40, 24:64] = 255
+
+    tf.reset_default_graph()
+    model = InpaintCAModel()
+    out = model.build_uint8_server_graph(FLAGS, tf.constant(images), tf.constant(mask))
+    out_attention, flow = model.build_uint8_server_graph(
+        FLAGS, tf.constant(images), tf.constant(mask), reuse=True,
+        reverse_channels=True, attention=True)
+    with pytest.raises(ValueError):
+        model.build_uint8_server_graph(FLAGS, tf.constant(images), tf.constant(mask),
+                                       reuse=True, quality='preview', attention=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        out, out_attention, flow = sess.run([out, out_attention, flow])
+    np.testing.assert_array_equal(out_attention, out[..., ::-1])
+    assert flow.dtype == np.uint8 and flow.shape == images.shape
+    # locations outside the mask attend to themselves, which is white
+    assert (flow[:, :8, :8] == 255).all()
+
+
+def test_evicted_session_closed_after_last_run():
+    from service.inference_backend import TensorFlowBackend
+
+    class FakeSession:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    backend = TensorFlowBackend(max_graphs=1)
+    sess = FakeSession()
+    backend._graphs[(1, 8, 8, 'full', False)] = (sess, None, None, None)
+    with backend._using(1, 8, 8, 'full', False):
+        with backend._using(1, 8, 8, 'full', False) as entry:
+            assert entry[0] is sess
+            # another lane drops it from the cache while both runs are going
+            backend.close()
+        assert not sess.closed
+    assert sess.closed
+    assert not backend._in_use and not backend._retired
@@ -0,0 +1,76 @@
+import os
+import types
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from service.inference_backend import create_backend
+from service.mask_registry import default_registry
+from watch_folder import FolderWatcher
+
+
+def _service():
+    # the parts of WatermarkRemovalService the watcher uses
+    backend = create_backend('opencv')
+    return types.SimpleNamespace(load_backend=lambda: backend, masks=default_registry())
+
+
+def _drop(directory, names):
+    rng = np.random.RandomState(0)
+    for i, name in enumerate(names):
+        height, width = [(120, 160), (128, 160), (200, 150)][i % 3]
+        image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        cv2.imwrite(str(directory / name), image)
+
+
+def _watcher(tmp_path, **kwargs):
+    return FolderWatcher(_service(), str(tmp_path / 'in'), str(tmp_path / 'out'),
+                         settle=0., poll_interval=0.01, batch_size=2,
+                         decode_workers=2, **kwargs)
+
+
+def test_processes_and_quarantines(tmp_path):
+    inbox = tmp_path / 'in'
+    inbox.mkdir()
+    _drop(inbox, [f'{i}.png' for i in range(5)])
+    (inbox / 'broken.jpg').write_bytes(b'not an image')
+    (inbox / 'upload.png.part').write_bytes(b'still writing')
+    (inbox / 'notes.txt').write_text('ignored')
+
+    watcher = _watcher(tmp_path)
+    try:
+        watcher.run(once=True)
+        assert watcher.ledger.counts() == {'done': 5, 'failed': 1}
+    finally:
+        watcher.close()
+
+    assert sorted(os.listdir(tmp_path / 'out')) == [f'{i}.png' for i in range(5)]
+    assert cv2.imread(str(tmp_path / 'out' / '2.png')).shape == (200, 150, 3)
+    assert sorted(os.listdir(tmp_path / 'in_quarantine')) == ['broken.jpg',
+                                                              'broken.jpg.error.txt']
+    assert sorted(os.listdir(inbox)) == ['.watch', 'notes.txt', 'upload.png.part']
+    assert os.listdir(inbox / '.watch' / 'claimed') == []
+
+
+def test_restart_resumes_claimed_files(tmp_path):
+    inbox = tmp_path / 'in'
+    inbox.mkdir()
+    _drop(inbox, ['a.png', 'b.png', 'c.png'])
+
+    # claimed, then interrupted before processing
+    watcher = _watcher(tmp_path)
+    claims = watcher.scan()
+    watcher.close()
+    assert len(claims) == 3 and os.listdir(inbox) == ['.watch']
+    # renamed, then interrupted before the claim was recorded
+    _drop(inbox / '.watch' / 'claimed', ['0123456789abcdef_d.png'])
+
+    watcher = _watcher(tmp_path)
+    try:
+        watcher.run(once=True)
+        assert watcher.ledger.counts() == {'done': 4}
+    finally:
+        watcher.close()
+    assert sorted(os.listdir(tmp_path / 'out')) == ['a.png', 'b.png', 'c.png', 'd.png']
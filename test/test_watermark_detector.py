@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+cv2 = pytest.importorskip('cv2')
+
+from service.mask_registry import MaskRegistry
+from service.watermark_detector import WatermarkDetector
+
+
+def _glyphs(width, height):
+    """A small text-like pattern: irregular bars and a stem."""
+    mask = np.zeros((height, width), np.uint8)
+    for top, thickness, left, right in [(0.1, 0.12, 0.1, 0.7), (0.35, 0.08, 0.3, 0.55),
+                                        (0.5, 0.15, 0.1, 0.9), (0.8, 0.1, 0.45, 0.65)]:
+        mask[int(height * top):int(height * (top + thickness)),
+             int(width * left):int(width * right)] = 255
+    mask[int(height * 0.1):int(height * 0.9), int(width * 0.8):int(width * 0.86)] = 255
+    return mask
+
+
+def _background(height, width):
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    ramp = np.linspace(40, 160, width)[None, :, None]
+    return np.clip(cv2.GaussianBlur(noise, (0, 0), 4) * 0.5 + ramp, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def registry(tmp_path):
+    mask = np.zeros((300, 400), np.uint8)
+    mask[100:180, 120:280] = _glyphs(160, 80)
+    path = os.path.join(str(tmp_path), 'logo', 'landscape')
+    os.makedirs(path)
+    Image.fromarray(mask).save(os.path.join(path, 'mask.png'))
+    return MaskRegistry(str(tmp_path), reload_interval=0)
+
+
+# scale is relative to the template stretched over the whole image (x1.6)
+@pytest.mark.parametrize('scale,x,y,alpha', [
+    (1.0, 40, 30, 0.4), (0.75, 300, 200, 0.3), (0.6, 450, 350, 0.25)])
+def test_detects_blended_watermark(registry, scale, x, y, alpha):
+    image = _background(480, 640)
+    glyphs = _glyphs(int(256 * scale), int(128 * scale))
+    truth = np.zeros(image.shape[:2], bool)
+    truth[y:y + glyphs.shape[0], x:x + glyphs.shape[1]] = glyphs > 0
+    image = np.where(truth[:, :, None], image * (1 - alpha) + 255 * alpha,
+                     image).astype(np.uint8)
+
+    detection = WatermarkDetector(registry).detect(image)
+    assert detection is not None
+    assert detection.watermark_type == 'logo'
+    mask = detection.mask[:, :, 0] > 0
+    assert mask.shape == truth.shape
+    assert (mask & truth).sum() / float(truth.sum()) > 0.9
+    assert (mask & truth).sum() / float((mask | truth).sum()) > 0.5
+    assert detection.coverage < 0.1
+    ys, xs = np.nonzero(truth)
+    y0, y1, x0, x1 = detection.bbox
+    assert abs(y0 - ys.min()) < 10 and abs(x0 - xs.min()) < 10
+
+
+def test_clean_image(registry):
+    assert WatermarkDetector(registry).detect(_background(480, 640)) is None
+
+
+def test_uniform_image(registry):
+    image = np.full((200, 300, 3), 128, np.uint8)
+    assert WatermarkDetector(registry).detect(image) is None
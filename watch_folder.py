@@ -0,0 +1,370 @@
+"""Watch-folder ingestion daemon.
+
+Images dropped into --input_dir are claimed by an atomic rename into the
+work directory, processed in shape-bucketed batches by batch_inpaint's
+BatchRunner on the backend of a single WatermarkRemovalService, and written
+to --output_dir under their original name. Outputs appear by rename, so
+readers of the output directory never see partial files. Files that fail to
+decode, infer or write are moved to --quarantine_dir with an .error.txt
+next to them.
+
+Every claim and outcome is recorded in an SQLite ledger in the work
+directory. Claimed files stay in the work directory until they are finished,
+so a restarted daemon resumes them instead of missing them, and files the
+ledger has finished are never processed again.
+
+Files are picked up once unchanged for --settle seconds; hidden files and
+.tmp/.part/.partial names are ignored, so writers can drop files by rename.
+
+    python watch_folder.py --input_dir /data/inbox --output_dir /data/clean \
+        --batch_size 4 --decode_workers 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+
+from batch_inpaint import BatchRunner, Sample, Throughput
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_dir', required=True, type=str)
+parser.add_argument('--output_dir', required=True, type=str)
+parser.add_argument('--quarantine_dir', default='', type=str,
+                    help='Failed inputs; defaults to <input_dir>_quarantine.')
+parser.add_argument('--work_dir', default='', type=str,
+                    help='Claimed files and the ledger; defaults to <input_dir>/.watch. '
+                    'Must be on the same filesystem as --input_dir.')
+parser.add_argument('--processed_dir', default='', type=str,
+                    help='Move finished inputs here instead of deleting them.')
+parser.add_argument('--watermark_type', default='istock', type=str)
+parser.add_argument('--quality', default='full', type=str,
+                    choices=['full', 'preview'])
+parser.add_argument('--batch_size', default=4, type=int)
+parser.add_argument('--bucket', default=64, type=int)
+parser.add_argument('--decode_workers', default=os.cpu_count() or 1, type=int)
+parser.add_argument('--write_workers', default=2, type=int)
+parser.add_argument('--max_claim', default=256, type=int,
+                    help='Files claimed per scan, processed as one run.')
+parser.add_argument('--settle', default=2., type=float,
+                    help='Seconds a file must be unchanged before it is claimed.')
+parser.add_argument('--poll_interval', default=1., type=float)
+parser.add_argument('--report_every', default=60., type=float)
+parser.add_argument('--once', action='store_true',
+                    help='Process the files present now, then exit.')
+
+EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp'}
+PARTIAL_SUFFIXES = ('.tmp', '.part', '.partial', '.crdownload')
+
+
+def file_key(name, stat):
+    """Identifies one dropped file: the same name dropped again is a new file."""
+    return hashlib.blake2b(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode(),
+                           digest_size=8).hexdigest()
+
+
+class Ledger:
+    """
+    SQLite record of every claimed file and its outcome.
+
+    Implements the is_done/append/close interface of batch_inpaint.Manifest,
+    so BatchRunner records outcomes in it directly. Rows are keyed by
+    file_key and looked up by the claimed path.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            key TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            claimed TEXT NOT NULL,
+            output TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            details TEXT,
+            claimed_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS files_claimed ON files (claimed);
+        CREATE INDEX IF NOT EXISTS files_status ON files (status);
+    '''
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def status(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT status FROM files WHERE key = ?',
+                                   (key,)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, key, name, claimed, output):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO files (key, name, claimed, output, status, claimed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, name, claimed, output, 'claimed', time.time()))
+
+    def claimed(self):
+        """(key, name, claimed path, output) of files not finished yet"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT key, name, claimed, output FROM files WHERE status = ?',
+                ('claimed',)).fetchall()
+
+    def is_done(self, output):
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM files WHERE output = ? AND status = ?',
+                                   (output, 'done')).fetchone()
+        return row is not None and os.path.exists(output)
+
+    def append(self, record):
+        details = {k: v for k, v in record.items()
+                   if k not in ('input', 'output', 'status', 'error', 'time')}
+        with self._lock:
+            self._db.execute(
+                'UPDATE files SET status = ?, error = ?, details = ?, finished_at = ? '
+                'WHERE claimed = ?',
+                (record['status'], record.get('error'), json.dumps(details),
+                 record.get('time', time.time()), record['input']))
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
+
+    def close(self):
+        self._db.close()
+
+
+class FolderRunner(BatchRunner):
+    """
+    BatchRunner that writes each result to a hidden partial file, then
+    publishes it by rename and disposes of the claimed input: deleted (or
+    moved to processed_dir) when done, moved to quarantine_dir when failed.
+    """
+
+    def __init__(self, backend, ledger, quarantine_dir, processed_dir='', **kwargs):
+        super().__init__(backend, ledger, **kwargs)
+        self.quarantine_dir = quarantine_dir
+        self.processed_dir = processed_dir
+        self.outputs = {}
+
+    def run(self, claims):
+        """
+        Args:
+            claims: (key, name, claimed path, output) tuples
+        """
+        items = []
+        for _, name, claimed, output in claims:
+            directory, basename = os.path.split(output)
+            stem, ext = os.path.splitext(basename)
+            # cv2.imwrite picks the format from the extension
+            partial = os.path.join(directory, f'.{stem}.partial{ext}')
+            self.outputs[claimed] = (name, partial, output)
+            items.append((claimed, None, partial))
+        try:
+            return super().run(items)
+        finally:
+            self.outputs.clear()
+
+    def _finish(self, item, status, **fields):
+        claimed = item.input if isinstance(item, Sample) else item[0]
+        name, partial, output = self.outputs[claimed]
+        if status == 'done':
+            try:
+                os.replace(partial, output)
+            except OSError as e:
+                status, fields = 'failed', {'error': f'publish: {e}'}
+        if status != 'done':
+            quarantine(claimed, name, self.quarantine_dir, fields.get('error'))
+            if os.path.exists(partial):
+                os.remove(partial)
+        super()._finish(item, status, **fields)
+        if status == 'done':
+            dispose(claimed, name, self.processed_dir)
+
+
+def quarantine(claimed, name, quarantine_dir, error):
+    os.makedirs(quarantine_dir, exist_ok=True)
+    target = os.path.join(quarantine_dir, name)
+    if os.path.exists(target):
+        stem, ext = os.path.splitext(name)
+        target = os.path.join(quarantine_dir, f'{stem}.{int(time.time() * 1000)}{ext}')
+    shutil.move(claimed, target)
+    with open(target + '.error.txt', 'w') as f:
+        f.write(f'{error}\n')
+
+
+def dispose(claimed, name, processed_dir):
+    if not os.path.exists(claimed):
+        return
+    if processed_dir:
+        os.makedirs(processed_dir, exist_ok=True)
+        shutil.move(claimed, os.path.join(processed_dir, name))
+    else:
+        os.remove(claimed)
+
+
+class FolderWatcher:
+    """
+    Scans input_dir, claims settled files and runs them through a FolderRunner.
+
+    Args:
+        service: WatermarkRemovalService, its backend and masks are reused
+    """
+
+    def __init__(self, service, input_dir, output_dir, quarantine_dir='', work_dir='',
+                 processed_dir='', max_claim=256, settle=2., poll_interval=1.,
+                 report_every=60., **runner_args):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.quarantine_dir = quarantine_dir or input_dir.rstrip('/') + '_quarantine'
+        self.work_dir = work_dir or os.path.join(input_dir, '.watch')
+        self.claim_dir = os.path.join(self.work_dir, 'claimed')
+        self.processed_dir = processed_dir
+        self.max_claim = max_claim
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.report_every = report_every
+        for directory in (output_dir, self.claim_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.ledger = Ledger(os.path.join(self.work_dir, 'ledger.sqlite3'))
+        self.runner = FolderRunner(
+            service.load_backend(), self.ledger, self.quarantine_dir, processed_dir,
+            registry=service.masks, report_every=report_every, **runner_args)
+        self.stats = Throughput(0, 0)
+        self.stopped = threading.Event()
+
+    def recover(self):
+        """
+        Files left in the claim directory by an interrupted run
+
+        Returns:
+            list: claims to process again
+        """
+        claims = []
+        known = set()
+        for key, name, claimed, output in self.ledger.claimed():
+            known.add(claimed)
+            if os.path.exists(claimed):
+                claims.append((key, name, claimed, output))
+            else:
+                self.ledger.append({'input': claimed, 'status': 'failed',
+                                    'error': 'claimed file lost by an interrupted run'})
+        for entry in os.scandir(self.claim_dir):
+            if entry.path in known:
+                continue
+            key, _, name = entry.name.partition('_')
+            status = self.ledger.status(key)
+            if status == 'done':
+                # finished, interrupted before the input was removed
+                dispose(entry.path, name, self.processed_dir)
+                continue
+            # renamed, interrupted before the claim was recorded
+            output = os.path.join(self.output_dir, name)
+            self.ledger.claim(key, name, entry.path, output)
+            claims.append((key, name, entry.path, output))
+        if claims:
+            print(f'Resuming {len(claims)} files claimed by an earlier run.')
+        return claims
+
+    def scan(self):
+        """Claim up to max_claim settled files, oldest first."""
+        now = time.time()
+        candidates = []
+        for entry in os.scandir(self.input_dir):
+            name = entry.name
+            if name.startswith('.') or name.endswith(PARTIAL_SUFFIXES) or \
+                    os.path.splitext(name)[1].lower() not in EXTENSIONS or \
+                    not entry.is_file():
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime >= self.settle:
+                candidates.append((stat.st_mtime, name, stat))
+        candidates.sort()
+
+        claims = []
+        for _, name, stat in candidates[:self.max_claim]:
+            key = file_key(name, stat)
+            source = os.path.join(self.input_dir, name)
+            if self.ledger.status(key) == 'done':
+                print(f'Already processed: {name}')
+                dispose(source, name, self.processed_dir)
+                continue
+            claimed = os.path.join(self.claim_dir, f'{key}_{name}')
+            try:
+                # atomic: of several daemons on the same directory only one wins
+                os.rename(source, claimed)
+            except FileNotFoundError:
+                continue
+            output = os.path.join(self.output_dir, name)
+            self.ledger.claim(key, name, claimed, output)
+            claims.append((key, name, claimed, output))
+        return claims
+
+    def process(self, claims):
+        report = self.runner.run(claims)
+        self.stats.done += report['done']
+        self.stats.megapixels += report['megapixels_per_s'] * report['elapsed_s']
+        self.stats.failed += report['failed']
+        self.stats.batches += report['batches']
+        self.stats.stage_seconds.update(report['stage_seconds'])
+
+    def run(self, once=False):
+        claims = self.recover()
+        if claims:
+            self.process(claims)
+        last_report = time.time()
+        while not self.stopped.is_set():
+            claims = self.scan()
+            if claims:
+                self.process(claims)
+            if time.time() - last_report > self.report_every:
+                last_report = time.time()
+                self.print_report()
+            if once and not claims:
+                break
+            if not claims or len(claims) < self.max_claim:
+                self.stopped.wait(self.poll_interval)
+        self.print_report()
+
+    def print_report(self):
+        report = self.stats.report()
+        print(f"{report['done']} done, {report['failed']} failed, "
+              f"{report['images_per_s'] * 60:.0f} files/min, mean batch "
+              f"{report['mean_batch']:.1f}; ledger {self.ledger.counts()}")
+
+    def stop(self, *_):
+        self.stopped.set()
+
+    def close(self):
+        self.ledger.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    from service.watermark_service import WatermarkRemovalService
+
+    service = WatermarkRemovalService()
+    watcher = FolderWatcher(
+        service, args.input_dir, args.output_dir, quarantine_dir=args.quarantine_dir,
+        work_dir=args.work_dir, processed_dir=args.processed_dir,
+        max_claim=args.max_claim, settle=args.settle, poll_interval=args.poll_interval,
+        report_every=args.report_every, watermark_type=args.watermark_type,
+        quality=args.quality, batch_size=args.batch_size, bucket=args.bucket,
+        decode_workers=args.decode_workers, write_workers=args.write_workers)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    print(f'Watching {args.input_dir}')
+    try:
+        watcher.run(once=args.once)
+    finally:
+        watcher.close()